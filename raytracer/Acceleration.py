@@ -0,0 +1,434 @@
+"""
+Contains acceleration structures.
+
+Acceleration structures limit the number of primitives (scene objects, triangles etc.)
+that have to be tested for collisions with a ray. Primitives are described only by
+their axis-aligned bounding boxes, so the same structure can be used for any kind of
+primitive. Testing a ray against the primitives themselves is done by a function passed
+by the caller.
+"""
+import numpy as np
+from raytracer import Vectors
+from raytracer.Objects import BatchCollisionResult, get_collision_distance
+
+# Estimated cost of testing a ray against a bounding box, relative to the cost of testing
+# a ray against a primitive. Used by the surface area heuristic.
+_TRAVERSAL_COST = 0.125
+# Packets with fewer rays are traced through a hierarchy one ray at a time.
+_MIN_PACKET_SIZE = 16
+
+
+class BoundingVolumeHierarchy:
+    """
+    Represents a bounding volume hierarchy (BVH) of axis-aligned bounding boxes.
+
+    The hierarchy is built using the surface area heuristic (SAH) and stored in flat numpy arrays.
+    Nodes are stored in depth-first order, so the left child of an inner node always directly follows
+    its parent. A leaf node refers to a range of the primitives array, which contains primitive indices
+    (indices of bounding boxes passed to the constructor).
+    """
+    def __init__(self, lower, upper, max_leaf_size=4):
+        """
+        :param lower: minimal corners of bounding boxes of primitives as a numpy array of shape (N, 3)
+        :param upper: maximal corners of bounding boxes of primitives as a numpy array of shape (N, 3)
+        :param max_leaf_size: number of primitives that are never split into separate nodes
+        """
+        lower = np.asarray(lower, dtype=float).reshape(-1, 3)
+        upper = np.asarray(upper, dtype=float).reshape(-1, 3)
+        # flat boxes (e.g. boxes of circles) are slightly enlarged, so that a ray can always pass through them
+        padding = 1e-9 * (1 + np.abs(lower) + np.abs(upper))
+        lower, upper = lower - padding, upper + padding
+        self.primitives = np.arange(len(lower))
+        nodes = []
+        # a hierarchy of no primitives has no nodes, and rays never collide with it
+        stack = [(0, len(lower), None)] if len(lower) else []
+        while stack:
+            start, end, parent = stack.pop()
+            index = len(nodes)
+            if parent is not None:
+                nodes[parent][5] = index
+            primitives = self.primitives[start:end]
+            node = [lower[primitives].min(axis=0), upper[primitives].max(axis=0), start, end - start, 0, 0]
+            nodes.append(node)
+            split = _find_split(lower[primitives], upper[primitives], max_leaf_size)
+            if split is not None:
+                axis, order, count = split
+                self.primitives[start:end] = primitives[order]
+                node[3], node[4] = 0, axis
+                stack.append((start + count, end, index))
+                stack.append((start, start + count, None))
+        self.node_lower = np.array([node[0] for node in nodes]).reshape(-1, 3)
+        self.node_upper = np.array([node[1] for node in nodes]).reshape(-1, 3)
+        self.node_start = np.array([node[2] for node in nodes], dtype=int)
+        self.node_count = np.array([node[3] for node in nodes], dtype=int)
+        self.node_axis = np.array([node[4] for node in nodes], dtype=int)
+        self.node_right = np.array([node[5] for node in nodes], dtype=int)
+        self._node_lists = None
+
+    @classmethod
+    def from_arrays(cls, arrays, primitives):
+        """
+        Recreates a hierarchy from arrays returned by get_arrays (e.g. loaded from a file).
+        :param arrays: dictionary of node arrays
+        :param primitives: numpy array of primitive indices
+        """
+        hierarchy = cls.__new__(cls)
+        hierarchy.__dict__.update(arrays)
+        hierarchy.primitives = primitives
+        hierarchy._node_lists = None
+        return hierarchy
+
+    def get_arrays(self):
+        """
+        Returns all node arrays as a dictionary (primitive indices are not included).
+        """
+        return {name: getattr(self, name) for name in ('node_lower', 'node_upper', 'node_start', 'node_count',
+                                                       'node_axis', 'node_right')}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_node_lists'] = None
+        return state
+
+    def intersect(self, eye, direction, near, far, intersect_primitives, root=0):
+        """
+        Finds the closest collision of a ray.
+
+        Nodes are visited in front-to-back order. Primitives from leaves hit by the ray are passed to
+        intersect_primitives(primitives, far), which should test them and return the distance of the
+        closest collision found so far (or far, if there is no closer collision). Nodes further
+        than that distance are skipped. If the returned value is lower than near, traversal is stopped
+        (this can be used to find any collision instead of the closest one).
+        :param eye: beginning of a ray
+        :param direction: direction of a ray
+        :param near: minimal distance of detecting collisions
+        :param far: maximal distance of detecting collisions
+        :param intersect_primitives: function testing primitives for collisions
+        :param root: index of the node the traversal starts at
+        :return: distance of the closest collision (or far, if there is no collision)
+        """
+        if not len(self.primitives):
+            return far
+        if self._node_lists is None:
+            self._node_lists = (self.node_lower.tolist(), self.node_upper.tolist(), self.node_start.tolist(),
+                                self.node_count.tolist(), self.node_axis.tolist(), self.node_right.tolist())
+        node_lower, node_upper, node_start, node_count, node_axis, node_right = self._node_lists
+        eye = [float(c) for c in eye]
+        direction = [float(c) for c in direction]
+        inverse_direction = [1 / d if d != 0 else None for d in direction]
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if not _ray_hits_box(eye, inverse_direction, node_lower[node], node_upper[node], near, far):
+                continue
+            count = node_count[node]
+            if count:
+                start = node_start[node]
+                far = intersect_primitives(self.primitives[start:start + count], far)
+                if far < near:
+                    break
+            elif direction[node_axis[node]] > 0:
+                stack.append(node_right[node])
+                stack.append(node + 1)
+            else:
+                stack.append(node + 1)
+                stack.append(node_right[node])
+        return far
+
+    def intersect_packet(self, eyes, directions, near, far, intersect_primitives, intersect_ray=None):
+        """
+        Finds the closest collisions of many rays.
+
+        Rays are traversed through the hierarchy together. Primitives from each leaf are passed to
+        intersect_primitives(rays, primitives) along with indices of rays that hit the leaf. This function
+        should test the primitives and lower far values of the rays that collide with them (far array
+        is modified in place). Nodes further than far are skipped, so rays that do not need to be traced
+        any further can be removed by setting their far values to -numpy.inf.
+
+        If intersect_ray is given, packets smaller than a few rays are split, and traversal of each ray
+        is continued separately by intersect_ray(ray, node) (it should also update the far array).
+        :param eyes: beginnings of rays as a numpy array of shape (N, 3) (or a single point shared by all rays)
+        :param directions: directions of rays as a numpy array of shape (N, 3)
+        :param near: minimal distance of detecting collisions (a single value or N values)
+        :param far: numpy array of N maximal distances of detecting collisions
+        :param intersect_primitives: function testing primitives for collisions
+        :param intersect_ray: function continuing traversal of one ray from given node
+        """
+        if not len(self.primitives):
+            return
+        with np.errstate(divide='ignore'):
+            inverse_directions = 1 / directions
+        mean_direction = np.sum(directions, axis=0)
+        stack = [(0, np.arange(len(directions)))]
+        while stack:
+            node, rays = stack.pop()
+            hits = _rays_hit_box(Vectors.select(eyes, rays, 1), inverse_directions[rays], self.node_lower[node],
+                                 self.node_upper[node], Vectors.select(near, rays), far[rays])
+            rays = rays[hits]
+            if not len(rays):
+                continue
+            if intersect_ray and len(rays) < _MIN_PACKET_SIZE:
+                for ray in rays:
+                    intersect_ray(ray, node)
+                continue
+            count = self.node_count[node]
+            if count:
+                start = self.node_start[node]
+                intersect_primitives(rays, self.primitives[start:start + count])
+            elif mean_direction[self.node_axis[node]] > 0:
+                stack.append((self.node_right[node], rays))
+                stack.append((node + 1, rays))
+            else:
+                stack.append((node + 1, rays))
+                stack.append((self.node_right[node], rays))
+
+
+class ObjectHierarchy:
+    """
+    Represents an acceleration structure for finding collisions of rays with scene objects.
+
+    Objects that have bounding boxes are organized in a bounding volume hierarchy. Objects without
+    bounding boxes (e.g. planes) are kept on a separate list and always tested. If the hierarchy
+    would not speed up the search (e.g. there are only few objects), all objects are kept on that list.
+
+    Collisions are detected the same way as by Scene.check_collision and Scene.check_collisions.
+    """
+    def __init__(self, objects):
+        """
+        :param objects: list of scene objects
+        """
+        self.material_offsets = np.cumsum([0] + [len(obj.materials) for obj in objects])[:-1]
+        self.unbounded_objects = []
+        self.bounded_objects = []
+        boxes = []
+        for index, obj in enumerate(objects):
+            box = obj.get_bounding_box() if hasattr(obj, 'get_bounding_box') else None
+            if box is None:
+                self.unbounded_objects.append((index, obj))
+            else:
+                self.bounded_objects.append((index, obj))
+                boxes.append(box)
+        self.hierarchy = None
+        if boxes:
+            lower, upper = zip(*boxes)
+            hierarchy = BoundingVolumeHierarchy(lower, upper)
+            if hierarchy.node_count[0] == 0:
+                self.hierarchy = hierarchy
+            else:
+                self.unbounded_objects = sorted(self.unbounded_objects + self.bounded_objects, key=lambda o: o[0])
+                self.bounded_objects = []
+
+    def check_collision(self, eye, direction, near, far):
+        """
+        Checks if a ray collides with any of the objects.
+        :return: a CollisionResult tuple of (collision point, normal, material, distance) or None, if there is
+        no collision
+        """
+        return self._find_closest_collision(eye, direction, near, far)[0]
+
+    def check_collisions(self, eyes, directions, near, far):
+        """
+        Checks if many rays collide with any of the objects.
+
+        Rays are traced through the hierarchy in packets. Packets that are split into only
+        a few rays are traced one ray at a time, which is faster for small numbers of rays.
+        :return: a tuple of (distances, normals, material indices), like Scene.check_collisions
+        """
+        distances = np.full(len(directions), np.inf)
+        normals = np.zeros((len(directions), 3))
+        materials = np.full(len(directions), -1)
+        far = np.minimum(far, distances)
+
+        def intersect_objects(rays, objects):
+            for index, obj in objects:
+                result = obj.check_collisions(Vectors.select(eyes, rays, 1), directions[rays],
+                                              Vectors.select(near, rays), far[rays])
+                closer = result.distance < distances[rays]
+                closer_rays = rays[closer]
+                distances[closer_rays] = far[closer_rays] = result.distance[closer]
+                normals[closer_rays] = result.normal[closer]
+                materials[closer_rays] = result.material[closer] + self.material_offsets[index]
+
+        def intersect_ray(ray, node):
+            eye, direction = Vectors.select(eyes, ray, 1), directions[ray]
+            result, index, distance = self._find_closest_collision(eye, direction, Vectors.select(near, ray),
+                                                                   far[ray], node)
+            if result:
+                scene_index, obj = self.bounded_objects[index]
+                distances[ray] = far[ray] = distance
+                normals[ray] = result.normal
+                materials[ray] = self.material_offsets[scene_index] + _material_index(obj, result)
+
+        intersect_objects(np.arange(len(directions)), self.unbounded_objects)
+        if self.hierarchy:
+            self.hierarchy.intersect_packet(eyes, directions, near, far,
+                                            lambda rays, primitives: intersect_objects(
+                                                rays, [self.bounded_objects[p] for p in primitives]),
+                                            intersect_ray)
+        return BatchCollisionResult(distances, normals, materials)
+
+    def find_occluder(self, eye, direction, near, far, node=None):
+        """
+        Finds any object that collides with a ray (not necessarily the closest one).
+        :param node: if given, only bounded objects from this node of the hierarchy are tested
+        :return: the object or None, if there is no collision
+        """
+        occluder = None
+
+        def occlude_objects(objects, far):
+            nonlocal occluder
+            for index, obj in objects:
+                if obj.check_occlusion(eye, direction, near, far):
+                    occluder = obj
+                    return -np.inf
+            return far
+
+        if node is None:
+            if occlude_objects(self.unbounded_objects, far) < near:
+                return occluder
+            node = 0
+        if self.hierarchy:
+            self.hierarchy.intersect(eye, direction, near, far,
+                                     lambda primitives, far: occlude_objects(
+                                         [self.bounded_objects[p] for p in primitives], far), node)
+        return occluder
+
+    def check_occlusions(self, eyes, directions, near, far):
+        """
+        Checks if many rays collide with any of the objects (not necessarily the closest ones).
+        :return: numpy array of boolean values
+        """
+        far = np.array(np.broadcast_to(far, len(directions)), dtype=float)
+
+        def occlude_objects(rays, objects):
+            for index, obj in objects:
+                occluded = obj.check_occlusions(Vectors.select(eyes, rays, 1), directions[rays],
+                                                Vectors.select(near, rays), far[rays])
+                far[rays[occluded]] = -np.inf
+                rays = rays[~occluded]
+                if not len(rays):
+                    break
+
+        def occlude_ray(ray, node):
+            if self.find_occluder(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                  far[ray], node) is not None:
+                far[ray] = -np.inf
+
+        occlude_objects(np.arange(len(directions)), self.unbounded_objects)
+        if self.hierarchy:
+            self.hierarchy.intersect_packet(eyes, directions, near, far,
+                                            lambda rays, primitives: occlude_objects(
+                                                rays, [self.bounded_objects[p] for p in primitives]),
+                                            occlude_ray)
+        return far == -np.inf
+
+    def _find_closest_collision(self, eye, direction, near, far, node=None):
+        """
+        Finds the closest collision of a ray using scalar calculations.
+        :param node: if given, only bounded objects from this node of the hierarchy are tested
+        :return: a tuple of (collision result, index of a bounded object, distance), collision result
+        is None if there is no collision (index is -1 if the closest object is unbounded)
+        """
+        closest = [None, -1]
+
+        def intersect_objects(objects, indices, min_collision_distance):
+            for index in indices:
+                result = objects[index][1].check_collision(eye, direction, near, min_collision_distance)
+                if result:
+                    distance = get_collision_distance(eye, result)
+                    if distance < min_collision_distance:
+                        closest[:] = result, index if objects is self.bounded_objects else -1
+                        min_collision_distance = distance
+            return min_collision_distance
+
+        if node is None:
+            far = intersect_objects(self.unbounded_objects, range(len(self.unbounded_objects)), far)
+            node = 0
+        if self.hierarchy:
+            far = self.hierarchy.intersect(eye, direction, near, far,
+                                           lambda primitives, far: intersect_objects(self.bounded_objects,
+                                                                                     primitives, far), node)
+        return closest[0], closest[1], far
+
+
+def _material_index(obj, collision_result):
+    """
+    Finds an index of a collision result's material in the object's materials tuple.
+
+    Objects that use one material for more than one purpose (e.g. the same material on both
+    sides of a circle) give the first matching index, which refers to the same material.
+    """
+    return obj.materials.index(collision_result.material)
+
+
+def _find_split(lower, upper, max_leaf_size):
+    """
+    Finds the best split of primitives into 2 groups using the surface area heuristic.
+    :return: a tuple of (axis, order of primitives, size of the first group),
+    or None if the primitives should not be split
+    """
+    count = len(lower)
+    if count <= max_leaf_size:
+        return None
+    node_area = _surface_area(lower.min(axis=0), upper.max(axis=0))
+    centroids = (lower + upper) / 2
+    best_cost, best_split = count, None
+    left_counts = np.arange(1, count)
+    for axis in range(3):
+        order = np.argsort(centroids[:, axis], kind='stable')
+        sorted_lower, sorted_upper = lower[order], upper[order]
+        left_areas = _surface_area(np.minimum.accumulate(sorted_lower), np.maximum.accumulate(sorted_upper))
+        right_areas = _surface_area(np.minimum.accumulate(sorted_lower[::-1])[::-1],
+                                    np.maximum.accumulate(sorted_upper[::-1])[::-1])
+        costs = left_areas[:-1]*left_counts + right_areas[1:]*(count - left_counts)
+        split = np.argmin(costs)
+        cost = _TRAVERSAL_COST + costs[split] / node_area if node_area > 0 else count
+        if cost < best_cost:
+            best_cost, best_split = cost, (axis, order, split + 1)
+    return best_split
+
+
+def _surface_area(lower, upper):
+    """
+    Calculates surface areas of boxes.
+    """
+    size = upper - lower
+    return 2*(size[..., 0]*size[..., 1] + size[..., 1]*size[..., 2] + size[..., 2]*size[..., 0])
+
+
+def _ray_hits_box(eye, inverse_direction, lower, upper, near, far):
+    """
+    Checks if a ray passes through a box between near and far (slab method).
+
+    All vectors are lists of 3 floats, None in inverse_direction means that the ray is parallel to an axis.
+    """
+    for axis in range(3):
+        inverse = inverse_direction[axis]
+        if inverse is None:
+            if not lower[axis] <= eye[axis] <= upper[axis]:
+                return False
+            continue
+        t1 = (lower[axis] - eye[axis]) * inverse
+        t2 = (upper[axis] - eye[axis]) * inverse
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > near:
+            near = t1
+        if t2 < far:
+            far = t2
+        if near > far:
+            return False
+    return True
+
+
+def _rays_hit_box(eyes, inverse_directions, lower, upper, near, far):
+    """
+    Checks which of many rays pass through a box between near and far (slab method).
+    :return: numpy array of boolean values
+    """
+    with np.errstate(invalid='ignore'):
+        t1 = (lower - eyes) * inverse_directions
+        t2 = (upper - eyes) * inverse_directions
+    t_near = np.fmax(np.max(np.fmin(t1, t2), axis=1), near)
+    t_far = np.fmin(np.min(np.fmax(t1, t2), axis=1), far)
+    return t_near <= t_far
@@ -0,0 +1,196 @@
+"""
+Contains tools for rendering animations (sequences of frames).
+
+An animation is rendered by one pool of worker processes. The scene is sent to each worker only once,
+when the pool starts, and each worker keeps its own copy of it. Tasks sent to the workers contain only
+a tile, a camera of the frame and animated attributes of scene objects and lights.
+
+Animated attributes are described by a function changes(frame), which returns a dictionary
+{(collection, index, attribute): value}, where collection is 'objects' or 'lights', index is an index
+of an object or a light in that collection and value is a new value of the attribute, e.g.:
+
+    def changes(frame):
+        return {('objects', 0, 'center'): np.array((0, frame / 10, 0)),
+                ('lights', 1, 'color'): np.array((255, 255 - frame, 255 - frame))}
+
+Values are absolute (not relative to the previous frame) and should have the same type as the original
+attributes (e.g. numpy arrays for positions). An attribute that is not returned for a frame
+keeps the value it had in the last frame that changed it.
+
+Animated attributes are pickled once per frame and sent with every tile of that frame. Any worker can
+render tiles of any frame, so it cannot rely on having seen the previous frames, and all attributes
+changed so far (not only those returned for the frame) are sent; their number should be kept small.
+Each worker applies them once per frame. If attributes of objects change, the worker rebuilds
+the acceleration structure of its scene, which for scenes with many objects can take longer than
+rendering a small tile.
+"""
+import itertools
+import pickle
+from collections import deque, namedtuple
+from multiprocessing.pool import Pool
+import numpy as np
+from PIL import Image
+from raytracer.Acceleration import ObjectHierarchy
+from raytracer.Camera import Camera, _calculate_tile_pixels
+from raytracer.Compilation import CompiledScene
+from raytracer.Framebuffer import get_tiles
+
+Keyframe = namedtuple('Keyframe', 'frame position look_at')
+
+_worker_scene = None
+_worker_state = {}
+_worker_frame = None
+
+
+class CameraPath:
+    """
+    Represents a path of a camera, described by keyframes.
+
+    Position and look_at point of the camera are interpolated linearly between keyframes. Before the first
+    keyframe and after the last one, the camera does not move.
+    """
+    def __init__(self, keyframes, up=(0, 1, 0), horizontal_angle=45, antialiasing=None):
+        """
+        :param keyframes: a sequence of keyframes (tuples of (frame, position, look_at)), ordered by frame
+        :param up: vector representing the 'up' direction of the camera (see Camera)
+        :param horizontal_angle: horizontal angle of view in degrees
+        :param antialiasing: sampler used for anti-aliasing (see Camera)
+        """
+        self.keyframes = [Keyframe(*keyframe) for keyframe in keyframes]
+        if not self.keyframes:
+            raise ValueError('Camera path needs at least one keyframe')
+        self.up = up
+        self.horizontal_angle = horizontal_angle
+        self.antialiasing = antialiasing
+
+    def get_camera(self, frame):
+        """
+        Creates a camera for given frame.
+        :return: Camera object
+        """
+        frames = [keyframe.frame for keyframe in self.keyframes]
+        position, look_at = (np.array([np.interp(frame, frames, [np.asarray(getattr(keyframe, name), dtype=float)[axis]
+                                                                  for keyframe in self.keyframes])
+                                       for axis in range(3)])
+                             for name in ('position', 'look_at'))
+        return Camera(position, look_at, self.up, self.horizontal_angle, self.antialiasing)
+
+
+class Animation:
+    """
+    Represents an animation of a scene.
+    """
+    def __init__(self, scene, camera_path, frame_count, changes=None):
+        """
+        :param scene: animated scene (it is not modified, workers animate their own copies); a compiled scene
+        (see Scene.compile) has no objects and lights to change, so it can only be used without changes
+        :param camera_path: CameraPath object (or any object with a method get_camera(frame))
+        :param frame_count: number of frames (frames are numbered from 0)
+        :param changes: function returning animated attributes of given frame (see module description)
+        """
+        if changes is not None and isinstance(scene, CompiledScene):
+            raise ValueError('Attributes of a compiled scene cannot be animated, animate the source scene instead')
+        self.scene = scene
+        self.camera_path = camera_path
+        self.frame_count = frame_count
+        self.changes = changes
+
+    def render_frames(self, image_size=(128, 72), batch=False, tile_size=(64, 64), processes=None, frames_ahead=2):
+        """
+        Renders all frames of the animation.
+
+        This is a generator, which yields frames in order, each of them as soon as it is finished
+        (workers render tiles of the next frames in the meantime). Closing the generator stops the workers.
+        :param image_size: image size as a tuple (width, height)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :param frames_ahead: maximal number of frames rendered ahead of the last yielded frame (so that
+        finished tiles do not pile up in memory if frames are consumed slower than they are rendered)
+        :return: generator of tuples (frame, image), where image is a PIL Image object
+        """
+        width, height = image_size
+        tiles = get_tiles(image_size, tile_size)
+        frame_tasks = self._get_tasks(tiles, image_size, batch)
+        with Pool(processes, initializer=_load_scene, initargs=(self.scene,)) as pool:
+            pending = deque()
+            for frame in range(self.frame_count):
+                for tasks in itertools.islice(frame_tasks, frames_ahead + 1 - len(pending)):
+                    pending.append([pool.apply_async(_render_tile, (task,)) for task in tasks])
+                pixels = np.zeros((height, width, 3), dtype=np.uint8)
+                for result in pending.popleft():
+                    tile, colors = result.get()
+                    pixels[tile.top:tile.bottom, tile.left:tile.right] = colors
+                yield frame, Image.fromarray(pixels)
+
+    def render(self, file_name_pattern='frame{:04d}.png', image_size=(128, 72), batch=False, tile_size=(64, 64),
+               processes=None):
+        """
+        Renders all frames of the animation and saves them to files.
+        :param file_name_pattern: pattern of names of output files (formatted with a frame number)
+        :param image_size: image size as a tuple (width, height)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :return: list of names of saved files
+        """
+        file_names = []
+        for frame, image in self.render_frames(image_size, batch, tile_size, processes):
+            file_names.append(file_name_pattern.format(frame))
+            image.save(file_names[-1])
+        return file_names
+
+    def _get_tasks(self, tiles, image_size, batch):
+        state = {}
+        state_data = pickle.dumps(state)
+        for frame in range(self.frame_count):
+            if self.changes:
+                state.update(self.changes(frame))
+                state_data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+            camera = self.camera_path.get_camera(frame)
+            yield [(frame, camera, state_data, tile, image_size, batch) for tile in tiles]
+
+
+def _load_scene(scene):
+    """
+    Initializes a worker process with a copy of the scene.
+    """
+    global _worker_scene, _worker_state, _worker_frame
+    scene.prepare()
+    _worker_scene = scene
+    _worker_state = {}
+    _worker_frame = None
+
+
+def _apply_state(state):
+    """
+    Sets animated attributes of the worker's scene (only attributes that have changed are set).
+    """
+    objects_changed = lights_changed = False
+    for key, value in state.items():
+        if key in _worker_state and np.array_equal(_worker_state[key], value):
+            continue
+        collection, index, attribute = key
+        setattr(getattr(_worker_scene, collection)[index], attribute, value)
+        _worker_state[key] = value
+        objects_changed |= collection == 'objects'
+        lights_changed |= collection == 'lights'
+    # only structures depending on the changed collection are rebuilt
+    if objects_changed:
+        _worker_scene.acceleration_structure = ObjectHierarchy(_worker_scene.objects)
+        _worker_scene.material_table = None
+        _worker_scene.material_table = _worker_scene.get_material_table()
+    if lights_changed:
+        _worker_scene.light_table = None
+        _worker_scene.light_table = _worker_scene.get_light_table()
+    if objects_changed or lights_changed:
+        _worker_scene.last_occluders = {}
+
+
+def _render_tile(task):
+    global _worker_frame
+    frame, camera, state_data, tile, image_size, batch = task
+    if frame != _worker_frame:
+        _apply_state(pickle.loads(state_data))
+        _worker_frame = frame
+    return _calculate_tile_pixels(tile, camera, image_size, _worker_scene, batch)
@@ -0,0 +1,324 @@
+"""
+Contains a benchmark suite, which measures rendering performance of fixed scenes.
+
+The suite renders the scenes from the Examples module, as well as generated scenes that stress
+specific parts of the ray tracer (many objects, many lights, deep reflections), at several image
+sizes and numbers of worker processes. Each benchmark runs in a separate process, so that its
+peak memory usage can be measured independently of other benchmarks.
+
+Results are saved as JSON, so that they can be compared between commits:
+
+    python -m raytracer.Benchmarks --output new.json --compare old.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from functools import partial
+import numpy as np
+from raytracer import Examples
+from raytracer.Camera import Camera
+from raytracer.Lights import Ambient, Point, Sun
+from raytracer.Materials import Material, GRAY_MATTE, MIRROR_GLOSSY
+from raytracer.Objects import Sphere, Plane, Circle
+from raytracer.Scene import Scene
+from raytracer.Statistics import RenderStats
+
+RESULTS_VERSION = 3
+
+
+def create_spheres_scene(sphere_count, seed=0):
+    """
+    Creates a scene with randomly placed spheres of random colors.
+
+    Spheres fill a cube whose volume grows with the number of spheres, so the density of the scene
+    (and the number of spheres visible in each pixel) stays roughly the same.
+    :param sphere_count: number of spheres
+    :param seed: seed of the random generator
+    :return: a tuple of (scene, camera)
+    """
+    random = np.random.default_rng(seed)
+    size = sphere_count ** (1/3)
+    scene = Scene()
+    for center, color in zip(random.uniform(-size, size, (sphere_count, 3)),
+                             random.integers(0, 256, (sphere_count, 3))):
+        scene.objects.append(Sphere(center, 0.3, Material(tuple(int(c) for c in color))))
+    scene.objects.append(Plane(position=(0, -size - 1, 0), material=GRAY_MATTE))
+    scene.lights.append(Sun(direction=(-1, -3, -2)))
+    scene.lights.append(Ambient())
+
+    camera = Camera((2.5*size, 1.5*size, 2.5*size), (0, 0, 0))
+    return scene, camera
+
+
+def create_lights_scene(light_count, seed=0):
+    """
+    Creates a scene with a few spheres illuminated by many point lights.
+    :param light_count: number of point lights
+    :param seed: seed of the random generator
+    :return: a tuple of (scene, camera)
+    """
+    random = np.random.default_rng(seed)
+    scene = Scene()
+    for x in range(-2, 3):
+        for z in range(-2, 3):
+            scene.objects.append(Sphere((x, 0, z), 0.4, Material((200, 200, 200))))
+    scene.objects.append(Plane(position=(0, -0.5, 0), material=GRAY_MATTE))
+    for position, color in zip(random.uniform((-4, 0.5, -4), (4, 4, 4), (light_count, 3)),
+                               random.integers(0, 256, (light_count, 3))):
+        scene.lights.append(Point(position=position, color=tuple(int(c) for c in color),
+                                  max_lighting_distance=8))
+    scene.lights.append(Ambient())
+
+    camera = Camera((0, 4, 6), (0, 0, 0))
+    return scene, camera
+
+
+def create_street_lamps_scene(lamp_count, seed=0):
+    """
+    Creates a long street lit by many point lights of short range (only a few of them reach each point).
+    :param lamp_count: number of lamps (placed in pairs on both sides of the street)
+    :param seed: seed of the random generator
+    :return: a tuple of (scene, camera)
+    """
+    random = np.random.default_rng(seed)
+    scene = Scene()
+    scene.background_color = (8, 8, 24)
+    scene.objects.append(Plane(position=(0, 0, 0), material=GRAY_MATTE))
+    length = lamp_count // 2 * 4
+    for z in range(-4, length, 8):
+        for x in (-5, 5):
+            scene.objects.append(Sphere((x, 1, -z), 1, Material(tuple(int(c) for c in random.integers(0, 256, 3)))))
+    for index in range(lamp_count):
+        scene.lights.append(Point(position=(-3 if index % 2 else 3, 4, -(index // 2) * 4), color=(255, 220, 160),
+                                  max_lighting_distance=8))
+    scene.lights.append(Ambient(color=(16, 16, 16)))
+
+    camera = Camera((0, 6, 8), (0, 1, -40))
+    return scene, camera
+
+
+def create_mirrors_scene(recursion_level):
+    """
+    Creates a scene with two parallel mirrors, in which rays are reflected many times.
+    :param recursion_level: maximal number of reflections of a ray
+    :return: a tuple of (scene, camera)
+    """
+    scene = Scene()
+    scene.max_recursion_level = recursion_level
+    scene.objects.append(Sphere((0, 0, 0), 0.25, Material((180, 60, 220))))
+    scene.objects.append(Circle((2, 0, 0), (-1, 0, 0), 4, MIRROR_GLOSSY))
+    scene.objects.append(Circle((-2, 0, 0), (1, 0, 0), 4, MIRROR_GLOSSY))
+    scene.objects.append(Plane(position=(0, -1, 0), material=GRAY_MATTE))
+    scene.lights.append(Point(position=(0, 3, 1), max_lighting_distance=128))
+    scene.lights.append(Ambient())
+
+    camera = Camera((1.5, 0.3, 0.5), (-2, 0, 0))
+    return scene, camera
+
+
+SCENES = {
+    'water_molecule': Examples.create_water_molecule_scene,
+    'reflecting_sphere': Examples.create_reflecting_sphere_scene,
+    'infinity_mirror': Examples.create_infinity_mirror_scene,
+    'spheres_10': partial(create_spheres_scene, 10),
+    'spheres_1k': partial(create_spheres_scene, 1000),
+    'spheres_10k': partial(create_spheres_scene, 10000),
+    'spheres_100k': partial(create_spheres_scene, 100000),
+    'lights_64': partial(create_lights_scene, 64),
+    'street_lamps_2k': partial(create_street_lamps_scene, 2000),
+    'mirrors_32': partial(create_mirrors_scene, 32),
+}
+
+
+def run_benchmark(scene_name, image_size, processes, batch=True):
+    """
+    Renders one scene and measures the performance of rendering.
+
+    The measurement runs in a separate process (which starts its own worker processes),
+    so peak memory usage includes only this benchmark.
+    :param scene_name: name of a scene from SCENES
+    :param image_size: image size as a tuple (width, height)
+    :param processes: number of worker processes
+    :param batch: if True, rays are traced using numpy arrays
+    :return: dictionary with results
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_measure, args=(sender, scene_name, image_size, processes, batch))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError('Benchmark {} failed'.format(scene_name))
+    finally:
+        process.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def run_benchmarks(scene_names, image_sizes, process_counts, batch=True, log=None):
+    """
+    Runs benchmarks for all combinations of scenes, image sizes and numbers of worker processes.
+
+    Scaling efficiency of a benchmark is its speedup in relation to the benchmark with the lowest number of
+    processes (for the same scene and image size) divided by the ratio of the numbers of processes.
+    The value of 1 means perfect scaling.
+    :param scene_names: names of scenes from SCENES
+    :param image_sizes: image sizes as tuples (width, height)
+    :param process_counts: numbers of worker processes
+    :param batch: if True, rays are traced using numpy arrays
+    :param log: function called with each result (e.g. for printing progress)
+    :return: dictionary with results and information about the environment (serializable to JSON)
+    """
+    results = []
+    for scene_name in scene_names:
+        for image_size in image_sizes:
+            base = None
+            for processes in sorted(process_counts):
+                result = run_benchmark(scene_name, image_size, processes, batch)
+                if base is None:
+                    base = result
+                speedup = base['wall_time'] / result['wall_time']
+                result['scaling_efficiency'] = speedup * base['processes'] / processes
+                results.append(result)
+                if log:
+                    log(result)
+    return {
+        'version': RESULTS_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': _get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'results': results,
+    }
+
+
+def compare_results(old_results, new_results, tolerance=0.1):
+    """
+    Compares two sets of benchmark results.
+    :param old_results: results returned by run_benchmarks (e.g. of a previous commit)
+    :param new_results: results returned by run_benchmarks
+    :param tolerance: relative slowdown that is not considered a regression
+    :return: list of tuples (key, old rays per second, new rays per second) for benchmarks
+    that became slower by more than the tolerance, where key is a tuple (scene, image size, processes, batch)
+    """
+    old = {_get_key(result): result for result in old_results['results']}
+    regressions = []
+    for result in new_results['results']:
+        key = _get_key(result)
+        if key in old and result['rays_per_second'] < old[key]['rays_per_second'] * (1 - tolerance):
+            regressions.append((key, old[key]['rays_per_second'], result['rays_per_second']))
+    return regressions
+
+
+def _measure(connection, scene_name, image_size, processes, batch):
+    """
+    Runs one benchmark in a separate process and sends its result through a connection.
+
+    Rays (primary, reflected and shadow rays) are counted by RenderStats. Counting rays of batch renders
+    costs almost nothing, so they are counted while the render is measured. Scalar renders would be
+    slowed down by counting, so they are rendered again to count their rays.
+    """
+    try:
+        scene, camera = SCENES[scene_name]()
+        width, height = image_size
+        stats = RenderStats()
+        start = time.perf_counter()
+        camera.render_image(scene, image_size, file_name=None, batch=batch, processes=processes,
+                            stats=stats if batch else None)
+        wall_time = time.perf_counter() - start
+        if not batch:
+            camera.render_image(scene, image_size, file_name=None, batch=batch, processes=processes, stats=stats)
+        result = {
+            'scene': scene_name,
+            'image_size': [width, height],
+            'processes': processes,
+            'batch': batch,
+            'objects': len(scene.objects),
+            'lights': len(scene.lights),
+            'wall_time': wall_time,
+            'primary_rays': stats.primary_rays,
+            'rays': stats.total_rays,
+            'rays_per_second': stats.total_rays / wall_time,
+            'pixels_per_second': width * height / wall_time,
+            'peak_rss': _get_peak_rss(),
+        }
+    except Exception as exception:
+        result = exception
+    connection.send(result)
+    connection.close()
+
+
+def _get_peak_rss():
+    """
+    Calculates peak memory usage (in bytes) of the largest single process: this process or one of its
+    finished worker processes. Memory of all processes is not summed, because the operating system
+    reports only the peak of the largest child process, not the peak of all of them together.
+    """
+    import resource  # available only on Unix
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * unit
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get_key(result):
+    return result['scene'], tuple(result['image_size']), result['processes'], result['batch']
+
+
+def _parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Measures rendering performance.')
+    parser.add_argument('--scenes', nargs='+', choices=sorted(SCENES), default=list(SCENES),
+                        help='scenes to render (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=_parse_size, default=[(128, 72), (640, 360)],
+                        help='image sizes, e.g. 640x360')
+    parser.add_argument('--processes', nargs='+', type=int,
+                        default=sorted({1, max(multiprocessing.cpu_count() // 2, 1), multiprocessing.cpu_count()}),
+                        help='numbers of worker processes')
+    parser.add_argument('--scalar', action='store_true', help='trace each ray separately instead of using batches')
+    parser.add_argument('--output', help='name of the JSON file for results')
+    parser.add_argument('--compare', help='name of a JSON file with previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression')
+    arguments = parser.parse_args(arguments)
+
+    def log(result):
+        print('{:20} {:>10} {:3} processes {:8.2f} s {:12.0f} rays/s {:8.1f} MB  efficiency {:.2f}'.format(
+            result['scene'], '{}x{}'.format(*result['image_size']), result['processes'], result['wall_time'],
+            result['rays_per_second'], result['peak_rss'] / 2**20, result['scaling_efficiency']))
+
+    results = run_benchmarks(arguments.scenes, arguments.sizes, arguments.processes, not arguments.scalar, log)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            regressions = compare_results(json.load(file), results, arguments.tolerance)
+        for (scene_name, image_size, processes, _), old, new in regressions:
+            print('Regression: {} {}x{} {} processes: {:.0f} -> {:.0f} rays/s ({:+.0%})'.format(
+                scene_name, *image_size, processes, old, new, new / old - 1))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+Contains a render cache, which stores rendered images, so that identical renders are not repeated.
+
+Images are identified by keys: SHA-256 hashes of everything that affects a rendered image. Contents
+of the scene are packed the same way as in scene files (see SceneFiles module), so equal scenes give
+equal keys, no matter how their objects were created. Lighting models of the scene, parameters of
+the camera (including anti-aliasing) and the image size are a part of a key as well. Scalar and batch
+renders give the same images, so the batch argument is not a part of a key; neither is the tile size
+(images, including anti-aliased ones, do not depend on tiles). Scenes that cannot be packed (e.g. scenes
+with custom objects or compiled scenes) are rendered without caching.
+
+The cache has two tiers. Recently used images are kept in memory (as raw RGB data), and all cached
+images can also be stored as PNG files in a directory, which can be shared by many processes and
+kept between runs of a program. Both tiers have size limits: when a tier is full, least recently used
+images are removed from it (on disk, the modification time of a file is its last use). Images found
+on disk are copied to memory.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from raytracer.Compilation import CompiledScene
+from raytracer.SceneFiles import pack_scene
+
+_CACHE_VERSION = 2
+
+
+class RenderCache:
+    """
+    Represents a cache of rendered images with a memory tier and an optional disk tier.
+
+    Counters of hits (memory_hits, disk_hits), misses and uncacheable renders can be read for monitoring
+    (see counters). All methods can be called from many threads at once.
+    """
+    def __init__(self, memory_size=256*2**20, directory=None, disk_size=4*2**30):
+        """
+        :param memory_size: maximal total size (in bytes) of images kept in memory
+        :param directory: directory of the disk tier (if None, images are cached only in memory)
+        :param disk_size: maximal total size (in bytes) of image files in the directory
+        """
+        self.memory_size = memory_size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            entries = [entry for entry in os.scandir(directory) if entry.name.endswith('.png')]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self._disk[entry.name[:-4]] = entry.stat().st_size
+                self._disk_used += entry.stat().st_size
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def counters(self):
+        """
+        Returns counters of the cache as a dictionary (e.g. to export them to a monitoring system).
+        """
+        with self._lock:
+            return {'hits': self.hits, 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'uncacheable': self.uncacheable, 'memory_images': len(self._memory),
+                    'memory_bytes': self._memory_used, 'disk_images': len(self._disk), 'disk_bytes': self._disk_used}
+
+    def render_image(self, scene, camera, image_size=(128, 72), file_name=None, batch=False, tile_size=(64, 64),
+                     processes=None):
+        """
+        Returns a cached image of a scene or renders it (see Camera.render_image) and adds it to the cache.
+
+        Cached images are returned without starting worker processes.
+        :param scene: scene to render
+        :param camera: camera used to render the image
+        :param image_size: image size as a tuple (width, height)
+        :param file_name: name of the output file (if None, no file will be generated)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :return: generated image as PIL Image object
+        """
+        try:
+            key = get_render_key(scene, camera, image_size)
+        except ValueError:
+            key = None
+            with self._lock:
+                self.uncacheable += 1
+        image = self.get(key) if key is not None else None
+        if image is None:
+            image = camera.render_image(scene, image_size, None, batch, tile_size, processes)
+            if key is not None:
+                self.put(key, image)
+        if file_name:
+            image.save(file_name)
+        return image
+
+    def get(self, key):
+        """
+        Finds an image in the cache (and marks it as recently used).
+        :param key: key of the image (see get_render_key)
+        :return: PIL Image object or None, if there is no such image in the cache
+        """
+        with self._lock:
+            memory_entry = self._memory.get(key)
+            if memory_entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+        if memory_entry is not None:
+            image_size, data = memory_entry
+            return Image.frombytes('RGB', image_size, data)
+        # files are read without holding the lock, so that other threads are not blocked by disk access
+        image, file_size = self._load_image(key)
+        data = image.tobytes() if image is not None else None
+        with self._lock:
+            self._update_disk(key, file_size)
+            if image is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store_in_memory(key, image.size, data)
+        return image
+
+    def put(self, key, image):
+        """
+        Adds an image to the cache (removing least recently used images, if the cache is full).
+        :param key: key of the image (see get_render_key)
+        :param image: PIL Image object (RGB)
+        """
+        data = image.tobytes()
+        with self._lock:
+            self._store_in_memory(key, image.size, data)
+        if self.directory is None:
+            return
+        file_name = self._get_file_name(key)
+        temporary_file_name = '{}.{}.{}.tmp'.format(file_name, os.getpid(), threading.get_ident())
+        image.save(temporary_file_name, format='PNG')
+        # other processes using the directory never see incomplete files
+        os.replace(temporary_file_name, file_name)
+        file_size = os.path.getsize(file_name)
+        evicted_keys = []
+        with self._lock:
+            self._update_disk(key, file_size)
+            while self._disk_used > self.disk_size:
+                evicted_key, size = self._disk.popitem(last=False)
+                self._disk_used -= size
+                evicted_keys.append(evicted_key)
+        for evicted_key in evicted_keys:
+            try:
+                os.remove(self._get_file_name(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def _store_in_memory(self, key, image_size, data):
+        self._memory_used -= len(self._memory.pop(key, (None, b''))[1])
+        if len(data) > self.memory_size:
+            return
+        self._memory[key] = image_size, data
+        self._memory_used += len(data)
+        while self._memory_used > self.memory_size:
+            self._memory_used -= len(self._memory.popitem(last=False)[1][1])
+
+    def _update_disk(self, key, file_size):
+        """
+        Records the size of an image file as its most recent use (or removes the record, if size is None).
+        """
+        self._disk_used -= self._disk.pop(key, 0)
+        if file_size is not None:
+            self._disk[key] = file_size
+            self._disk_used += file_size
+
+    def _load_image(self, key):
+        """
+        Loads an image from the disk tier (files added by other processes are found as well).
+        :return: a tuple of (PIL Image object, file size) or (None, None), if there is no such file
+        """
+        if self.directory is None:
+            return None, None
+        file_name = self._get_file_name(key)
+        try:
+            with Image.open(file_name) as image:
+                image = image.convert('RGB')
+            os.utime(file_name)
+            return image, os.path.getsize(file_name)
+        except OSError:
+            # the file was removed (e.g. by another process or by eviction in another thread) or it is damaged
+            return None, None
+
+    def _get_file_name(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+
+def get_render_key(scene, camera, image_size):
+    """
+    Calculates a key of a render: a hash of the scene contents, the camera and the render settings.
+    :param scene: Scene object
+    :param camera: camera used to render the image
+    :param image_size: image size as a tuple (width, height)
+    :return: hexadecimal digest
+    :raises ValueError: if the scene cannot be packed (see SceneFiles.pack_scene) or if it is compiled
+    """
+    if isinstance(scene, CompiledScene):
+        raise ValueError('Compiled scenes cannot be packed')
+    header, arrays = pack_scene(scene, camera)
+    settings = {'version': _CACHE_VERSION, 'scene': header, 'image_size': [int(size) for size in image_size],
+                'lighting_model': _get_name(scene.lighting_model),
+                'batch_lighting_model': _get_name(scene.batch_lighting_model)}
+    if camera.antialiasing is not None:
+        sampler = camera.antialiasing
+        settings['antialiasing'] = [_get_name(type(sampler)), repr(sorted(vars(sampler).items()))]
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update('{} {} {}'.format(name, array.dtype.str, array.shape).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _get_name(obj):
+    return '{}.{}'.format(obj.__module__, obj.__qualname__)
@@ -1,9 +1,18 @@
+import itertools
+import os
+import time
 from functools import partial
 from multiprocessing.pool import Pool
 import numpy as np
 import math
 from PIL import Image
-from multiprocessing import Manager
+from raytracer import Tracing, Vectors
+from raytracer.Framebuffer import SharedFramebuffer, Tile, get_tiles, order_tiles
+from raytracer.Relighting import GBuffer
+from raytracer.Statistics import RenderStats
+
+# Maximal number of tiles whose costs are estimated by one task (see Camera._schedule_tiles).
+_ESTIMATE_CHUNK_SIZE = 256
 
 
 class Camera:
@@ -14,14 +23,17 @@ class Camera:
     That is why the camera is not one of normal scene objects. Instead, it is a separate object
     that can create an image of a scene, but is not rendered itself.
     """
-    def __init__(self, position=(4, 4, 4), look_at=(0, 0, 0), up=(0, 1, 0), horizontal_angle=45):
+    def __init__(self, position=(4, 4, 4), look_at=(0, 0, 0), up=(0, 1, 0), horizontal_angle=45, antialiasing=None):
         """
         :param position: position of the camera (eye)
         :param look_at: point that the camera is looking at
         :param up: vector representing the 'up' direction (might not be normalized)
         :param horizontal_angle: horizontal angle of view in degrees
+        :param antialiasing: sampler used for anti-aliasing (e.g. AdaptiveSampler from Sampling module),
+        if None, one ray is traced through the center of each pixel
         """
         self.position = np.array(position)
+        self.antialiasing = antialiasing
         self.up = np.array(up)
 
         front = look_at - self.position
@@ -32,43 +44,293 @@ class Camera:
         self.up = up / np.linalg.norm(up)
         self.image_plane_width = 2*(math.tan(math.radians(horizontal_angle/2)))
 
-    def render_image(self, scene, image_size=(128, 72), file_name='image.png'):
+    def render_image(self, scene, image_size=(128, 72), file_name='image.png', batch=False, tile_size=(64, 64),
+                     processes=None, stats=None, tile_costs=None, region=None):
         """
         Creates an image of a scene.
 
-        Uses multiprocessing to improve performance. For big scenes or big images
-        the computation time can be long. By default this method creates a png file
-        with rendered image.
+        Uses multiprocessing to improve performance. The image is split into tiles, which are
+        rendered by worker processes straight into a framebuffer stored in shared memory.
+        For big scenes or big images the computation time can be long. By default this method
+        creates a png file with rendered image.
+        If a region is given, only pixels of this rectangle are traced (a crop window), and they are the same
+        as the pixels of the whole image (also with anti-aliasing).
         :param scene: scene to render
         :param image_size: image size as a tuple (width, height)
         :param file_name: name of the output file (if None, no file will be generated)
-        :return: generated image as PIL Image object
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :param stats: RenderStats object (see Statistics module), if given, statistics of the render
+        collected by all worker processes are added to it (this makes rendering slightly slower)
+        :param tile_costs: expected rendering costs of tiles (see render_framebuffer)
+        :param region: rendered rectangle of the image as a tuple (left, top, right, bottom) in pixels
+        (if None, the whole image is rendered)
+        :return: generated image as PIL Image object (of the size of the region, if it is given)
         """
-        m = Manager()
-        rendered_pixels = m.list(range(np.prod(image_size)))
-        pool = Pool()
-        pixel_color = partial(self.calculate_pixel_color, image_size=image_size, scene=scene, pixels=rendered_pixels)
-        pool.map(pixel_color, ((x, y) for (x, y) in np.ndindex(image_size)))
+        region = _get_region(image_size, region)
+        framebuffer = SharedFramebuffer((region.right - region.left, region.bottom - region.top))
+        try:
+            self.render_framebuffer(scene, framebuffer, batch, tile_size, processes, stats, tile_costs, image_size,
+                                    region)
+            rendered_image = framebuffer.to_image()
+        finally:
+            framebuffer.unlink()
 
-        rendered_image = Image.new('RGB', image_size)
-        rendered_image.putdata(rendered_pixels)
         if file_name:
             rendered_image.save(file_name)
         return rendered_image
 
-    def calculate_pixel_color(self, pixel_coordinates, image_size, scene, pixels):
+    def render_framebuffer(self, scene, framebuffer, batch=False, tile_size=(64, 64), processes=None, stats=None,
+                           tile_costs=None, image_size=None, region=None):
+        """
+        Renders an image of a scene into a framebuffer (see Framebuffer module).
+
+        Tiles are rendered by worker processes and written straight into the framebuffer, so with
+        a MemmapFramebuffer even images bigger than the available memory can be rendered.
+        Expensive tiles are rendered first (see Framebuffer.order_tiles), so that all workers stay busy
+        until the end of the render. Costs of tiles are estimated by a low-resolution pre-pass (traced by
+        the workers in chunks of tiles), unless they are given (e.g. rendering times of tiles of the previous
+        frame of an animation) or there are no more tiles than workers.
+        :param scene: scene to render
+        :param framebuffer: framebuffer of the image (its size is the image size)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :param stats: RenderStats object (see Statistics module), if given, statistics of the render
+        collected by all worker processes are added to it (this makes rendering slightly slower)
+        :param tile_costs: dictionary {tile: expected cost} (e.g. tile_times of RenderStats of a previous render),
+        if None, costs are estimated
+        :param image_size: size of the whole image as a tuple (width, height) (if None, the framebuffer size is used)
+        :param region: rendered rectangle of the image as a tuple (left, top, right, bottom) in pixels
+        (the framebuffer must have its size), if None, the whole image is rendered
+        """
+        image_size = framebuffer.image_size if image_size is None else image_size
+        region = _get_region(image_size, region)
+        if tuple(framebuffer.image_size) != (region.right - region.left, region.bottom - region.top):
+            raise ValueError('Framebuffer size does not match the rendered region')
+        scene.prepare()
+        with Pool(processes) as pool:
+            tiles = self._schedule_tiles(pool, processes, scene, image_size, tile_size, tile_costs, region)
+            render_tile = partial(_render_tile, camera=self, image_size=image_size, scene=scene,
+                                  framebuffer=framebuffer, batch=batch, collect_stats=stats is not None,
+                                  region=region)
+            tile_stats = pool.map(render_tile, tiles, chunksize=1)
+
+        if stats is not None:
+            for single_tile_stats in tile_stats:
+                stats.merge(single_tile_stats)
+
+    def render_tiles(self, scene, image_size=(128, 72), tile_size=(64, 64), batch=False, processes=None,
+                     tile_costs=None):
         """
-        Calculates a color of one pixel on image plane and puts it in a pixel list.
-        :param pixel_coordinates: pixel coordinates as a tuple (x, y)
+        Renders an image of a scene tile by tile.
+
+        This is a generator, which yields tiles as soon as they are finished (in order of completion,
+        not in order of their position). Tiles can be passed straight to an output sink (see Output module),
+        so the image does not have to be kept in memory. Closing the generator (e.g. breaking a loop over it)
+        cancels the render and stops all worker processes.
+        :param scene: scene to render
         :param image_size: image size as a tuple (width, height)
+        :param tile_size: maximal size of a tile, as a tuple (width, height)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :param tile_costs: expected rendering costs of tiles (see render_framebuffer)
+        :return: generator of tuples (tile, colors), where colors is a numpy array of shape
+        (tile height, tile width, 3) with 8-bit unsigned values
+        """
+        scene.prepare()
+        with Pool(processes) as pool:
+            tiles = self._schedule_tiles(pool, processes, scene, image_size, tile_size, tile_costs)
+            tile_pixels = partial(_calculate_tile_pixels, camera=self, image_size=image_size, scene=scene,
+                                  batch=batch)
+            yield from pool.imap_unordered(tile_pixels, tiles)
+
+    def render_progressive(self, scene, image_size=(128, 72), steps=(4, 2, 1), batch=False, tile_size=(64, 64),
+                           processes=None):
+        """
+        Renders an image of a scene in passes of increasing resolution (e.g. for quick previews).
+
+        This is a generator, which yields an image after each pass. A pass with step s traces every s-th pixel
+        in each direction (the default steps trace 1/16, then 1/4 and then all pixels), and pixels that were not
+        traced yet are filled with the colors of the nearest traced pixels above and to the left. Pixels traced
+        by previous passes are not traced again, so all passes trace as many rays as one render of the image,
+        and the last image is the same as an image rendered by render_image. If the camera uses anti-aliasing,
+        the previews are not anti-aliased, and the last pass renders the whole image again using the sampler.
+        Costs of tiles are estimated only for the first pass, tiles of the next passes are ordered by rendering
+        times of the previous pass. Closing the generator cancels the render and stops all worker processes.
         :param scene: scene to render
-        :param pixels: a list of pixels, row by row, starting at top left corner, as tuples of 3 colors (R, G, B);
+        :param image_size: image size as a tuple (width, height)
+        :param steps: steps of the passes in decreasing order (each step must be a multiple of the next one,
+        the last step should be 1)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task in the last pass, as a tuple (width, height)
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :return: generator of PIL Image objects
         """
-        x, y = pixel_coordinates
+        if min(steps) < 1 or any(previous_step % step for previous_step, step in zip(steps, steps[1:])):
+            raise ValueError('Each step must be a multiple of the next one')
         width, height = image_size
-        pixel_vector = self.get_pixel_vector(x, y, width, height)
-        color = scene.trace_ray(self.position, pixel_vector)
-        pixels[y * width + x] = color
+        pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        scene.prepare()
+        with Pool(processes) as pool:
+            previous_step = None
+            tile_times = {}
+            for step in steps:
+                # tiles of sparse passes are bigger, so that each task traces a similar number of rays
+                pass_tile_size = (tile_size[0] * step, tile_size[1] * step)
+                tile_costs = None
+                if tile_times:
+                    tile_costs = _get_pass_tile_costs(tile_times, get_tiles(image_size, pass_tile_size))
+                tiles = self._schedule_tiles(pool, processes, scene, image_size, pass_tile_size, tile_costs)
+                tile_times = {}
+                if step == 1 and self.antialiasing:
+                    results = pool.imap_unordered(partial(_calculate_tile_pixels, camera=self, image_size=image_size,
+                                                          scene=scene, batch=batch), tiles)
+                    for tile, colors in results:
+                        pixels[tile.top:tile.bottom, tile.left:tile.right] = colors
+                else:
+                    results = pool.imap_unordered(partial(_calculate_pass_pixels, camera=self, image_size=image_size,
+                                                          scene=scene, batch=batch, step=step,
+                                                          previous_step=previous_step), tiles)
+                    for tile, colors, tile_time in results:
+                        x, y = _get_pass_pixels(tile, step, previous_step)
+                        pixels[y, x] = colors
+                        tile_times[tile] = tile_time
+                previous_step = step
+                preview = np.repeat(np.repeat(pixels[::step, ::step], step, axis=0), step, axis=1)
+                yield Image.fromarray(preview[:height, :width])
+
+    def estimate_tile_costs(self, scene, image_size, tiles, samples=(4, 4)):
+        """
+        Estimates rendering costs of tiles by tracing a few rays through each of them (a low-resolution pre-pass).
+
+        Only collisions of the rays and their reflections are found (lighting is not calculated), and the cost
+        of a pixel is estimated as 1 plus the number of collisions of its rays.
+        :param scene: prepared scene
+        :param image_size: image size as a tuple (width, height)
+        :param tiles: list of tiles
+        :param samples: maximal number of rays traced through a tile in each direction, as a tuple (x, y)
+        :return: list of estimated costs (in pixel units)
+        """
+        x, y, sample_counts = [], [], []
+        for tile in tiles:
+            columns, rows = min(samples[0], tile.right - tile.left), min(samples[1], tile.bottom - tile.top)
+            tile_x, tile_y = np.meshgrid(tile.left + (np.arange(columns) + 0.5) * (tile.right - tile.left) / columns,
+                                         tile.top + (np.arange(rows) + 0.5) * (tile.bottom - tile.top) / rows)
+            x.append(tile_x.ravel())
+            y.append(tile_y.ravel())
+            sample_counts.append(columns * rows)
+        vectors = self.get_image_plane_vectors(np.concatenate(x), np.concatenate(y), *image_size)
+        collision_counts = Tracing.count_collisions(scene, self.position, vectors, scene.max_recursion_level)
+        sample_costs = np.split(1 + collision_counts, np.cumsum(sample_counts)[:-1])
+        return [float(np.mean(costs)) * (tile.right - tile.left) * (tile.bottom - tile.top)
+                for tile, costs in zip(tiles, sample_costs)]
+
+    def _schedule_tiles(self, pool, processes, scene, image_size, tile_size, tile_costs, region=None):
+        """
+        Orders tiles of an image (or of its region) for rendering (see render_framebuffer).
+
+        Costs of tiles are estimated by workers of the pool, in chunks of at most _ESTIMATE_CHUNK_SIZE tiles,
+        so that memory used by the estimate does not depend on the image size. If there are no more tiles
+        than workers, all tiles are rendered at once, so costs are not estimated.
+        :param pool: pool of worker processes
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :return: list of tiles
+        """
+        tiles = get_tiles(image_size, tile_size, region)
+        worker_count = processes or os.cpu_count() or 1
+        if tile_costs is None and len(tiles) > worker_count:
+            chunk_size = min(_ESTIMATE_CHUNK_SIZE, -(-len(tiles) // worker_count))
+            chunks = [tiles[start:start + chunk_size] for start in range(0, len(tiles), chunk_size)]
+            estimate = partial(_estimate_tile_costs, camera=self, image_size=image_size, scene=scene)
+            tile_costs = dict(zip(tiles, itertools.chain.from_iterable(pool.map(estimate, chunks, chunksize=1))))
+        return order_tiles(tiles, tile_costs)
+
+    def render_gbuffer(self, scene, image_size=(128, 72)):
+        """
+        Traces primary rays of an image and stores their collisions in a G-buffer.
+
+        The G-buffer can be relit many times after changing lights of the scene (see Relighting module),
+        which is much faster than rendering the whole image again. One ray is traced through the center
+        of each pixel (anti-aliasing is not used).
+        :param scene: scene to render
+        :param image_size: image size as a tuple (width, height)
+        :return: GBuffer object
+        """
+        scene.prepare()
+        width, height = image_size
+        y, x = np.mgrid[0:height, 0:width]
+        directions = self.get_pixel_vectors(x.ravel(), y.ravel(), width, height)
+        distances, normals, materials = scene.check_collisions(self.position, directions, scene.near, scene.far)
+        hits = distances < np.inf
+        points = self.position + directions[hits]*distances[hits, np.newaxis]
+        return GBuffer(image_size, directions, hits, points, normals[hits], materials[hits])
+
+    def render_tile(self, tile, image_size, scene, framebuffer, batch=False, region=None):
+        """
+        Renders one tile of an image and writes it into a framebuffer.
+        :param tile: tile to render
+        :param image_size: image size as a tuple (width, height)
+        :param scene: scene to render
+        :param framebuffer: framebuffer of the whole image
+        :param batch: if True, all pixels of the tile are traced at once using numpy arrays
+        :param region: if given (as a Tile), the framebuffer contains only this region of the image
+        """
+        colors = self.calculate_tile_colors(tile, image_size, scene, batch)
+        if region is not None:
+            tile = Tile(tile.left - region.left, tile.top - region.top, tile.right - region.left,
+                        tile.bottom - region.top)
+        framebuffer.write_tile(tile, colors)
+
+    def calculate_tile_colors(self, tile, image_size, scene, batch=False):
+        """
+        Calculates colors of all pixels in one tile of the image plane.
+        :param tile: tile to render
+        :param image_size: image size as a tuple (width, height)
+        :param scene: scene to render
+        :param batch: if True, all pixels of the tile are traced at once using numpy arrays
+        :return: colors of the pixels as a numpy array of shape (tile height, tile width, 3)
+        """
+        if self.antialiasing:
+            colors, _ = self.antialiasing.sample_tile(self, tile, image_size, scene, batch)
+            return colors
+        y, x = np.mgrid[tile.top:tile.bottom, tile.left:tile.right]
+        return np.reshape(self.calculate_pixel_colors(x.ravel(), y.ravel(), image_size, scene, batch), x.shape + (3,))
+
+    def calculate_pixel_colors(self, x, y, image_size, scene, batch=False):
+        """
+        Calculates colors of pixels by tracing one ray through the center of each of them (without anti-aliasing).
+        :param x: x indices of the pixels as a numpy array
+        :param y: y indices of the pixels as a numpy array
+        :param image_size: image size as a tuple (width, height)
+        :param scene: scene to render
+        :param batch: if True, all rays are traced at once using numpy arrays
+        :return: colors as a numpy array of shape (N, 3)
+        """
+        width, height = image_size
+        if batch:
+            return scene.trace_rays(self.position, self.get_pixel_vectors(x, y, width, height))
+        return np.reshape([scene.trace_ray(self.position, self.get_pixel_vector(px, py, width, height))
+                           for px, py in zip(x, y)], (len(x), 3))
+
+    def trace_image_plane_points(self, x, y, image_size, scene, batch=False):
+        """
+        Calculates colors of rays passing through given points of the image plane.
+
+        Points are given in pixel units: (0, 0) is the left top corner of the image and (width, height)
+        is its right bottom corner, so the center of the pixel (x, y) is (x + 0.5, y + 0.5).
+        :param x: x coordinates of the points as a numpy array
+        :param y: y coordinates of the points as a numpy array
+        :param image_size: image size as a tuple (width, height)
+        :param scene: scene to render
+        :param batch: if True, all rays are traced at once using numpy arrays
+        :return: colors as a numpy array of shape (N, 3)
+        """
+        vectors = self.get_image_plane_vectors(x, y, *image_size)
+        if batch:
+            return scene.trace_rays(self.position, vectors)
+        return np.reshape([scene.trace_ray(self.position, vector) for vector in vectors], (len(vectors), 3))
 
     def get_pixel_vector(self, x, y, width, height):
         """
@@ -87,3 +349,128 @@ class Camera:
         pixel_vector = self.front + self.right*pixel_pos_x + self.up*-pixel_pos_y
         pixel_vector /= np.linalg.norm(pixel_vector)
         return pixel_vector
+
+    def get_pixel_vectors(self, x, y, width, height):
+        """
+        Creates vectors pointing from camera's position to many pixels on image plane.
+
+        This is a counterpart of get_pixel_vector that operates on numpy arrays.
+        :param x: x indices of pixels as a numpy array
+        :param y: y indices of pixels as a numpy array
+        :param width: width of an image
+        :param height: height of an image
+        :return: normalized vectors as a numpy array of shape (N, 3)
+        """
+        return self.get_image_plane_vectors(x + 0.5, y + 0.5, width, height)
+
+    def get_image_plane_vectors(self, x, y, width, height):
+        """
+        Creates vectors pointing from camera's position to many points on image plane.
+
+        Points are given in pixel units (see trace_image_plane_points).
+        :param x: x coordinates of points as a numpy array
+        :param y: y coordinates of points as a numpy array
+        :param width: width of an image
+        :param height: height of an image
+        :return: normalized vectors as a numpy array of shape (N, 3)
+        """
+        image_plane_height = height * self.image_plane_width / width
+        pixel_pos_x = (x / width) * self.image_plane_width - 0.5*self.image_plane_width
+        pixel_pos_y = (y / height) * image_plane_height - 0.5*image_plane_height
+        pixel_vectors = self.front + self.right*pixel_pos_x[:, np.newaxis] + self.up*-pixel_pos_y[:, np.newaxis]
+        return Vectors.normalize(pixel_vectors)
+
+
+def _render_tile(tile, camera, image_size, scene, framebuffer, batch, collect_stats=False, region=None):
+    """
+    Renders one tile in a worker process.
+
+    The framebuffer is a copy attached to the framebuffer of the image (e.g. to shared memory),
+    so it is detached when the tile is ready.
+    :return: RenderStats object with statistics of the tile (if collect_stats is True) or None
+    """
+    try:
+        if not collect_stats:
+            camera.render_tile(tile, image_size, scene, framebuffer, batch, region)
+            return None
+        stats = RenderStats()
+        instrumented_scene = stats.instrument(scene)
+        stats.measure_tile(tile, lambda: camera.render_tile(tile, image_size, instrumented_scene, framebuffer, batch,
+                                                            region))
+        return stats
+    finally:
+        framebuffer.close()
+
+
+def _estimate_tile_costs(tiles, camera, image_size, scene):
+    """
+    Estimates rendering costs of a chunk of tiles in a worker process (see Camera.estimate_tile_costs).
+    """
+    return camera.estimate_tile_costs(scene, image_size, tiles)
+
+
+def _get_pass_tile_costs(tile_times, tiles):
+    """
+    Calculates expected costs of tiles of a pass of progressive rendering from rendering times of tiles
+    of the previous pass. Each tile lies inside one tile of the previous pass (tiles of both passes start
+    at multiples of their sizes), and its cost is a part of the time of that tile proportional to its area.
+    :param tile_times: dictionary {tile of the previous pass: rendering time}
+    :param tiles: tiles of the pass
+    :return: dictionary {tile: expected cost}
+    """
+    previous_tile = next(iter(tile_times))
+    width, height = previous_tile.right - previous_tile.left, previous_tile.bottom - previous_tile.top
+    previous_tiles = {(tile.left, tile.top): tile for tile in tile_times}
+    tile_costs = {}
+    for tile in tiles:
+        previous_tile = previous_tiles[tile.left - tile.left % width, tile.top - tile.top % height]
+        area = (tile.right - tile.left) * (tile.bottom - tile.top)
+        previous_area = (previous_tile.right - previous_tile.left) * (previous_tile.bottom - previous_tile.top)
+        tile_costs[tile] = tile_times[previous_tile] * area / previous_area
+    return tile_costs
+
+
+def _get_pass_pixels(tile, step, previous_step):
+    """
+    Lists pixels of a tile traced by a pass of progressive rendering (see Camera.render_progressive).
+    :return: a tuple of (x indices, y indices) of the pixels as numpy arrays
+    """
+    y, x = np.mgrid[tile.top:tile.bottom, tile.left:tile.right]
+    traced = (x % step == 0) & (y % step == 0)
+    if previous_step is not None:
+        traced &= (x % previous_step != 0) | (y % previous_step != 0)
+    return x[traced], y[traced]
+
+
+def _calculate_pass_pixels(tile, camera, image_size, scene, batch, step, previous_step):
+    """
+    Calculates colors of pixels of one tile traced by a pass of progressive rendering in a worker process.
+    :return: a tuple of (tile, colors as 8-bit unsigned values, rendering time)
+    """
+    start = time.perf_counter()
+    x, y = _get_pass_pixels(tile, step, previous_step)
+    colors = camera.calculate_pixel_colors(x, y, image_size, scene, batch) if len(x) else np.zeros((0, 3))
+    return tile, np.clip(colors, 0, 255).astype(np.uint8), time.perf_counter() - start
+
+
+def _calculate_tile_pixels(tile, camera, image_size, scene, batch):
+    """
+    Calculates colors of one tile in a worker process.
+    :return: a tuple of (tile, colors as 8-bit unsigned values)
+    """
+    colors = camera.calculate_tile_colors(tile, image_size, scene, batch)
+    return tile, np.clip(colors, 0, 255).astype(np.uint8)
+
+
+def _get_region(image_size, region):
+    """
+    Checks a rendered region of an image.
+    :return: Tile object (the whole image, if the region is None)
+    """
+    width, height = image_size
+    if region is None:
+        return Tile(0, 0, width, height)
+    region = Tile(*(int(value) for value in region))
+    if not (0 <= region.left < region.right <= width and 0 <= region.top < region.bottom <= height):
+        raise ValueError('Region {} is outside of the image'.format(tuple(region)))
+    return region
@@ -0,0 +1,356 @@
+"""
+Contains compiled scenes.
+
+A compiled scene is a frozen copy of a scene, in which objects, materials and lights are stored
+in packed numpy arrays (one array per parameter) instead of lists of Python objects. Spheres, planes
+and circles are tested for collisions many at once, and the whole scene is cheap to copy to worker
+processes. Objects of other types (e.g. triangle meshes) are kept as they are and use their own methods.
+
+A compiled scene implements the same methods as a prepared scene, so it can be rendered by a camera,
+and it renders the same images. Tracing rays always uses the batch lighting model of the scene
+(single rays are traced as batches of one ray). A compiled scene does not change when the original
+scene is modified; it has to be compiled again.
+"""
+import numpy as np
+from raytracer import Tracing, Vectors
+from raytracer.Acceleration import BoundingVolumeHierarchy
+from raytracer.Lights import LightTable
+from raytracer.Materials import MaterialTable
+from raytracer.Objects import BatchCollisionResult, CollisionResult, Sphere, Plane, Circle
+
+SPHERE, PLANE, CIRCLE, OTHER = range(4)
+
+# Objects are tested many at once, so bigger leaves of the hierarchy are cheaper than deeper traversal.
+_MAX_LEAF_SIZE = 16
+
+
+class CompiledScene:
+    """
+    Represents a scene compiled into packed arrays.
+
+    Each object of the original scene is identified by its index in the scene objects list. Arrays kind
+    and slot describe the type of each object and its index in arrays of that type (e.g. sphere_center).
+    Materials of objects are stored as indices of the material table (circles have two materials:
+    front and back, other objects have as many as their materials tuple).
+    """
+    def __init__(self, scene):
+        """
+        :param scene: scene to compile
+        """
+        objects = scene.objects
+        self.background_color = scene.background_color
+        self.max_recursion_level = scene.max_recursion_level
+        self.reflection_threshold = scene.reflection_threshold
+        self.russian_roulette_weight = scene.russian_roulette_weight
+        self.near = scene.near
+        self.far = scene.far
+        self.batch_lighting_model = scene.batch_lighting_model
+        self.light_table = LightTable(scene.lights)
+
+        # materials shared by many objects are stored in the table only once
+        material_indices = {}
+        object_materials = []
+        for obj in objects:
+            object_materials.append(np.array([material_indices.setdefault(id(material), len(material_indices))
+                                              for material in obj.materials], dtype=np.int32))
+        unique_materials = {id(material): material for obj in objects for material in obj.materials}
+        self.material_table = MaterialTable(unique_materials[key] for key in material_indices)
+
+        self.kind = np.array([_get_kind(obj) for obj in objects], dtype=np.int8)
+        self.slot = np.zeros(len(objects), dtype=np.int32)
+        for kind in (SPHERE, PLANE, CIRCLE, OTHER):
+            self.slot[self.kind == kind] = np.arange(np.count_nonzero(self.kind == kind))
+
+        def select(kind):
+            selected = [index for index, obj_kind in enumerate(self.kind) if obj_kind == kind]
+            return [objects[index] for index in selected], [object_materials[index] for index in selected]
+
+        spheres, materials = select(SPHERE)
+        self.sphere_material = np.array([indices[0] for indices in materials], dtype=np.int32)
+        self.sphere_center = np.array([sphere.center for sphere in spheres], dtype=float).reshape(-1, 3)
+        self.sphere_radius = np.array([abs(sphere.radius) for sphere in spheres], dtype=float)
+        self.sphere_radius_squared = np.array([sphere.radius**2 for sphere in spheres], dtype=float)
+
+        planes, materials = select(PLANE)
+        self.plane_material = np.array([indices[0] for indices in materials], dtype=np.int32)
+        self.plane_position = np.array([plane.position for plane in planes], dtype=float).reshape(-1, 3)
+        self.plane_normal = np.array([plane.normal for plane in planes], dtype=float).reshape(-1, 3)
+
+        circles, materials = select(CIRCLE)
+        self.circle_material = np.array(materials, dtype=np.int32).reshape(-1, 2)
+        self.circle_center = np.array([circle.front_plane.position for circle in circles], dtype=float).reshape(-1, 3)
+        self.circle_normal = np.array([circle.front_plane.normal for circle in circles], dtype=float).reshape(-1, 3)
+        self.circle_radius = np.array([circle.radius for circle in circles], dtype=float)
+
+        self.other_objects, self.other_materials = select(OTHER)
+
+        self.hierarchy = None
+        self.unbounded_objects = np.arange(len(objects))
+        boxes = [self._get_bounding_box(index, obj) for index, obj in enumerate(objects)]
+        bounded_objects = np.array([index for index, box in enumerate(boxes) if box is not None], dtype=int)
+        if len(bounded_objects):
+            lower, upper = zip(*(boxes[index] for index in bounded_objects))
+            hierarchy = BoundingVolumeHierarchy(lower, upper, _MAX_LEAF_SIZE)
+            if hierarchy.node_count[0] == 0:
+                # leaves of the hierarchy refer to scene objects directly
+                hierarchy.primitives = bounded_objects[hierarchy.primitives].astype(np.int32)
+                self.hierarchy = hierarchy
+                self.unbounded_objects = np.array([index for index, box in enumerate(boxes) if box is None],
+                                                  dtype=int)
+
+    def prepare(self):
+        """
+        Does nothing (a compiled scene is always ready for rendering).
+        """
+
+    def refresh_lighting(self):
+        """
+        Reads parameters of the lights again (e.g. before relighting an image).
+
+        Only lights changed in place (e.g. a sun with a new direction) are updated. Materials and the list
+        of lights are a part of the compiled scene, so the scene has to be compiled again after they change.
+        """
+        self.light_table = LightTable(self.light_table.lights)
+
+    def compile(self):
+        return self
+
+    def get_material_table(self):
+        return self.material_table
+
+    def get_light_table(self):
+        return self.light_table
+
+    def check_collision(self, eye, direction, near=None, far=None):
+        """
+        Checks if a ray collides with any object (see Scene.check_collision).
+        """
+        eye, direction = np.asarray(eye, dtype=float), np.asarray(direction, dtype=float)
+        distances, normals, materials = self.check_collisions(eye, np.reshape(direction, (1, 3)), near, far)
+        if distances[0] == np.inf:
+            return None
+        return CollisionResult(eye + direction*distances[0], normals[0], self.material_table.materials[materials[0]],
+                               distances[0])
+
+    def check_occlusion(self, eye, direction, near=None, far=None, cache_key=None):
+        """
+        Checks if a ray is blocked by any object (see Scene.check_occlusion, cache_key is ignored).
+        """
+        return bool(self.check_occlusions(np.asarray(eye, dtype=float), np.reshape(direction, (1, 3)), near, far)[0])
+
+    def trace_ray(self, eye, direction, recursion_level=None):
+        """
+        Traces a ray of light through the scene and returns its color (see Scene.trace_ray).
+        """
+        return tuple(int(c) for c in self._trace_rays(eye, np.reshape(direction, (1, 3)), recursion_level)[0])
+
+    def check_collisions(self, eyes, directions, near=None, far=None):
+        """
+        Checks if many rays collide with any object (see Scene.check_collisions).
+        """
+        if near is None:
+            near = self.near
+        if far is None:
+            far = self.far
+        distances = np.full(len(directions), np.inf)
+        normals = np.zeros((len(directions), 3))
+        materials = np.full(len(directions), -1)
+        far = np.minimum(far, distances)
+
+        def intersect_objects(rays, objects):
+            result = self._find_collisions(Vectors.select(eyes, rays, 1), directions[rays],
+                                           Vectors.select(near, rays), far[rays], objects)
+            closer = result.distance < distances[rays]
+            closer_rays = rays[closer]
+            distances[closer_rays] = far[closer_rays] = result.distance[closer]
+            normals[closer_rays] = result.normal[closer]
+            materials[closer_rays] = result.material[closer]
+
+        if len(self.unbounded_objects):
+            intersect_objects(np.arange(len(directions)), self.unbounded_objects)
+        if self.hierarchy:
+            self.hierarchy.intersect_packet(eyes, directions, near, far, intersect_objects)
+        return BatchCollisionResult(distances, normals, materials)
+
+    def check_occlusions(self, eyes, directions, near=None, far=None):
+        """
+        Checks if many rays are blocked by any object (see Scene.check_occlusions).
+        """
+        if near is None:
+            near = self.near
+        if far is None:
+            far = self.far
+        far = np.array(np.broadcast_to(far, len(directions)), dtype=float)
+
+        def occlude_objects(rays, objects):
+            occluded = self._find_occlusions(Vectors.select(eyes, rays, 1), directions[rays],
+                                             Vectors.select(near, rays), far[rays], objects)
+            far[rays[occluded]] = -np.inf
+
+        if len(self.unbounded_objects):
+            occlude_objects(np.arange(len(directions)), self.unbounded_objects)
+        if self.hierarchy:
+            self.hierarchy.intersect_packet(eyes, directions, near, far, occlude_objects)
+        return far == -np.inf
+
+    def trace_rays(self, eyes, directions, recursion_level=None):
+        """
+        Traces many rays of light through the scene and returns their colors (see Scene.trace_rays).
+        """
+        return self._trace_rays(eyes, directions, recursion_level)
+
+    def shade_rays(self, eyes, directions, recursion_level):
+        """
+        Calculates colors of the first collisions of many rays (see Scene.shade_rays).
+        """
+        return Tracing.shade_rays(self, eyes, directions, recursion_level)
+
+    def _trace_rays(self, eyes, directions, recursion_level):
+        if recursion_level is None:
+            recursion_level = self.max_recursion_level
+        return Tracing.trace_rays(self, eyes, directions, recursion_level)
+
+    def _find_collisions(self, eyes, directions, near, far, objects):
+        """
+        Finds the closest collisions of rays with given objects.
+
+        If a ray collides with more than one object at the same distance, the object that is earlier
+        in the scene objects list is chosen (the same way as in Scene.check_collisions).
+        :param objects: indices of objects
+        :return: a tuple of (distances, normals, material indices), like Scene.check_collisions
+        """
+        objects = np.sort(objects)
+        kinds, slots = self.kind[objects], self.slot[objects]
+        all_distances = np.full((len(directions), len(objects)), np.inf)
+        other_results = {}
+        for kind, get_distances in ((SPHERE, self._get_sphere_distances), (PLANE, self._get_plane_distances),
+                                    (CIRCLE, self._get_circle_distances)):
+            columns = np.flatnonzero(kinds == kind)
+            if len(columns):
+                all_distances[:, columns] = get_distances(eyes, directions, _as_column(near), _as_column(far),
+                                                          slots[columns])
+        for column in np.flatnonzero(kinds == OTHER):
+            result = self.other_objects[slots[column]].check_collisions(eyes, directions, near, far)
+            all_distances[:, column] = result.distance
+            other_results[column] = result
+
+        closest = np.argmin(all_distances, axis=1)
+        distances = all_distances[np.arange(len(directions)), closest]
+        normals = np.zeros((len(directions), 3))
+        materials = np.full(len(directions), -1)
+        hits = np.flatnonzero(distances < np.inf)
+        hit_kinds, hit_slots = kinds[closest[hits]], slots[closest[hits]]
+
+        rays, slot = hits[hit_kinds == SPHERE], hit_slots[hit_kinds == SPHERE]
+        if len(rays):
+            points = Vectors.select(eyes, rays, 1) + directions[rays]*distances[rays, np.newaxis]
+            normals[rays] = Vectors.normalize(points - self.sphere_center[slot])
+            materials[rays] = self.sphere_material[slot]
+
+        rays, slot = hits[hit_kinds == PLANE], hit_slots[hit_kinds == PLANE]
+        normals[rays] = self.plane_normal[slot]
+        materials[rays] = self.plane_material[slot]
+
+        rays, slot = hits[hit_kinds == CIRCLE], hit_slots[hit_kinds == CIRCLE]
+        if len(rays):
+            normal = self.circle_normal[slot]
+            front = Vectors.dot(directions[rays], normal) < 0
+            normals[rays] = np.where(front[:, np.newaxis], normal, -normal)
+            materials[rays] = self.circle_material[slot, np.where(front, 0, 1)]
+
+        for column, result in other_results.items():
+            rays = hits[closest[hits] == column]
+            normals[rays] = result.normal[rays]
+            materials[rays] = self.other_materials[slots[column]][result.material[rays]]
+        return BatchCollisionResult(distances, normals, materials)
+
+    def _find_occlusions(self, eyes, directions, near, far, objects):
+        """
+        Checks if rays collide with any of given objects.
+        :param objects: indices of objects
+        :return: numpy array of boolean values
+        """
+        kinds, slots = self.kind[objects], self.slot[objects]
+        occluded = np.zeros(len(directions), dtype=bool)
+        for kind, get_distances in ((SPHERE, self._get_sphere_distances), (PLANE, self._get_plane_distances),
+                                    (CIRCLE, self._get_circle_distances)):
+            selected_slots = slots[kinds == kind]
+            if len(selected_slots):
+                distances = get_distances(eyes, directions, _as_column(near), _as_column(far), selected_slots)
+                occluded |= np.any(distances < np.inf, axis=1)
+        for slot in slots[kinds == OTHER]:
+            rays = np.flatnonzero(~occluded)
+            if not len(rays):
+                break
+            occluded[rays] = self.other_objects[slot].check_occlusions(
+                Vectors.select(eyes, rays, 1), directions[rays], Vectors.select(near, rays), Vectors.select(far, rays))
+        return occluded
+
+    def _get_sphere_distances(self, eyes, directions, near, far, slots):
+        """
+        Calculates distances along rays to spheres (the same way as Sphere.check_collisions).
+        :return: numpy array of shape (number of rays, number of spheres)
+        """
+        to_eye = eyes[..., np.newaxis, :] - self.sphere_center[slots]
+        directions = directions[:, np.newaxis, :]
+        a = Vectors.dot(directions, directions)
+        b = 2*Vectors.dot(to_eye, directions)
+        c = Vectors.dot(to_eye, to_eye) - self.sphere_radius_squared[slots]
+        delta = b**2 - 4*a*c
+        hits = delta >= 0
+        sqrt_delta = np.sqrt(np.where(hits, delta, 0))
+        distance1 = (-b - sqrt_delta) / (2*a)
+        distance2 = (-b + sqrt_delta) / (2*a)
+        distances = np.where((near <= distance2) & (distance2 <= far), distance2, np.inf)
+        distances = np.where((near <= distance1) & (distance1 <= far), distance1, distances)
+        distances[~hits | (distances == 0)] = np.inf
+        return distances
+
+    def _get_plane_distances(self, eyes, directions, near, far, slots):
+        """
+        Calculates distances along rays to planes (the same way as Plane.check_collisions).
+        :return: numpy array of shape (number of rays, number of planes)
+        """
+        return _get_plane_distances(eyes, directions, near, far, self.plane_position[slots], self.plane_normal[slots])
+
+    def _get_circle_distances(self, eyes, directions, near, far, slots):
+        """
+        Calculates distances along rays to circles (the same way as Circle.check_collisions).
+        :return: numpy array of shape (number of rays, number of circles)
+        """
+        centers = self.circle_center[slots]
+        distances = _get_plane_distances(eyes, directions, near, far, centers, self.circle_normal[slots])
+        hits = distances < np.inf
+        points = eyes[..., np.newaxis, :] + directions[:, np.newaxis, :]*np.where(hits, distances, 0)[..., np.newaxis]
+        distances[hits & (Vectors.norm(centers - points) > self.circle_radius[slots])] = np.inf
+        return distances
+
+    def _get_bounding_box(self, index, obj):
+        kind, slot = self.kind[index], self.slot[index]
+        if kind == SPHERE:
+            center, radius = self.sphere_center[slot], self.sphere_radius[slot]
+            return center - radius, center + radius
+        elif kind == CIRCLE:
+            return obj.get_bounding_box()
+        elif kind == OTHER and hasattr(obj, 'get_bounding_box'):
+            return obj.get_bounding_box()
+        return None
+
+
+def _get_kind(obj):
+    # subclasses might override methods, so only exact types are packed
+    return {Sphere: SPHERE, Plane: PLANE, Circle: CIRCLE}.get(type(obj), OTHER)
+
+
+def _as_column(values):
+    """
+    Converts values of rays to a column, so that they can be broadcast against values of many objects.
+    """
+    return np.reshape(values, (-1, 1)) if np.ndim(values) else np.reshape(values, (1, 1))
+
+
+def _get_plane_distances(eyes, directions, near, far, positions, normals):
+    d = Vectors.dot(directions[:, np.newaxis, :], normals)
+    hits = d != 0
+    distances = Vectors.dot(normals, positions - eyes[..., np.newaxis, :]) / np.where(hits, d, 1)
+    return np.where(hits & (near <= distances) & (distances <= far), distances, np.inf)
@@ -0,0 +1,271 @@
+"""
+Contains tools for rendering images on many machines.
+
+Each machine runs one or more render workers, which listen on TCP ports:
+
+    python -m raytracer.Distributed --host 0.0.0.0 --port 6000 --authkey secret
+
+A coordinator connects to all workers, sends the scene once to each of them and then hands out tiles
+on demand: a worker gets a new tile as soon as it returns the previous one. Tiles of workers that fail
+(disconnect, report an error or do not answer within a timeout) are given to other workers.
+
+Messages are pickled objects preceded by their length. They are sent only after both sides of
+a connection prove that they know a shared key (authkey) by signing random challenges with it,
+but workers should still be reachable only from a trusted network.
+"""
+import argparse
+import hmac
+import os
+import pickle
+import socket
+import struct
+import sys
+import threading
+import traceback
+from collections import deque
+import numpy as np
+from PIL import Image
+from raytracer.Camera import _calculate_tile_pixels
+from raytracer.Framebuffer import get_tiles
+
+_HANDSHAKE_TIMEOUT = 10
+_HEADER = struct.Struct('!Q')
+
+
+class RenderWorker:
+    """
+    Represents a worker that renders tiles for coordinators connecting to it.
+    """
+    def __init__(self, address=('localhost', 6000), authkey=b'', timeout=600):
+        """
+        :param address: address to listen on, as a tuple (host, port) (if port is 0, a free port is chosen)
+        :param authkey: key used to authenticate coordinators (non-empty bytes)
+        :param timeout: maximal time (in seconds) of waiting for the next request of a coordinator, after which
+        its connection is closed (so that a coordinator that died without closing it does not block the worker)
+        """
+        if not authkey:
+            raise ValueError('Authkey must not be empty')
+        self.server_socket = socket.create_server(address)
+        self.address = self.server_socket.getsockname()[:2]
+        self.authkey = authkey
+        self.timeout = timeout
+
+    def serve_forever(self):
+        """
+        Handles connections of coordinators one by one, until the process is stopped.
+        """
+        while True:
+            connection, _ = self.server_socket.accept()
+            with connection:
+                try:
+                    connection.settimeout(_HANDSHAKE_TIMEOUT)
+                    _authenticate(connection, self.authkey, b'worker', b'coordinator')
+                    connection.settimeout(self.timeout)
+                except (OSError, EOFError):
+                    continue
+                self.handle(connection)
+
+    def handle(self, connection):
+        """
+        Handles requests sent through one connection, until it is closed or no request comes within the timeout.
+
+        Requests are tuples: ('scene', pickled scene) sets the rendered scene and
+        ('tile', camera, tile, image_size, batch) renders a tile of it. The answer to a tile request
+        is ('tile', tile, colors) or ('error', message).
+        """
+        scene = None
+        while True:
+            try:
+                request = _receive(connection)
+            except (OSError, EOFError):
+                return
+            try:
+                if request[0] == 'scene':
+                    scene = pickle.loads(request[1])
+                    scene.prepare()
+                    continue
+                _, camera, tile, image_size, batch = request
+                answer = ('tile',) + _calculate_tile_pixels(tile, camera, image_size, scene, batch)
+            except Exception:
+                answer = ('error', traceback.format_exc())
+            try:
+                _send(connection, answer)
+            except OSError:
+                return
+
+    def close(self):
+        self.server_socket.close()
+
+
+class RenderCoordinator:
+    """
+    Represents a coordinator that renders images using remote workers.
+    """
+    def __init__(self, addresses, authkey=b'', timeout=60):
+        """
+        :param addresses: addresses of workers, as a list of tuples (host, port)
+        :param authkey: key used to authenticate with workers (non-empty bytes)
+        :param timeout: maximal time (in seconds) of connecting to a worker, sending the scene to it or rendering
+        one tile, after which the worker is no longer used in this render (and its tile is given to another worker)
+        """
+        if not authkey:
+            raise ValueError('Authkey must not be empty')
+        self.addresses = addresses
+        self.authkey = authkey
+        self.timeout = timeout
+        self.errors = []
+
+    def render_image(self, scene, camera, image_size=(128, 72), file_name=None, batch=False, tile_size=(64, 64)):
+        """
+        Creates an image of a scene using the workers (see Camera.render_image).
+
+        Errors of workers that failed during the render are stored in the errors list.
+        :param scene: scene to render
+        :param camera: camera used to render the image
+        :param image_size: image size as a tuple (width, height)
+        :param file_name: name of the output file (if None, no file will be generated)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :return: generated image as PIL Image object
+        """
+        job = _Job(get_tiles(image_size, tile_size), image_size)
+        self.errors = []
+        scene_data = pickle.dumps(scene, protocol=pickle.HIGHEST_PROTOCOL)
+        threads = [threading.Thread(target=self._serve_worker, args=(address, job, scene_data, camera, batch))
+                   for address in self.addresses]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if job.pending:
+            raise RuntimeError('All workers failed, {} tiles not rendered:\n{}'.format(
+                len(job.pending), '\n'.join(self.errors)))
+
+        rendered_image = Image.fromarray(job.pixels)
+        if file_name:
+            rendered_image.save(file_name)
+        return rendered_image
+
+    def _serve_worker(self, address, job, scene_data, camera, batch):
+        """
+        Sends tiles to one worker until all tiles are rendered or the worker fails.
+        """
+        tile = None
+        try:
+            with socket.create_connection(address, self.timeout) as connection:
+                _authenticate(connection, self.authkey, b'coordinator', b'worker')
+                _send(connection, ('scene', scene_data))
+                while True:
+                    tile = job.take_tile()
+                    if tile is None:
+                        return
+                    _send(connection, ('tile', camera, tile, job.image_size, batch))
+                    answer = _receive(connection)
+                    if answer[0] == 'error':
+                        raise RuntimeError(answer[1])
+                    job.finish_tile(tile, answer[2])
+                    tile = None
+        except Exception as error:
+            self.errors.append('{}: {!r}'.format(address, error))
+            if tile is not None:
+                job.return_tile(tile)
+
+
+class _Job:
+    """
+    Represents tiles of one render shared by threads communicating with workers.
+    """
+    def __init__(self, tiles, image_size):
+        width, height = image_size
+        self.image_size = image_size
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        self.pending = deque(tiles)
+        self.in_progress = set()
+        self.condition = threading.Condition()
+
+    def take_tile(self):
+        """
+        Returns a tile to render or None, if all tiles are rendered.
+
+        If there are no pending tiles, but some tiles are still rendered by other workers, waits
+        until they are finished (or returned by failed workers).
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending or not self.in_progress)
+            if not self.pending:
+                return None
+            tile = self.pending.popleft()
+            self.in_progress.add(tile)
+            return tile
+
+    def finish_tile(self, tile, colors):
+        with self.condition:
+            self.pixels[tile.top:tile.bottom, tile.left:tile.right] = colors
+            self.in_progress.discard(tile)
+            self.condition.notify_all()
+
+    def return_tile(self, tile):
+        with self.condition:
+            self.in_progress.discard(tile)
+            self.pending.append(tile)
+            self.condition.notify_all()
+
+
+def _send(connection, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    connection.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _receive(connection):
+    size, = _HEADER.unpack(_receive_bytes(connection, _HEADER.size))
+    return pickle.loads(_receive_bytes(connection, size))
+
+
+def _receive_bytes(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 2**20))
+        if not chunk:
+            raise EOFError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def _authenticate(connection, authkey, role, peer_role):
+    """
+    Checks that the other side of a connection knows the authkey (and proves that this side knows it too).
+
+    Each side signs a random challenge of the other side together with its own role, so a signature
+    cannot be reflected back to the side that requested it.
+    """
+    challenge = os.urandom(32)
+    connection.sendall(challenge)
+    peer_challenge = _receive_bytes(connection, len(challenge))
+    connection.sendall(hmac.new(authkey, role + peer_challenge, 'sha256').digest())
+    expected_signature = hmac.new(authkey, peer_role + challenge, 'sha256').digest()
+    if not hmac.compare_digest(_receive_bytes(connection, len(expected_signature)), expected_signature):
+        raise ConnectionRefusedError('Authentication failed')
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Runs a worker rendering tiles for remote coordinators.')
+    parser.add_argument('--host', default='localhost', help='host to listen on (default: localhost)')
+    parser.add_argument('--port', type=int, default=6000, help='port to listen on (default: 6000)')
+    parser.add_argument('--authkey', required=True, help='key shared with coordinators')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds of waiting for the next request of a coordinator (default: 600)')
+    arguments = parser.parse_args(arguments)
+
+    worker = RenderWorker((arguments.host, arguments.port), arguments.authkey.encode(), arguments.timeout)
+    print('Listening on {}:{}'.format(*worker.address))
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
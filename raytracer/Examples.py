@@ -1,9 +1,10 @@
 """
 Contains functions for rendering sample scenes.
 
-Each function by default generates a png file with a size of 128x72 pixels.
+Each render function by default generates a png file with a size of 128x72 pixels.
 These functions are meant to give a sample of the possible effects available
-in this ray tracer.
+in this ray tracer. Scenes and cameras used by them can also be created separately
+(e.g. for benchmarks).
 """
 import time
 
@@ -15,7 +16,7 @@ from raytracer.Objects import Sphere, Plane, Circle
 from raytracer.Lights import Ambient, Sun, Point
 
 
-def render_water_molecule(image_size=(128, 72), file_name='image.png'):
+def create_water_molecule_scene():
     scene = Scene()
     scene.objects.append(Sphere((0, 0, 0), 0.5, ORANGE_GLOSSY))
     scene.objects.append(Sphere((0.124, 0.484, 0), 0.3, BLUE_GLOSSY))
@@ -25,13 +26,18 @@ def render_water_molecule(image_size=(128, 72), file_name='image.png'):
     scene.lights.append(Ambient())
 
     camera = Camera((0, 0.4, 4), (0, 0, 0))
+    return scene, camera
+
+
+def render_water_molecule(image_size=(128, 72), file_name='image.png'):
+    scene, camera = create_water_molecule_scene()
     t_start = time.time()
     print("Start")
     camera.render_image(scene, image_size, file_name)
     print("Finished", time.time() - t_start)
 
 
-def render_reflecting_sphere(image_size=(128, 72), file_name='image.png'):
+def create_reflecting_sphere_scene():
     scene = Scene()
     scene.objects.append(Sphere((0, 0, 0), 0.5, MIRROR_GLOSSY))
     scene.objects.append(Sphere((1, 0, 0), 0.3, GREEN_GLOSSY))
@@ -41,13 +47,18 @@ def render_reflecting_sphere(image_size=(128, 72), file_name='image.png'):
     scene.lights.append(Ambient())
 
     camera = Camera((0, 0.6, 4), (0, 0, 0))
+    return scene, camera
+
+
+def render_reflecting_sphere(image_size=(128, 72), file_name='image.png'):
+    scene, camera = create_reflecting_sphere_scene()
     t_start = time.time()
     print("Start")
     camera.render_image(scene, image_size, file_name)
     print("Finished", time.time() - t_start)
 
 
-def render_infinity_mirror(image_size=(128, 72), file_name='image.png'):
+def create_infinity_mirror_scene():
     scene = Scene()
     scene.max_recursion_level = 7
     scene.objects.append(Sphere((0, 0, 0), 0.25, PURPLE_GLOSSY))
@@ -60,6 +71,11 @@ def render_infinity_mirror(image_size=(128, 72), file_name='image.png'):
     scene.lights.append(Ambient())
 
     camera = Camera((3, 0.4, 0), (0, 0, 0))
+    return scene, camera
+
+
+def render_infinity_mirror(image_size=(128, 72), file_name='image.png'):
+    scene, camera = create_infinity_mirror_scene()
     t_start = time.time()
     print("Start")
     camera.render_image(scene, image_size, file_name)
@@ -0,0 +1,86 @@
+"""
+Contains functions for reading and writing binary files with packed numpy arrays.
+
+Each file starts with a file type identifier (8 bytes), followed by the length of a header
+(8 bytes, little endian) and the header itself, which is a UTF-8 encoded JSON object.
+The header contains an entry "arrays" describing all arrays stored in the file
+(their data types, shapes and offsets from the beginning of the file). Arrays are stored
+after the header in C order, each of them aligned to 64 bytes. Because of that, arrays can be
+memory-mapped instead of being read, which makes loading big files instant and allows many
+processes to share the same data.
+"""
+import json
+import os
+import struct
+import numpy as np
+
+_ALIGNMENT = 64
+
+
+def save_arrays(file_name, file_type, header, arrays):
+    """
+    Saves numpy arrays to a binary file.
+    :param file_name: name of the output file
+    :param file_type: file type identifier (8 bytes)
+    :param header: dictionary with additional information (must be serializable to JSON)
+    :param arrays: dictionary of numpy arrays to save
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    descriptions = {}
+    header = dict(header, arrays=descriptions)
+    # offsets depend on the header length, so the header is encoded until its length is stable
+    header_length = 0
+    while True:
+        offset = _align(16 + header_length)
+        for name, array in arrays.items():
+            descriptions[name] = {'dtype': array.dtype.newbyteorder('<').str, 'shape': list(array.shape),
+                                  'offset': offset}
+            offset = _align(offset + array.nbytes)
+        encoded_header = json.dumps(header).encode('utf-8')
+        if len(encoded_header) == header_length:
+            break
+        header_length = len(encoded_header)
+
+    with open(file_name, 'wb') as file:
+        file.write(file_type)
+        file.write(struct.pack('<Q', header_length))
+        file.write(encoded_header)
+        for name, array in arrays.items():
+            file.write(b'\0' * (descriptions[name]['offset'] - file.tell()))
+            file.write(array.astype(descriptions[name]['dtype'], copy=False).tobytes())
+
+
+def load_arrays(file_name, file_type, mmap_mode='r'):
+    """
+    Loads numpy arrays from a binary file.
+    :param file_name: name of the input file
+    :param file_type: expected file type identifier (8 bytes)
+    :param mmap_mode: mode of memory-mapping arrays (see numpy.memmap), if None, arrays are read into memory
+    :return: a tuple of (header, dictionary of arrays)
+    :raises ValueError: if the file is not a valid file of given type
+    """
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as file:
+        if file.read(8) != file_type:
+            raise ValueError('{} is not a {} file'.format(file_name, file_type.rstrip(b'\0').decode()))
+        header_length, = struct.unpack('<Q', file.read(8))
+        try:
+            header = json.loads(file.read(header_length).decode('utf-8'))
+            descriptions = header.pop('arrays')
+        except (ValueError, KeyError):
+            raise ValueError('{} has an invalid header'.format(file_name))
+
+    arrays = {}
+    for name, description in descriptions.items():
+        dtype, shape, offset = np.dtype(description['dtype']), tuple(description['shape']), description['offset']
+        if offset < 16 + header_length or offset + dtype.itemsize * int(np.prod(shape)) > file_size:
+            raise ValueError('{} is truncated or corrupted (array {})'.format(file_name, name))
+        if mmap_mode is not None and np.prod(shape) > 0:
+            arrays[name] = np.memmap(file_name, dtype, mmap_mode, offset, shape)
+        else:
+            arrays[name] = np.fromfile(file_name, dtype, int(np.prod(shape)), offset=offset).reshape(shape)
+    return header, arrays
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
@@ -0,0 +1,220 @@
+"""
+Contains framebuffers (images that are being rendered) and tools for splitting them into tiles.
+
+A tile is a rectangular part of an image. Tiles can be rendered independently of each other,
+so they are used as units of work when an image is rendered by many processes. Idle workers take
+the next tile from a shared queue, so the order of tiles matters: expensive tiles should be started
+first (otherwise one worker might still render an expensive tile when all others are idle), and
+neighbouring tiles should be rendered one after another (see order_tiles).
+
+Each framebuffer implements methods write_tile(tile, colors), to_image(), close() (called by worker
+processes after writing their tiles) and unlink() (called by the process that created the framebuffer,
+when the image is no longer needed).
+"""
+import math
+import os
+from collections import namedtuple
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from PIL import Image
+
+Tile = namedtuple('Tile', 'left top right bottom')
+
+# number of groups of tiles with different costs (see order_tiles)
+_COST_GROUPS = 8
+
+
+def get_tiles(image_size, tile_size, region=None):
+    """
+    Splits an image into tiles.
+
+    Tiles are listed row by row, starting at top left corner. Tiles in the last row and column
+    might be smaller than tile_size.
+    :param image_size: image size as a tuple (width, height)
+    :param tile_size: maximal tile size as a tuple (width, height)
+    :param region: if given (as a Tile), only this part of the image is split (tiles are still aligned
+    to the tiles of the whole image, so tiles at the borders of the region might be smaller)
+    :return: list of tiles
+    """
+    width, height = image_size
+    tile_width, tile_height = tile_size
+    region = Tile(0, 0, width, height) if region is None else region
+    return [Tile(max(left, region.left), max(top, region.top), min(left + tile_width, region.right),
+                 min(top + tile_height, region.bottom))
+            for top in range(region.top - region.top % tile_height, region.bottom, tile_height)
+            for left in range(region.left - region.left % tile_width, region.right, tile_width)]
+
+
+def order_tiles(tiles, tile_costs=None):
+    """
+    Orders tiles for rendering: expensive tiles first, neighbouring tiles one after another.
+
+    Tiles are grouped by their expected cost (each group contains tiles that are up to 2 times cheaper
+    than tiles of the previous group), and tiles in each group are ordered along a Hilbert curve.
+    :param tiles: list of tiles of an image (see get_tiles)
+    :param tile_costs: dictionary {tile: expected cost} (e.g. rendering times of tiles of a previous frame,
+    see RenderStats.tile_times), if None, tiles are ordered only along the curve (tiles without a known
+    cost are treated as the most expensive ones)
+    :return: list of tiles
+    """
+    columns = {left: column for column, left in enumerate(sorted({tile.left for tile in tiles}))}
+    rows = {top: row for row, top in enumerate(sorted({tile.top for tile in tiles}))}
+    curve_size = 1 << max(len(columns), len(rows), 1).bit_length()
+    costs = [(tile_costs or {}).get(tile) for tile in tiles]
+    max_cost = max((cost for cost in costs if cost is not None), default=0)
+
+    def get_group(cost):
+        if cost is None or max_cost <= 0:
+            return 0
+        if cost <= 0:
+            return _COST_GROUPS
+        return min(int(math.log2(max_cost / cost)), _COST_GROUPS - 1)
+
+    keys = [(get_group(cost), _get_hilbert_index(columns[tile.left], rows[tile.top], curve_size))
+            for tile, cost in zip(tiles, costs)]
+    return [tile for _, tile in sorted(zip(keys, tiles), key=lambda item: item[0])]
+
+
+def _get_hilbert_index(x, y, curve_size):
+    """
+    Calculates the position of a cell on a Hilbert curve filling a square grid.
+    :param curve_size: size of the grid (a power of 2, greater than x and y)
+    """
+    index = 0
+    size = curve_size // 2
+    while size > 0:
+        rx, ry = int((x & size) > 0), int((y & size) > 0)
+        index += size * size * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x, y = curve_size - 1 - x, curve_size - 1 - y
+            x, y = y, x
+        size //= 2
+    return index
+
+
+class SharedFramebuffer:
+    """
+    Represents an RGB image stored in shared memory.
+
+    Pixels are available as a numpy array of shape (height, width, 3), which can be written
+    by many processes at once (each of them should write a different part of the image).
+    A framebuffer passed to another process is attached to the same shared memory block
+    instead of being copied. The process that created the framebuffer is responsible for
+    releasing the memory using the unlink method.
+    """
+    def __init__(self, image_size, name=None):
+        """
+        :param image_size: image size as a tuple (width, height)
+        :param name: name of an existing shared memory block (if None, a new block will be created)
+        """
+        width, height = image_size
+        self.image_size = image_size
+        self.shared_memory = SharedMemory(name=name, create=name is None, size=width*height*3)
+        self.pixels = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self.shared_memory.buf)
+
+    def __reduce__(self):
+        return SharedFramebuffer, (self.image_size, self.shared_memory.name)
+
+    def write_tile(self, tile, colors):
+        """
+        Writes colors of a tile into the framebuffer.
+        :param tile: tile to write
+        :param colors: colors of the tile as a numpy array of shape (tile height, tile width, 3)
+        (values outside of range 0 - 255 will be clipped)
+        """
+        self.pixels[tile.top:tile.bottom, tile.left:tile.right] = np.clip(colors, 0, 255)
+
+    def to_image(self):
+        """
+        Creates a copy of the framebuffer as PIL Image object.
+        """
+        return Image.fromarray(self.pixels)
+
+    def close(self):
+        """
+        Detaches the framebuffer from shared memory (the framebuffer cannot be used afterwards).
+        """
+        self.pixels = None
+        self.shared_memory.close()
+
+    def unlink(self):
+        """
+        Releases shared memory used by the framebuffer (in all processes).
+        """
+        self.close()
+        self.shared_memory.unlink()
+
+
+class MemmapFramebuffer:
+    """
+    Represents an RGB image stored in a file mapped to memory.
+
+    The file contains only pixel values (row by row, starting at top left corner), so an image bigger
+    than the available memory can be rendered: pages of the file are loaded and written back by
+    the operating system as needed. Pixels are stored as 8-bit unsigned values (clipped to range 0 - 255)
+    or as 32-bit floats (HDR, colors are not clipped). A framebuffer passed to another process
+    maps the same file instead of being copied.
+    """
+    def __init__(self, file_name, image_size, dtype=np.uint8, create=True):
+        """
+        :param file_name: name of the file storing pixels
+        :param image_size: image size as a tuple (width, height)
+        :param dtype: type of pixel values: numpy.uint8 or numpy.float32
+        :param create: if True, a new file is created (all pixels are black), otherwise an existing file is used
+        """
+        width, height = image_size
+        self.file_name = file_name
+        self.image_size = image_size
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.uint8, np.float32):
+            raise ValueError('Unsupported pixel type: {}'.format(self.dtype))
+        self.pixels = np.memmap(file_name, self.dtype, 'w+' if create else 'r+', shape=(height, width, 3))
+
+    def __reduce__(self):
+        return MemmapFramebuffer, (self.file_name, self.image_size, self.dtype.str, False)
+
+    def write_tile(self, tile, colors):
+        """
+        Writes colors of a tile into the framebuffer.
+        :param tile: tile to write
+        :param colors: colors of the tile as a numpy array of shape (tile height, tile width, 3)
+        (values outside of range 0 - 255 will be clipped, unless pixels are floats)
+        """
+        if self.dtype == np.uint8:
+            colors = np.clip(colors, 0, 255)
+        self.pixels[tile.top:tile.bottom, tile.left:tile.right] = colors
+
+    def write_to(self, sink, strip_height=64):
+        """
+        Writes the image to an output sink (see Output module) in strips of rows.
+
+        Only one strip is read into memory at once, so memory usage does not depend on the image size.
+        :param sink: output sink (e.g. PngWriter or RawWriter), it is not closed by this method
+        :param strip_height: number of rows written at once
+        """
+        width, height = self.image_size
+        for top in range(0, height, strip_height):
+            bottom = min(top + strip_height, height)
+            sink.write_tile(Tile(0, top, width, bottom), np.clip(self.pixels[top:bottom], 0, 255).astype(np.uint8))
+
+    def to_image(self):
+        """
+        Creates a copy of the framebuffer as PIL Image object (the whole image is loaded into memory).
+        """
+        return Image.fromarray(np.clip(self.pixels, 0, 255).astype(np.uint8))
+
+    def close(self):
+        """
+        Writes changed pixels to the file and unmaps it (the framebuffer cannot be used afterwards).
+        """
+        if self.pixels is not None:
+            self.pixels.flush()
+            self.pixels = None
+
+    def unlink(self):
+        """
+        Closes the framebuffer and removes its file.
+        """
+        self.close()
+        os.remove(self.file_name)
@@ -0,0 +1,332 @@
+"""
+Contains instances: scene objects that reuse the geometry of another object.
+
+An instance refers to a shared object (e.g. a triangle mesh) and places it in the scene using an affine
+transform (a matrix of shape (4, 4) or (3, 4), which transforms points of the object to the scene).
+Many instances of one object share its geometry, so they use little memory, and the object is pickled
+only once when a scene is sent to worker processes.
+
+Rays are transformed into the object space (the space in which the shared object is defined) and tested
+against the object itself. Directions of transformed rays are normalized again, so distances along them
+are scaled back to the scene. Normals are transformed by the inverse transposed matrix. Only the inverse
+transform is needed for that, and instances provide bounding boxes in the scene, so they can be used
+inside any acceleration structure (the shared object can also have its own, like a triangle mesh).
+
+A scene object is a Python object, so scenes with millions of instances should use an instance group:
+all instances of one object stored in numpy arrays, with their own bounding volume hierarchy.
+"""
+import math
+import numpy as np
+from raytracer import Vectors
+from raytracer.Acceleration import BoundingVolumeHierarchy
+from raytracer.Objects import BatchCollisionResult, CollisionResult, get_collision_distance
+from raytracer.Vectors import Vec3
+
+_MAX_LEAF_SIZE = 8
+
+
+class Instance:
+    """
+    Represents an object placed in the scene using an affine transform.
+
+    If a material is given, it replaces all materials of the object.
+    """
+    def __init__(self, obj, transform=None, material=None):
+        """
+        :param obj: shared object (any scene object)
+        :param transform: affine transform from the object space to the scene (see create_transform),
+        if None, the object is not transformed
+        :param material: material of the instance (if None, materials of the object will be used)
+        """
+        self.object = obj
+        self.transform = _get_affine_matrices(np.eye(4) if transform is None else transform)
+        self.inverse_transform = _invert_affine_matrices(self.transform)
+        self.material = material
+        self.materials = obj.materials if material is None else (material,)
+
+    def get_bounding_box(self):
+        box = self.object.get_bounding_box() if hasattr(self.object, 'get_bounding_box') else None
+        if box is None:
+            return None
+        return _transform_box(self.transform, *box)
+
+    def check_collision(self, eye, direction, near, far):
+        return _check_collision(self.object, self.inverse_transform.tolist(), self.material,
+                                eye, direction, near, far)
+
+    def check_occlusion(self, eye, direction, near, far):
+        object_eye, object_direction, scale = _transform_ray(self.inverse_transform.tolist(), eye, direction)
+        return self.object.check_occlusion(object_eye, object_direction, near*scale, far*scale)
+
+    def check_collisions(self, eyes, directions, near, far):
+        object_eyes, object_directions, scales = _transform_rays(self.inverse_transform, eyes, directions)
+        result = self.object.check_collisions(object_eyes, object_directions, near*scales, far*scales)
+        distances = result.distance / scales
+        normals = np.zeros((len(directions), 3))
+        hits = distances < np.inf
+        if np.any(hits):
+            normals[hits] = _transform_normals(self.inverse_transform, result.normal[hits])
+        materials = result.material if self.material is None else np.zeros(len(directions), dtype=int)
+        return BatchCollisionResult(distances, normals, materials)
+
+    def check_occlusions(self, eyes, directions, near, far):
+        object_eyes, object_directions, scales = _transform_rays(self.inverse_transform, eyes, directions)
+        return self.object.check_occlusions(object_eyes, object_directions, near*scales, far*scales)
+
+
+class InstanceGroup:
+    """
+    Represents many instances of one object, stored in numpy arrays.
+
+    Only inverse transforms of instances are kept (and indices of their materials, if they are given),
+    so a million instances use about a hundred megabytes. The object must have a bounding box. Instances
+    are stored in the order of the group's bounding volume hierarchy (so they might be reordered
+    in relation to given transforms).
+    """
+    def __init__(self, obj, transforms, materials=None):
+        """
+        :param obj: shared object (any scene object with a bounding box)
+        :param transforms: affine transforms of instances as an array of shape (N, 4, 4) or (N, 3, 4)
+        :param materials: materials of instances as a sequence of N materials (None for instances that use
+        materials of the object), if None, all instances use materials of the object
+        :raises ValueError: if there are no transforms, a transform cannot be inverted or the object is unbounded
+        """
+        box = obj.get_bounding_box() if hasattr(obj, 'get_bounding_box') else None
+        if box is None:
+            raise ValueError('Only objects with bounding boxes can be instanced in groups')
+        transforms = _get_affine_matrices(transforms).reshape(-1, 3, 4)
+        if not len(transforms):
+            raise ValueError('An instance group needs at least one transform')
+        self.object = obj
+        self.materials = tuple(obj.materials)
+        self.material_indices = None
+        if materials is not None:
+            # materials of instances are numbered after the materials of the object
+            indices = {}
+            self.material_indices = np.array([-1 if material is None else indices.setdefault(
+                id(material), len(self.materials) + len(indices)) for material in materials], dtype=np.int32)
+            instance_materials = {id(material): material for material in materials if material is not None}
+            self.materials += tuple(instance_materials[key] for key in indices)
+            if len(self.material_indices) != len(transforms):
+                raise ValueError('Numbers of transforms and materials do not match')
+        self.hierarchy = BoundingVolumeHierarchy(*_transform_box(transforms, *box), _MAX_LEAF_SIZE)
+        self.inverse_transforms = _invert_affine_matrices(transforms[self.hierarchy.primitives])
+        if self.material_indices is not None:
+            self.material_indices = self.material_indices[self.hierarchy.primitives]
+        self.hierarchy.primitives = np.arange(len(transforms))
+
+    def __len__(self):
+        return len(self.inverse_transforms)
+
+    def get_bounding_box(self):
+        return self.hierarchy.node_lower[0], self.hierarchy.node_upper[0]
+
+    def check_collision(self, eye, direction, near, far):
+        closest = None
+
+        def intersect_instances(instances, far):
+            nonlocal closest
+            for instance in instances:
+                result = _check_collision(self.object, self.inverse_transforms[instance].tolist(),
+                                          self._get_material(instance), eye, direction, near, far)
+                if result and result.distance < far:
+                    closest, far = result, result.distance
+            return far
+
+        self.hierarchy.intersect(eye, direction, near, far, intersect_instances)
+        return closest
+
+    def check_occlusion(self, eye, direction, near, far):
+        def occlude_instances(instances, far):
+            for instance in instances:
+                object_eye, object_direction, scale = _transform_ray(self.inverse_transforms[instance].tolist(),
+                                                                     eye, direction)
+                if self.object.check_occlusion(object_eye, object_direction, near*scale, far*scale):
+                    return -np.inf
+            return far
+
+        return self.hierarchy.intersect(eye, direction, near, far, occlude_instances) == -np.inf
+
+    def check_collisions(self, eyes, directions, near, far):
+        distances = np.full(len(directions), np.inf)
+        normals = np.zeros((len(directions), 3))
+        materials = np.zeros(len(directions), dtype=int)
+        far = np.minimum(far, distances)
+
+        def intersect_instances(rays, instances):
+            # every ray is tested against every instance of the leaf by one call of the object
+            pair_rays, pair_instances = np.repeat(rays, len(instances)), np.tile(instances, len(rays))
+            inverse_transforms = self.inverse_transforms[pair_instances]
+            object_eyes, object_directions, scales = _transform_rays(
+                inverse_transforms, Vectors.select(eyes, pair_rays, 1), directions[pair_rays])
+            result = self.object.check_collisions(object_eyes, object_directions,
+                                                  Vectors.select(near, pair_rays)*scales, far[pair_rays]*scales)
+            pair_distances = (result.distance / scales).reshape(len(rays), len(instances))
+            closest = np.argmin(pair_distances, axis=1)
+            closest_distances = pair_distances[np.arange(len(rays)), closest]
+            closer = closest_distances < distances[rays]
+            if not np.any(closer):
+                return
+            closer_rays = rays[closer]
+            pairs = np.flatnonzero(closer)*len(instances) + closest[closer]
+            distances[closer_rays] = far[closer_rays] = closest_distances[closer]
+            normals[closer_rays] = _transform_normals(inverse_transforms[pairs], result.normal[pairs])
+            materials[closer_rays] = result.material[pairs]
+            if self.material_indices is not None:
+                instance_materials = self.material_indices[pair_instances[pairs]]
+                overridden = instance_materials >= 0
+                materials[closer_rays[overridden]] = instance_materials[overridden]
+
+        def intersect_ray(ray, node):
+            def intersect_ray_instances(instances, ray_far):
+                intersect_instances(np.array([ray]), instances)
+                return far[ray]
+            self.hierarchy.intersect(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                     far[ray], intersect_ray_instances, node)
+
+        self.hierarchy.intersect_packet(eyes, directions, near, far, intersect_instances, intersect_ray)
+        return BatchCollisionResult(distances, normals, materials)
+
+    def check_occlusions(self, eyes, directions, near, far):
+        far = np.array(np.broadcast_to(far, len(directions)), dtype=float)
+
+        def occlude_instances(rays, instances):
+            pair_rays, pair_instances = np.repeat(rays, len(instances)), np.tile(instances, len(rays))
+            object_eyes, object_directions, scales = _transform_rays(
+                self.inverse_transforms[pair_instances], Vectors.select(eyes, pair_rays, 1), directions[pair_rays])
+            occluded = self.object.check_occlusions(object_eyes, object_directions,
+                                                    Vectors.select(near, pair_rays)*scales, far[pair_rays]*scales)
+            far[pair_rays[occluded]] = -np.inf
+
+        def occlude_ray(ray, node):
+            def occlude_ray_instances(instances, ray_far):
+                occlude_instances(np.array([ray]), instances)
+                return far[ray]
+            self.hierarchy.intersect(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                     far[ray], occlude_ray_instances, node)
+
+        self.hierarchy.intersect_packet(eyes, directions, near, far, occlude_instances, occlude_ray)
+        return far == -np.inf
+
+    def _get_material(self, instance):
+        """
+        Returns the material that replaces materials of the object for an instance (or None).
+        """
+        if self.material_indices is None or self.material_indices[instance] < 0:
+            return None
+        return self.materials[self.material_indices[instance]]
+
+
+def create_transform(translation=(0, 0, 0), scale=1, axis=(0, 1, 0), angle=0):
+    """
+    Creates an affine transform, which scales an object, rotates it around an axis and then translates it.
+    :param translation: translation vector
+    :param scale: scale factor (a single value or 3 values, one for each axis)
+    :param axis: rotation axis (might not be normalized)
+    :param angle: rotation angle in degrees (counterclockwise, when looking against the axis)
+    :return: numpy array of shape (4, 4)
+    """
+    x, y, z = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    sin, cos = math.sin(math.radians(angle)), math.cos(math.radians(angle))
+    rotation = np.array([[cos + x*x*(1 - cos), x*y*(1 - cos) - z*sin, x*z*(1 - cos) + y*sin],
+                         [y*x*(1 - cos) + z*sin, cos + y*y*(1 - cos), y*z*(1 - cos) - x*sin],
+                         [z*x*(1 - cos) - y*sin, z*y*(1 - cos) + x*sin, cos + z*z*(1 - cos)]])
+    transform = np.eye(4)
+    transform[:3, :3] = rotation * np.broadcast_to(scale, 3)
+    transform[:3, 3] = translation
+    return transform
+
+
+def _get_affine_matrices(transforms):
+    """
+    Converts affine transforms to matrices of shape (3, 4) (the last row of a 4x4 matrix is dropped).
+    """
+    transforms = np.asarray(transforms, dtype=float)
+    if transforms.shape[-2:] not in ((3, 4), (4, 4)):
+        raise ValueError('Transforms must be matrices of shape (4, 4) or (3, 4)')
+    return np.array(transforms[..., :3, :])
+
+
+def _invert_affine_matrices(transforms):
+    """
+    Inverts affine transforms given as matrices of shape (..., 3, 4).
+    """
+    try:
+        linear = np.linalg.inv(transforms[..., :3])
+    except np.linalg.LinAlgError:
+        raise ValueError('Transforms must be invertible') from None
+    translation = -np.einsum('...ij,...j->...i', linear, transforms[..., 3])
+    return np.concatenate((linear, translation[..., np.newaxis]), axis=-1)
+
+
+def _transform_box(transforms, lower, upper):
+    """
+    Calculates axis-aligned boxes containing transformed boxes.
+    :return: a tuple of (minimal corners, maximal corners)
+    """
+    center, extent = (np.asarray(lower) + upper) / 2, (np.asarray(upper) - lower) / 2
+    transformed_center = np.einsum('...ij,j->...i', transforms[..., :3], center) + transforms[..., 3]
+    transformed_extent = np.einsum('...ij,j->...i', np.abs(transforms[..., :3]), extent)
+    return transformed_center - transformed_extent, transformed_center + transformed_extent
+
+
+def _transform_ray(inverse_transform, eye, direction):
+    """
+    Transforms a ray into the object space using scalar calculations (the same way as _transform_rays).
+    :param inverse_transform: inverse transform as nested lists of shape (3, 4)
+    :return: a tuple of (eye, normalized direction, scale), scale is the length of the transformed direction
+    """
+    (ex, ey, ez), (dx, dy, dz) = eye, direction
+    (a, b, c, d), (e, f, g, h), (i, j, k, l) = inverse_transform
+    x, y, z = a*dx + b*dy + c*dz, e*dx + f*dy + g*dz, i*dx + j*dy + k*dz
+    scale = math.sqrt(x*x + y*y + z*z)
+    return (Vec3((a*ex + b*ey + c*ez + d, e*ex + f*ey + g*ez + h, i*ex + j*ey + k*ez + l)),
+            Vec3((x/scale, y/scale, z/scale)), scale)
+
+
+def _transform_rays(inverse_transforms, eyes, directions):
+    """
+    Transforms rays into the object space.
+    :param inverse_transforms: one inverse transform of shape (3, 4) or one for each ray
+    :return: a tuple of (eyes, normalized directions, scales), scales are lengths of transformed directions
+    """
+    object_eyes = _multiply(inverse_transforms, eyes) + inverse_transforms[..., 3]
+    object_directions = _multiply(inverse_transforms, directions)
+    scales = Vectors.norm(object_directions)
+    return object_eyes, object_directions / scales[..., np.newaxis], scales
+
+
+def _transform_normals(inverse_transforms, normals):
+    """
+    Transforms normals from the object space to the scene (using inverse transposed matrices).
+    """
+    return Vectors.normalize(_multiply(np.swapaxes(inverse_transforms[..., :3], -1, -2), normals))
+
+
+def _multiply(matrices, vectors):
+    """
+    Multiplies vectors by matrices (only the first 3 columns are used), adding products in the same order
+    as the scalar calculations.
+    """
+    return np.stack([matrices[..., row, 0]*vectors[..., 0] + matrices[..., row, 1]*vectors[..., 1] +
+                     matrices[..., row, 2]*vectors[..., 2] for row in range(3)], axis=-1)
+
+
+def _check_collision(obj, inverse_transform, material, eye, direction, near, far):
+    """
+    Checks if a ray collides with a transformed object using scalar calculations.
+    :param inverse_transform: inverse transform as nested lists of shape (3, 4)
+    :param material: material replacing materials of the object (or None)
+    """
+    object_eye, object_direction, scale = _transform_ray(inverse_transform, eye, direction)
+    result = obj.check_collision(object_eye, object_direction, near*scale, far*scale)
+    if not result:
+        return None
+    distance = get_collision_distance(object_eye, result) / scale
+    (ex, ey, ez), (dx, dy, dz) = eye, direction
+    (a, b, c, _), (e, f, g, _), (i, j, k, _) = inverse_transform
+    nx, ny, nz = result.normal
+    x, y, z = a*nx + e*ny + i*nz, b*nx + f*ny + j*nz, c*nx + g*ny + k*nz
+    length = math.sqrt(x*x + y*y + z*z)
+    return CollisionResult(Vec3((ex + dx*distance, ey + dy*distance, ez + dz*distance)),
+                           Vec3((x/length, y/length, z/length)), material or result.material, distance)
@@ -5,6 +5,8 @@ All vectors representing directions (normal vectors, ray vectors) passed to the
 functions from this module have to be normalized, unless specified otherwise.
 """
 import numpy as np
+from raytracer import Vectors
+from raytracer.Vectors import Vec3
 
 
 def whitted_lighting_model(scene, ray_direction, collision_result, recursion_level):
@@ -14,54 +16,159 @@ def whitted_lighting_model(scene, ray_direction, collision_result, recursion_lev
     This function calculates a color of a point as a sum of light it receives
     from all light sources on scene. If light source is directed, the diffuse light will
     be calculated using Lambertian reflectance and specular reflection will be added using
-    Phong model. If the material is reflective, a reflected ray will be traced through the scene
-    and its color added to the calculated color.
+    Phong model. Mirror reflections are not included: if the material is reflective, the scene
+    traces a reflected ray and adds its color weighted by the reflection factor (see Tracing module).
     :param scene: scene that is being rendered
     :param ray_direction: direction of a traced light ray
     :param collision_result: a tuple of (collision_point, normal_vector, object_material), cannot be None
     :param recursion_level: current recursion level for reflected rays
     :return: color as a tuple of 3 values (R, G, B), range 0 - 255.
     """
-    collision_point, normal, material = collision_result
-    color = np.array((0, 0, 0))
-    for light in (light for light in scene.lights if light.illuminates(collision_point, scene)):
+    collision_point, normal, material = collision_result[:3]
+    color = (0, 0, 0)
+    light_table = getattr(scene, 'light_table', None)
+    if light_table is not None:
+        lights = (light_table.lights[index] for index in light_table.find_lights(collision_point))
+    else:
+        lights = scene.lights
+    for light in lights:
+        # cheap tests come first: a shadow ray is traced only if the light would change the color
         light_color = light.get_light_intensity_at(collision_point)
+        if not any(light_color):
+            continue
         light_vector = light.get_light_vector_at(collision_point)
         if light_vector is not None:
-            color += _calculate_diffuse_color(light_color, light_vector, material, normal)
-            color += _calculate_specular_color(light_color, light_vector, material, normal, ray_direction)
+            diffuse_color = _calculate_diffuse_color(light_color, light_vector, material, normal)
+            specular_color = _calculate_specular_color(light_color, light_vector, material, normal, ray_direction)
+            if (any(diffuse_color) or any(specular_color)) and light.illuminates(collision_point, scene):
+                color = _add_scalar_color(_add_scalar_color(color, diffuse_color), specular_color)
         else:
-            color += material.color * light_color / 255
-    if material.reflection_factor > 0:
-        reflected_vector = _reflection(ray_direction, normal)
-        reflected_color = scene.trace_ray(collision_point, reflected_vector, recursion_level-1)
-        color += np.array(reflected_color)
-    return tuple(int(c) for c in color)
+            (mr, mg, mb), (lr, lg, lb) = material.color, light_color
+            ambient_color = mr*lr/255, mg*lg/255, mb*lb/255
+            if any(ambient_color) and light.illuminates(collision_point, scene):
+                color = _add_scalar_color(color, ambient_color)
+    return color
+
+
+def batch_whitted_lighting_model(scene, ray_directions, collision_result, recursion_level):
+    """
+    Represents whitted_lighting_model operating on many collision points at once.
+
+    Colors calculated by this function are the same as colors calculated by whitted_lighting_model
+    for each collision point separately.
+    :param scene: scene that is being rendered
+    :param ray_directions: directions of traced light rays as a numpy array of shape (N, 3)
+    :param collision_result: a tuple of (collision_points, normal_vectors, material_indices), where
+    material indices refer to the scene's material table (lights are taken from the scene's light table)
+    :param recursion_level: current recursion level for reflected rays
+    :return: colors as a numpy array of shape (N, 3) with integer values, range 0 - 255.
+    """
+    collision_points, normals, material_indices = collision_result[:3]
+    materials = scene.get_material_table()
+    material_colors = materials.color[material_indices]
+    color = np.zeros((len(collision_points), 3), dtype=int)
+    lights = scene.get_light_table()
+    for light in lights.find_lights_at_points(collision_points):
+        # cheap tests come first: shadow rays are traced only for points whose color the light would change
+        light_color = lights.get_light_intensity_at_points(light, collision_points)
+        candidates = _select_nonzero(light_color.any(axis=1))
+        if candidates is not None:
+            if not len(candidates):
+                continue
+            light_color = light_color[candidates]
+        points = _select(collision_points, candidates)
+        light_vector = lights.get_light_vector_at_points(light, points)
+        if light_vector is not None:
+            normal = _select(normals, candidates)
+            indices = _select(material_indices, candidates)
+            diffuse_coefficient = np.maximum(Vectors.dot(-light_vector, normal), 0)
+            diffuse_color = _select(material_colors, candidates) * (light_color / 255) * \
+                diffuse_coefficient[:, np.newaxis]
+
+            reflected_light_vector = Vectors.reflection(light_vector, normal)
+            specular_coefficient = np.maximum(Vectors.dot(reflected_light_vector, -_select(ray_directions, candidates)),
+                                              0)
+            specular_coefficient **= materials.phong_exponent[indices]
+            specular_color = materials.specular_color[indices] * (light_color / 255)
+            added_colors = (diffuse_color, specular_color * specular_coefficient[:, np.newaxis])
+            # colors are zeros wherever both coefficients are zeros
+            changed = (diffuse_coefficient != 0) | (specular_coefficient != 0)
+        else:
+            added_colors = (_select(material_colors, candidates) * light_color / 255,)
+            changed = added_colors[0].any(axis=1)
+        changed_points = _select_nonzero(changed)
+        illuminated = lights.illuminates_points(light, _select(points, changed_points), scene)
+        if changed_points is not None:
+            illuminated, illuminated_points = np.zeros(len(changed), dtype=bool), illuminated
+            illuminated[changed_points] = illuminated_points
+        if not np.any(illuminated):
+            continue
+        illuminated_indices = np.flatnonzero(illuminated) if candidates is None else candidates[illuminated]
+        illuminated_color = color[illuminated_indices]
+        for added_color in added_colors:
+            _add_color(illuminated_color, added_color[illuminated])
+        color[illuminated_indices] = illuminated_color
+    return color
+
+
+def _select_nonzero(mask):
+    """
+    Finds indices of True values of a mask.
+    :return: numpy array of indices or None, if all values are True
+    """
+    return None if mask.all() else np.flatnonzero(mask)
+
+
+def _select(array, indices):
+    return array if indices is None else array[indices]
+
+
+def _add_color(color, added_color):
+    """
+    Adds a color to an integer numpy array in place.
+
+    The sum is truncated to integer values, so every partial result of lighting calculations is truncated.
+    """
+    np.add(color, added_color, out=color, casting='unsafe')
+
+
+def _add_scalar_color(color, added_color):
+    """
+    Adds a color to an integer color (the counterpart of _add_color for single colors).
+    :return: a tuple of 3 integer values
+    """
+    (r, g, b), (added_r, added_g, added_b) = color, added_color
+    return int(r + added_r), int(g + added_g), int(b + added_b)
 
 
 def _calculate_diffuse_color(light_color, light_vector, material, normal):
     """
     Calculates diffuse light using Lambertian reflectance.
-    :return: numpy array of 3 values, range 0 - 255
+    :return: a tuple of 3 values, range 0 - 255
     """
-    diffuse_coefficient = max(np.dot(-light_vector, normal), 0)
-    diffuse_color = np.multiply(material.color, light_color / 255) * diffuse_coefficient
-    return diffuse_color
+    (lx, ly, lz), (nx, ny, nz) = light_vector, normal
+    diffuse_coefficient = max((-lx)*nx + (-ly)*ny + (-lz)*nz, 0)
+    (mr, mg, mb), (lr, lg, lb) = material.color, light_color
+    return mr*(lr/255)*diffuse_coefficient, mg*(lg/255)*diffuse_coefficient, mb*(lb/255)*diffuse_coefficient
 
 
 def _calculate_specular_color(light_color, light_vector, material, normal, ray_direction):
     """
     Calculates specular light using Phong reflection model.
-    :return: numpy array of 3 values, range 0 - 255
+    :return: a tuple of 3 values, range 0 - 255
     """
-    reflected_light_vector = _reflection(light_vector, normal)
-    specular_coefficient = max(np.dot(reflected_light_vector, -ray_direction), 0)**material.phong_exponent
-    specular_color = np.multiply(material.specular_color, light_color / 255) * specular_coefficient
-    return specular_color
+    rx, ry, rz = _reflection(light_vector, normal)
+    dx, dy, dz = ray_direction
+    specular_coefficient = max(rx*(-dx) + ry*(-dy) + rz*(-dz), 0)**material.phong_exponent
+    (sr, sg, sb), (lr, lg, lb) = material.specular_color, light_color
+    return sr*(lr/255)*specular_coefficient, sg*(lg/255)*specular_coefficient, sb*(lb/255)*specular_coefficient
 
 
 def _reflection(vector, normal):
     """
     Creates a reflection of given vector in relation to given normal.
+    :return: Vec3 object
     """
-    return vector - 2*(np.dot(vector, normal))*normal
+    (vx, vy, vz), (nx, ny, nz) = vector, normal
+    d = 2*(vx*nx + vy*ny + vz*nz)
+    return Vec3((vx - d*nx, vy - d*ny, vz - d*nz))
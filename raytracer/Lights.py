@@ -6,9 +6,33 @@ Each light source must implement 3 methods:
 - get_light_intensity_at(point): returns color of the light at given point ((0, 0, 0) represents no illumination)
 - get_light_vector_at(point): returns normalized light ray direction at given point (might be None)
 
-Values returned by get_light_intensity_at and get_light_vector_at must be numpy arrays with 3 values (range 0 - 255).
+Points are usually Vec3 objects (see Vectors module), but numpy arrays must be accepted as well.
+Values returned by get_light_intensity_at and get_light_vector_at must be sequences of 3 values
+(e.g. Vec3 objects or numpy arrays), light intensity is in range 0 - 255.
+
+Each light source must also implement counterparts of these methods that operate on many points
+at once (points are passed as a numpy array of shape (N, 3)):
+- illuminates_points(points, scene): returns a numpy array of N boolean values
+- get_light_intensity_at_points(points): returns a numpy array of shape (N, 3)
+- get_light_vector_at_points(points): returns a numpy array of shape (N, 3) (might be None)
+
+Lights of a scene can also be packed into a LightTable, which stores parameters of standard
+light sources in numpy arrays. A light table also indexes point lights in a uniform grid, so that
+only lights whose range covers a point are visited when the point is shaded (scenes with thousands
+of small lights, e.g. street lamps, do not pay for lights that are far away).
 """
+import itertools
+import math
 import numpy as np
+from raytracer import Vectors
+from raytracer.Vectors import Vec3
+
+AMBIENT, POINT, SUN, OTHER = range(4)
+
+# point lights whose range covers more grid cells are treated like suns (they are visited everywhere)
+_MAX_LIGHT_CELLS = 64
+# find_lights_at_points does not search the grid, if there are fewer lights
+_MIN_INDEXED_LIGHTS = 8
 
 
 class Point:
@@ -31,22 +55,38 @@ class Point:
         self.max_lighting_distance = max_lighting_distance
 
     def illuminates(self, point, scene):
-        light_vector = self.position - point
-        light_vector_len = np.linalg.norm(light_vector)
-        return not scene.check_collision(point, light_vector / light_vector_len, far=light_vector_len)
+        (px, py, pz), (lx, ly, lz) = point, self.position.tolist()
+        x, y, z = lx - px, ly - py, lz - pz
+        light_vector_len = math.sqrt(x*x + y*y + z*z)
+        return not scene.check_occlusion(point, Vec3((x/light_vector_len, y/light_vector_len, z/light_vector_len)),
+                                         far=light_vector_len, cache_key=self)
 
     def get_light_intensity_at(self, point):
-        distance = np.linalg.norm(point - self.position)
+        (px, py, pz), (lx, ly, lz) = point, self.position.tolist()
+        x, y, z = px - lx, py - ly, pz - lz
+        distance = math.sqrt(x*x + y*y + z*z)
         if distance > self.max_lighting_distance:
-            return np.array((0, 0, 0))
+            return Vec3((0.0, 0.0, 0.0))
         else:
-            factor = ((self.max_lighting_distance - distance) / self.max_lighting_distance)**2
-            return self.color * factor
+            factor = (self.max_lighting_distance - distance) / self.max_lighting_distance
+            factor *= factor
+            r, g, b = self.color.tolist()
+            return Vec3((r*factor, g*factor, b*factor))
 
     def get_light_vector_at(self, point):
-        light_vector = point - self.position
-        light_vector /= np.linalg.norm(light_vector)
-        return light_vector
+        (px, py, pz), (lx, ly, lz) = point, self.position.tolist()
+        x, y, z = px - lx, py - ly, pz - lz
+        length = math.sqrt(x*x + y*y + z*z)
+        return Vec3((x/length, y/length, z/length))
+
+    def illuminates_points(self, points, scene):
+        return _point_illuminates_points(self.position, points, scene)
+
+    def get_light_intensity_at_points(self, points):
+        return _point_light_intensity_at_points(self.color, self.position, self.max_lighting_distance, points)
+
+    def get_light_vector_at_points(self, points):
+        return Vectors.normalize(points - self.position)
 
 
 class Ambient:
@@ -67,11 +107,20 @@ class Ambient:
         return True
 
     def get_light_intensity_at(self, point):
-        return self.color
+        return Vectors.vec3(self.color)
 
     def get_light_vector_at(self, point):
         return None
 
+    def illuminates_points(self, points, scene):
+        return np.ones(len(points), dtype=bool)
+
+    def get_light_intensity_at_points(self, points):
+        return np.broadcast_to(self.color, points.shape)
+
+    def get_light_vector_at_points(self, points):
+        return None
+
 
 class Sun:
     """
@@ -91,10 +140,181 @@ class Sun:
         self.color = np.array(color)
 
     def illuminates(self, point, scene):
-        return not scene.check_collision(point, -self.direction)
+        x, y, z = self.direction.tolist()
+        return not scene.check_occlusion(point, Vec3((-x, -y, -z)), cache_key=self)
 
     def get_light_intensity_at(self, point):
-        return self.color
+        return Vectors.vec3(self.color)
 
     def get_light_vector_at(self, point):
-        return self.direction
+        return Vec3(self.direction.tolist())
+
+    def illuminates_points(self, points, scene):
+        return _sun_illuminates_points(self.direction, points, scene)
+
+    def get_light_intensity_at_points(self, points):
+        return np.broadcast_to(self.color, points.shape)
+
+    def get_light_vector_at_points(self, points):
+        return np.broadcast_to(self.direction, points.shape)
+
+
+class LightTable:
+    """
+    Represents a list of light sources stored as numpy arrays.
+
+    Parameters of point lights, suns and ambient lights are stored in arrays (parameters that
+    do not apply to a light are zeros), which are used by batch lighting models. Other light sources
+    are kept as objects and their methods are used. Lights are identified by their indices and keep
+    the order of the list they were created from. The table also keeps the light objects themselves
+    (see lights), so indices found in the table always refer to the lights it was created from,
+    even if the scene's list of lights has changed since then.
+
+    Point lights are indexed in a grid of cubic cells (the cell size is the median diameter of their
+    ranges). Each cell lists the point lights whose range overlaps it, as well as all lights that can
+    reach any point (ambient lights, suns, other light sources and point lights with huge ranges).
+    """
+    def __init__(self, lights):
+        """
+        :param lights: a sequence of light sources
+        """
+        self.lights = lights = tuple(lights)
+        self.kind = np.array([_get_kind(light) for light in lights], dtype=int)
+        self.color = np.zeros((len(lights), 3))
+        self.position = np.zeros((len(lights), 3))
+        self.direction = np.zeros((len(lights), 3))
+        self.max_lighting_distance = np.zeros(len(lights))
+        self.other_lights = {}
+        for index, (kind, light) in enumerate(zip(self.kind, lights)):
+            if kind == OTHER:
+                self.other_lights[index] = light
+                continue
+            self.color[index] = light.color
+            if kind == POINT:
+                self.position[index] = light.position
+                self.max_lighting_distance[index] = light.max_lighting_distance
+            elif kind == SUN:
+                self.direction[index] = light.direction
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.kind)
+
+    def _build_grid(self):
+        radii = self.max_lighting_distance
+        bounded = (self.kind == POINT) & np.isfinite(radii) & (radii > 0)
+        self.cell_size = 2 * float(np.median(radii[bounded])) if np.any(bounded) else None
+        cells = {}
+        if self.cell_size is not None:
+            # ranges are enlarged a little, so rounding errors never leave out a light
+            lower = np.floor((self.position - 1.000001*radii[:, np.newaxis]) / self.cell_size).astype(np.int64)
+            upper = np.floor((self.position + 1.000001*radii[:, np.newaxis]) / self.cell_size).astype(np.int64)
+            cell_counts = np.prod(upper - lower + 1, axis=1)
+            bounded &= cell_counts <= _MAX_LIGHT_CELLS
+            for index in np.flatnonzero(bounded):
+                for cell in itertools.product(*(range(low, high + 1) for low, high in zip(lower[index].tolist(),
+                                                                                          upper[index].tolist()))):
+                    cells.setdefault(cell, []).append(int(index))
+        self.global_lights = tuple(np.flatnonzero(~bounded).tolist())
+        self.cells = {cell: tuple(sorted(self.global_lights + tuple(indices))) for cell, indices in cells.items()}
+
+    def find_lights(self, point):
+        """
+        Finds lights that might illuminate a point (other lights certainly do not reach it).
+        :param point: a point (e.g. Vec3 object)
+        :return: a tuple of light indices in increasing order
+        """
+        if self.cell_size is None:
+            return self.global_lights
+        x, y, z = point
+        cell = math.floor(x / self.cell_size), math.floor(y / self.cell_size), math.floor(z / self.cell_size)
+        return self.cells.get(cell, self.global_lights)
+
+    def find_lights_at_points(self, points):
+        """
+        Finds lights that might illuminate any of many points (see find_lights).
+
+        Lights of all cells overlapping the bounding box of the points are listed (unless there are many
+        such cells), so a few lights that do not reach any of the points might be listed as well.
+        :param points: numpy array of shape (N, 3)
+        :return: numpy array of light indices in increasing order
+        """
+        if self.cell_size is None or not len(points):
+            return np.array(self.global_lights, dtype=int)
+        if len(self) <= _MIN_INDEXED_LIGHTS:
+            # testing a few lights is cheaper than searching the grid
+            return np.arange(len(self))
+        lower = np.floor(points.min(axis=0) / self.cell_size).astype(np.int64).tolist()
+        upper = np.floor(points.max(axis=0) / self.cell_size).astype(np.int64).tolist()
+        if math.prod(high - low + 1 for low, high in zip(lower, upper)) <= _MAX_LIGHT_CELLS:
+            cells = itertools.product(*(range(low, high + 1) for low, high in zip(lower, upper)))
+        elif len(self.cells) <= _MAX_LIGHT_CELLS:
+            cells = [cell for cell in self.cells if all(low <= c <= high for low, c, high in zip(lower, cell, upper))]
+        else:
+            cells = map(tuple, np.unique(np.floor(points / self.cell_size).astype(np.int64), axis=0).tolist())
+        lights = set(self.global_lights)
+        for cell in cells:
+            lights.update(self.cells.get(cell, ()))
+        return np.array(sorted(lights), dtype=int)
+
+    def illuminates_points(self, index, points, scene):
+        """
+        Checks which points are reached by the light with given index (see illuminates_points of lights).
+        """
+        kind = self.kind[index]
+        if kind == POINT:
+            return _point_illuminates_points(self.position[index], points, scene)
+        elif kind == SUN:
+            return _sun_illuminates_points(self.direction[index], points, scene)
+        elif kind == AMBIENT:
+            return np.ones(len(points), dtype=bool)
+        return self.other_lights[index].illuminates_points(points, scene)
+
+    def get_light_intensity_at_points(self, index, points):
+        """
+        Calculates colors of the light with given index at points (see get_light_intensity_at_points of lights).
+        """
+        kind = self.kind[index]
+        if kind == POINT:
+            return _point_light_intensity_at_points(self.color[index], self.position[index],
+                                                    self.max_lighting_distance[index], points)
+        elif kind in (SUN, AMBIENT):
+            return np.broadcast_to(self.color[index], points.shape)
+        return self.other_lights[index].get_light_intensity_at_points(points)
+
+    def get_light_vector_at_points(self, index, points):
+        """
+        Calculates light vectors of the light with given index at points (see get_light_vector_at_points of lights).
+        """
+        kind = self.kind[index]
+        if kind == POINT:
+            return Vectors.normalize(points - self.position[index])
+        elif kind == SUN:
+            return np.broadcast_to(self.direction[index], points.shape)
+        elif kind == AMBIENT:
+            return None
+        return self.other_lights[index].get_light_vector_at_points(points)
+
+
+def _get_kind(light):
+    # subclasses might override methods, so only exact types are packed
+    return {Ambient: AMBIENT, Point: POINT, Sun: SUN}.get(type(light), OTHER)
+
+
+def _point_illuminates_points(position, points, scene):
+    light_vectors = position - points
+    light_vector_lengths = Vectors.norm(light_vectors)
+    directions = light_vectors / light_vector_lengths[:, np.newaxis]
+    return ~scene.check_occlusions(points, directions, far=light_vector_lengths)
+
+
+def _point_light_intensity_at_points(color, position, max_lighting_distance, points):
+    distances = Vectors.norm(points - position)
+    factors = ((max_lighting_distance - distances) / max_lighting_distance)**2
+    factors[distances > max_lighting_distance] = 0
+    return color * factors[:, np.newaxis]
+
+
+def _sun_illuminates_points(direction, points, scene):
+    directions = np.broadcast_to(-direction, points.shape)
+    return ~scene.check_occlusions(points, directions)
@@ -1,8 +1,27 @@
 from collections import namedtuple
+import numpy as np
 
 Material = namedtuple('Material', 'color specular_color phong_exponent reflection_factor')
 Material.__new__.__defaults__ = ((127, 127, 127), (255, 255, 255), 60, 0)
 
+
+class MaterialTable:
+    """
+    Represents a list of materials stored as numpy arrays.
+
+    Each attribute of a material is stored in a separate array, so that materials
+    of many collision points can be looked up at once using material indices.
+    """
+    def __init__(self, materials):
+        """
+        :param materials: a sequence of materials (index of a material in this sequence is its material index)
+        """
+        self.materials = tuple(materials)
+        self.color = np.array([m.color for m in self.materials], dtype=float).reshape(-1, 3)
+        self.specular_color = np.array([m.specular_color for m in self.materials], dtype=float).reshape(-1, 3)
+        self.phong_exponent = np.array([m.phong_exponent for m in self.materials])
+        self.reflection_factor = np.array([m.reflection_factor for m in self.materials], dtype=float)
+
 ORANGE_GLOSSY = Material(color=(255, 165, 0))
 ORANGE_MATTE = Material(color=(255, 165, 0), specular_color=(0, 0, 0))
 BLUE_GLOSSY = Material(color=(30, 144, 255))
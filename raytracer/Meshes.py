@@ -0,0 +1,285 @@
+"""
+Contains triangle meshes and functions for loading and saving them.
+
+A mesh is stored in a few contiguous numpy arrays (instead of one object per triangle), so even
+meshes with millions of triangles use little memory. Meshes can be loaded from OBJ files or from
+a compact binary format. Binary files are memory-mapped, so loading them is instant, and processes
+rendering the same mesh share its data instead of copying it.
+"""
+import numpy as np
+from raytracer import Vectors
+from raytracer.Acceleration import BoundingVolumeHierarchy
+from raytracer.Files import load_arrays, save_arrays
+from raytracer.Materials import GRAY_GLOSSY, Material
+from raytracer.Objects import BatchCollisionResult, CollisionResult
+
+MESH_FILE_TYPE = b'RTMESH01'
+
+_MAX_LEAF_SIZE = 8
+
+
+class TriangleMesh:
+    """
+    Represents a mesh of triangles.
+
+    Triangles are illuminated from both sides. If vertex normals are given, normals are interpolated
+    across triangles (smooth shading), otherwise each triangle is flat. The mesh has its own bounding
+    volume hierarchy, and triangles are stored in its order (so they might be reordered in relation
+    to given indices).
+    """
+    def __init__(self, vertices, indices, normals=None, material=GRAY_GLOSSY, hierarchy=None):
+        """
+        :param vertices: vertex positions as an array of shape (V, 3)
+        :param indices: vertex indices of triangles as an array of shape (T, 3)
+        :param normals: vertex normals as an array of shape (V, 3) (if None, triangles will be flat)
+        :param material: material of the mesh
+        :param hierarchy: bounding volume hierarchy of the triangles (if None, it will be built,
+        otherwise triangles must already be in its order)
+        """
+        self.vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+        self.indices = np.asarray(indices, dtype=np.int32).reshape(-1, 3)
+        self.normals = None if normals is None else np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+        self.material = material
+        self.materials = (material,)
+        self.file_name = None
+        if hierarchy is None:
+            triangles = self.vertices[self.indices]
+            hierarchy = BoundingVolumeHierarchy(triangles.min(axis=1), triangles.max(axis=1), _MAX_LEAF_SIZE)
+            self.indices = self.indices[hierarchy.primitives]
+            hierarchy.primitives = np.arange(len(self.indices))
+        self.hierarchy = hierarchy
+
+    def __getstate__(self):
+        if self.file_name:
+            return {'file_name': self.file_name, 'material': self.material}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'file_name' in state and len(state) == 2:
+            state = load_mesh(state['file_name'], state['material']).__dict__
+        self.__dict__.update(state)
+
+    def get_bounding_box(self):
+        if not len(self.indices):
+            return None
+        return self.hierarchy.node_lower[0], self.hierarchy.node_upper[0]
+
+    def check_collision(self, eye, direction, near, far):
+        eye, direction = np.asarray(eye), np.asarray(direction)
+        closest = None
+
+        def intersect_triangles(triangles, far):
+            nonlocal closest
+            distances, u, v = self._intersect_triangles(eye, direction, triangles, near, far)
+            index = np.argmin(distances)
+            if distances[index] < far:
+                closest = triangles[index], u[index], v[index]
+                far = distances[index]
+            return far
+
+        distance = self.hierarchy.intersect(eye, direction, near, far, intersect_triangles)
+        if closest is None:
+            return None
+        normal = self._get_normals(*closest, direction)
+        return CollisionResult(eye + direction*distance, normal, self.material, distance)
+
+    def check_occlusion(self, eye, direction, near, far):
+        eye, direction = np.asarray(eye), np.asarray(direction)
+
+        def occlude_triangles(triangles, far):
+            distances = self._intersect_triangles(eye, direction, triangles, near, far)[0]
+            return -np.inf if np.any(distances < np.inf) else far
+
+        return self.hierarchy.intersect(eye, direction, near, far, occlude_triangles) == -np.inf
+
+    def check_collisions(self, eyes, directions, near, far):
+        distances = np.full(len(directions), np.inf)
+        triangles = np.zeros(len(directions), dtype=int)
+        u = np.zeros(len(directions))
+        v = np.zeros(len(directions))
+        far = np.minimum(far, distances)
+
+        def intersect_triangles(rays, leaf_triangles):
+            ray_eyes = np.reshape(Vectors.select(eyes, rays, 1), (-1, 1, 3))
+            ray_near = np.reshape(Vectors.select(near, rays), (-1, 1))
+            leaf_distances, leaf_u, leaf_v = self._intersect_triangles(
+                ray_eyes, directions[rays, np.newaxis], leaf_triangles, ray_near, far[rays, np.newaxis])
+            closest = np.argmin(leaf_distances, axis=1)
+            closest_distances = leaf_distances[np.arange(len(rays)), closest]
+            closer = closest_distances < distances[rays]
+            closer_rays, closest = rays[closer], closest[closer]
+            distances[closer_rays] = far[closer_rays] = closest_distances[closer]
+            triangles[closer_rays] = leaf_triangles[closest]
+            u[closer_rays] = leaf_u[closer, closest]
+            v[closer_rays] = leaf_v[closer, closest]
+
+        def intersect_ray(ray, node):
+            def intersect_ray_triangles(leaf_triangles, ray_far):
+                intersect_triangles(np.array([ray]), leaf_triangles)
+                return far[ray]
+            self.hierarchy.intersect(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                     far[ray], intersect_ray_triangles, node)
+
+        self.hierarchy.intersect_packet(eyes, directions, near, far, intersect_triangles, intersect_ray)
+        normals = np.zeros((len(directions), 3))
+        hits = distances < np.inf
+        if np.any(hits):
+            normals[hits] = self._get_normals(triangles[hits], u[hits], v[hits], directions[hits])
+        return BatchCollisionResult(distances, normals, np.zeros(len(directions), dtype=int))
+
+    def check_occlusions(self, eyes, directions, near, far):
+        far = np.array(np.broadcast_to(far, len(directions)), dtype=float)
+
+        def occlude_triangles(rays, triangles):
+            ray_eyes = np.reshape(Vectors.select(eyes, rays, 1), (-1, 1, 3))
+            ray_near = np.reshape(Vectors.select(near, rays), (-1, 1))
+            distances = self._intersect_triangles(ray_eyes, directions[rays, np.newaxis], triangles, ray_near,
+                                                  far[rays, np.newaxis])[0]
+            far[rays[np.any(distances < np.inf, axis=1)]] = -np.inf
+
+        def occlude_ray(ray, node):
+            def occlude_ray_triangles(triangles, ray_far):
+                occlude_triangles(np.array([ray]), triangles)
+                return far[ray]
+            self.hierarchy.intersect(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                     far[ray], occlude_ray_triangles, node)
+
+        self.hierarchy.intersect_packet(eyes, directions, near, far, occlude_triangles, occlude_ray)
+        return far == -np.inf
+
+    def _intersect_triangles(self, eyes, directions, triangles, near, far):
+        """
+        Checks collisions of rays with triangles using Moller-Trumbore algorithm.
+
+        Arguments are broadcast against each other, so one ray can be tested against many triangles,
+        or many rays (arrays of shape (N, 1, 3)) against many triangles at once.
+        :return: a tuple of (distances, u, v), where u and v are barycentric coordinates of collision points
+        (distance is numpy.inf if a ray does not collide with a triangle)
+        """
+        vertices = self.vertices[self.indices[triangles]].astype(float)
+        edge1 = vertices[..., 1, :] - vertices[..., 0, :]
+        edge2 = vertices[..., 2, :] - vertices[..., 0, :]
+        p = Vectors.cross(directions, edge2)
+        determinant = Vectors.dot(edge1, p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse_determinant = 1 / determinant
+            to_eye = eyes - vertices[..., 0, :]
+            u = Vectors.dot(to_eye, p) * inverse_determinant
+            q = Vectors.cross(to_eye, edge1)
+            v = Vectors.dot(directions, q) * inverse_determinant
+            distances = Vectors.dot(edge2, q) * inverse_determinant
+            hits = (u >= 0) & (v >= 0) & (u + v <= 1) & (near <= distances) & (distances <= far)
+        return np.where(hits, distances, np.inf), u, v
+
+    def _get_normals(self, triangles, u, v, directions):
+        """
+        Calculates normals at given points of triangles (normals are directed against the rays).
+        """
+        if self.normals is not None:
+            normals = self.normals[self.indices[triangles]].astype(float)
+            u, v = np.asarray(u)[..., np.newaxis], np.asarray(v)[..., np.newaxis]
+            normals = (1 - u - v)*normals[..., 0, :] + u*normals[..., 1, :] + v*normals[..., 2, :]
+        else:
+            vertices = self.vertices[self.indices[triangles]].astype(float)
+            normals = Vectors.cross(vertices[..., 1, :] - vertices[..., 0, :], vertices[..., 2, :] - vertices[..., 0, :])
+        normals = Vectors.normalize(normals)
+        facing_away = Vectors.dot(normals, directions) > 0
+        return np.where(np.expand_dims(facing_away, -1), -normals, normals)
+
+
+def load_obj(file_name, material=GRAY_GLOSSY):
+    """
+    Loads a mesh from a Wavefront OBJ file.
+
+    Only vertex positions, vertex normals and faces are read (polygons are split into triangles).
+    Vertex normals are used only if they are given for all faces.
+    :param file_name: name of the OBJ file
+    :param material: material of the mesh
+    :return: TriangleMesh object
+    """
+    positions, normals, corners = [], [], []
+    with open(file_name) as file:
+        for line in file:
+            values = line.split()
+            if not values:
+                continue
+            if values[0] == 'v':
+                positions.append([float(value) for value in values[1:4]])
+            elif values[0] == 'vn':
+                normals.append([float(value) for value in values[1:4]])
+            elif values[0] == 'f':
+                face = [_parse_face_corner(value, len(positions), len(normals)) for value in values[1:]]
+                for i in range(1, len(face) - 1):
+                    corners.extend((face[0], face[i], face[i + 1]))
+
+    positions = np.array(positions, dtype=np.float32).reshape(-1, 3)
+    corners = np.array(corners, dtype=int).reshape(-1, 2)
+    if len(corners) and np.all(corners[:, 1] >= 0):
+        # OBJ indexes positions and normals separately, so each distinct pair becomes a vertex
+        pairs, indices = np.unique(corners, axis=0, return_inverse=True)
+        normals = np.array(normals, dtype=np.float32)[pairs[:, 1]]
+        return TriangleMesh(positions[pairs[:, 0]], indices.reshape(-1, 3), normals, material)
+    return TriangleMesh(positions, corners[:, 0].reshape(-1, 3), material=material)
+
+
+def save_mesh(mesh, file_name):
+    """
+    Saves a mesh to a binary file, which can be loaded using load_mesh.
+
+    The file contains vertices, triangles, normals, the mesh's bounding volume hierarchy and material.
+    :param mesh: TriangleMesh object
+    :param file_name: name of the output file
+    """
+    arrays = {'vertices': mesh.vertices, 'indices': mesh.indices}
+    if mesh.normals is not None:
+        arrays['normals'] = mesh.normals
+    for name, array in mesh.hierarchy.get_arrays().items():
+        arrays['hierarchy_' + name] = array
+    header = {'material': [list(value) if isinstance(value, tuple) else value for value in mesh.material]}
+    save_arrays(file_name, MESH_FILE_TYPE, header, arrays)
+
+
+def load_mesh(file_name, material=None, mmap=True):
+    """
+    Loads a mesh from a binary file created by save_mesh.
+    :param file_name: name of the input file
+    :param material: material of the mesh (if None, the material saved in the file will be used)
+    :param mmap: if True, the mesh's arrays will be memory-mapped instead of being read into memory
+    (a memory-mapped mesh passed to another process is loaded from the file again instead of being copied)
+    :return: TriangleMesh object
+    :raises ValueError: if the file is not a valid mesh file
+    """
+    header, arrays = load_arrays(file_name, MESH_FILE_TYPE, 'r' if mmap else None)
+    try:
+        vertices, indices, normals = arrays['vertices'], arrays['indices'], arrays.get('normals')
+        hierarchy_arrays = {name: np.asarray(arrays['hierarchy_' + name])
+                            for name in ('node_lower', 'node_upper', 'node_start', 'node_count', 'node_axis',
+                                         'node_right')}
+        if material is None:
+            material = Material(*(tuple(value) if isinstance(value, list) else value
+                                  for value in header['material']))
+    except (KeyError, TypeError):
+        raise ValueError('{} is not a complete mesh file'.format(file_name))
+    if vertices.shape[1:] != (3,) or indices.shape[1:] != (3,) or (normals is not None and
+                                                                   normals.shape != vertices.shape):
+        raise ValueError('{} contains arrays of invalid shapes'.format(file_name))
+
+    hierarchy = BoundingVolumeHierarchy.from_arrays(hierarchy_arrays, np.arange(len(indices)))
+    mesh = TriangleMesh(vertices, indices, normals, material, hierarchy)
+    if mmap:
+        mesh.file_name = file_name
+    return mesh
+
+
+def _parse_face_corner(value, position_count, normal_count):
+    """
+    Parses a corner of an OBJ face (e.g. '1', '1/2', '1//3' or '1/2/3').
+    :return: a tuple of (position index, normal index), normal index is -1 if there is no normal
+    """
+    values = value.split('/')
+    position = int(values[0])
+    position = position - 1 if position > 0 else position_count + position
+    if len(values) < 3 or not values[2]:
+        return position, -1
+    normal = int(values[2])
+    return position, normal - 1 if normal > 0 else normal_count + normal
@@ -3,20 +3,58 @@ Contains scene objects.
 
 Each object must implement a method check_collision(eye, direction, near, far).
 Vectors eye and direction represent the position and direction of a traced ray
-of light (direction must be normalized). Values near and far represent the
+of light (direction must be normalized). They are usually Vec3 objects (see Vectors
+module), but numpy arrays must be accepted as well. Values near and far represent the
 minimal and maximal distance along the ray that a collision can occur (if a
 collision occurs outside of this range, it will not be detected). The value
 returned by this method is either None (if a collision with the object does not
-occur) or a tuple of (collision_point, normal, material). Collision point is
-a point at which the ray collides with the object, normal is a normalized
-normal vector at that point, and material is a material of given object.
+occur) or a CollisionResult tuple of (collision_point, normal, material, distance).
+Collision point is a point at which the ray collides with the object, normal is
+a normalized normal vector at that point, material is a material of given object
+and distance is the distance along the ray to the collision point (it might be None,
+in that case it is calculated from the collision point).
+
+Each object must also have an attribute materials (a tuple of all materials
+used by the object) and implement a method check_collisions(eyes, directions, near, far),
+which checks collisions for many rays at once. Arguments eyes and directions are
+numpy arrays of shape (N, 3) (eyes might also be a single point shared by all rays),
+near and far are either single values or arrays of N values. The value returned by
+this method is a tuple of (distances, normals, material_indices). Distance is
+numpy.inf for rays that do not collide with the object, material index is an index
+of the material in the object's materials tuple.
+
+Shadow rays only need to know if anything blocks them, so each object must also
+implement methods check_occlusion(eye, direction, near, far) and
+check_occlusions(eyes, directions, near, far). They take the same arguments as
+check_collision and check_collisions, but return only True (or an array of boolean
+values) for rays that collide with the object between near and far. They should
+avoid any calculations that are not needed to answer that question (e.g. normals).
+
+Objects might also implement a method get_bounding_box(), which returns a tuple of
+(minimal corner, maximal corner) of an axis-aligned box containing the whole object.
+Bounded objects are organized in an acceleration structure, so that a ray is not tested
+against objects that are far from its path. Objects that do not implement this method
+(or return None) are always tested.
 """
 from collections import namedtuple
 import numpy as np
 import math
 from raytracer.Materials import GRAY_GLOSSY
+from raytracer import Vectors
+from raytracer.Vectors import Vec3
+
+CollisionResult = namedtuple('CollisionResult', 'point normal material distance')
+CollisionResult.__new__.__defaults__ = (None,)
+BatchCollisionResult = namedtuple('BatchCollisionResult', 'distance normal material')
 
-CollisionResult = namedtuple('CollisionResult', 'point normal material')
+
+def get_collision_distance(eye, collision_result):
+    """
+    Returns the distance along a ray to its collision point (it is calculated only if the object did not give it).
+    """
+    if collision_result.distance is not None:
+        return collision_result.distance
+    return np.linalg.norm(np.subtract(eye, collision_result.point))
 
 
 class Sphere:
@@ -34,15 +72,34 @@ class Sphere:
         self.center = np.array(center)
         self.radius = radius
         self.material = material
+        self.materials = (material,)
 
     def check_collision(self, eye, direction, near, far):
+        collision_distance = self._get_collision_distance(eye, direction, near, far)
+        if collision_distance:
+            (ex, ey, ez), (dx, dy, dz) = eye, direction
+            cx, cy, cz = self.center.tolist()
+            px, py, pz = ex + dx*collision_distance, ey + dy*collision_distance, ez + dz*collision_distance
+            nx, ny, nz = px - cx, py - cy, pz - cz
+            length = math.sqrt(nx*nx + ny*ny + nz*nz)
+            return CollisionResult(Vec3((px, py, pz)), Vec3((nx/length, ny/length, nz/length)), self.material,
+                                   collision_distance)
+        else:
+            return None
+
+    def check_occlusion(self, eye, direction, near, far):
+        return bool(self._get_collision_distance(eye, direction, near, far))
+
+    def _get_collision_distance(self, eye, direction, near, far):
         collision_distance = None
 
-        to_eye = eye - self.center
-        a = np.dot(direction, direction)
-        b = 2*np.dot(to_eye, direction)
-        c = np.dot(to_eye, to_eye) - self.radius**2
-        delta = b**2 - 4*a*c
+        (ex, ey, ez), (dx, dy, dz) = eye, direction
+        cx, cy, cz = self.center.tolist()
+        tx, ty, tz = ex - cx, ey - cy, ez - cz
+        a = dx*dx + dy*dy + dz*dz
+        b = 2*(tx*dx + ty*dy + tz*dz)
+        c = (tx*tx + ty*ty + tz*tz) - self.radius**2
+        delta = b*b - 4*a*c
 
         if delta > 0:
             distance1 = (-b - math.sqrt(delta)) / (2*a)
@@ -52,14 +109,45 @@ class Sphere:
             distance = -b / (2*a)
             if near <= distance <= far:
                 collision_distance = distance
+        return collision_distance
 
-        if collision_distance:
-            collision_point = eye + direction*collision_distance
-            normal = collision_point - self.center
-            normal /= np.linalg.norm(normal)
-            return CollisionResult(collision_point, normal, self.material)
-        else:
-            return None
+    def check_collisions(self, eyes, directions, near, far):
+        distances = self._get_collision_distances(eyes, directions, near, far)
+        normals = np.zeros((len(directions), 3))
+        hits = distances < np.inf
+        if np.any(hits):
+            hit_eyes = Vectors.select(eyes, hits, 1)
+            normals[hits] = Vectors.normalize(hit_eyes + directions[hits]*distances[hits, np.newaxis] - self.center)
+        return BatchCollisionResult(distances, normals, np.zeros(len(directions), dtype=int))
+
+    def check_occlusions(self, eyes, directions, near, far):
+        return self._get_collision_distances(eyes, directions, near, far) < np.inf
+
+    def _get_collision_distances(self, eyes, directions, near, far):
+        to_eye = eyes - self.center
+        a = Vectors.dot(directions, directions)
+        b = 2*Vectors.dot(to_eye, directions)
+        c = Vectors.dot(to_eye, to_eye) - self.radius**2
+        delta = b**2 - 4*a*c
+
+        distances = np.full(len(directions), np.inf)
+        hits = delta >= 0
+        if np.any(hits):
+            a, b = a[hits], b[hits]
+            sqrt_delta = np.sqrt(delta[hits])
+            near = Vectors.select(near, hits)
+            far = Vectors.select(far, hits)
+            distance1 = (-b - sqrt_delta) / (2*a)
+            distance2 = (-b + sqrt_delta) / (2*a)
+            distance = np.where((near <= distance2) & (distance2 <= far), distance2, np.inf)
+            distance = np.where((near <= distance1) & (distance1 <= far), distance1, distance)
+            distance[distance == 0] = np.inf
+            distances[hits] = distance
+        return distances
+
+    def get_bounding_box(self):
+        radius = abs(self.radius)
+        return self.center - radius, self.center + radius
 
 
 class Plane:
@@ -77,15 +165,29 @@ class Plane:
         self.position = np.array(position)
         self.normal = normal / np.linalg.norm(normal)
         self.material = material
+        self.materials = (material,)
 
     def check_collision(self, eye, direction, near, far):
-        d = np.dot(direction, self.normal)
-        if d != 0:
-            distance = np.dot(self.normal, (self.position - eye)) / d
-            if near <= distance <= far:
-                return CollisionResult(eye + direction*distance, self.normal, self.material)
+        distance = self._get_collision_distance(eye, direction, near, far)
+        if distance is not None:
+            return CollisionResult(_ray_point(eye, direction, distance), Vec3(self.normal.tolist()), self.material,
+                                   distance)
         return None
 
+    def check_occlusion(self, eye, direction, near, far):
+        return self._get_collision_distance(eye, direction, near, far) is not None
+
+    def _get_collision_distance(self, eye, direction, near, far):
+        return _plane_distance(self.position.tolist(), self.normal.tolist(), eye, direction, near, far)
+
+    def check_collisions(self, eyes, directions, near, far):
+        distances = _plane_distances(self.position, self.normal, eyes, directions, near, far)
+        normals = np.broadcast_to(self.normal, directions.shape)
+        return BatchCollisionResult(distances, normals, np.zeros(len(directions), dtype=int))
+
+    def check_occlusions(self, eyes, directions, near, far):
+        return _plane_distances(self.position, self.normal, eyes, directions, near, far) < np.inf
+
 
 class Circle:
     """
@@ -107,15 +209,103 @@ class Circle:
         self.front_plane = Plane(center, normal, front_material)
         self.back_plane = Plane(center, -normal, back_material)
         self.radius = radius
+        self.materials = (front_material, back_material)
 
     def check_collision(self, eye, direction, near, far):
-        if np.dot(direction, self.front_plane.normal) < 0:
-            collision_result = self.front_plane.check_collision(eye, direction, near, far)
-        else:
-            collision_result = self.back_plane.check_collision(eye, direction, near, far)
-        if collision_result:
-            distance = np.linalg.norm(self.front_plane.position - collision_result.point)
-            if distance <= self.radius:
-                return collision_result
-        else:
+        # the radius is checked before the collision result is created, so rays missing the circle are cheap
+        distance, point = self._get_collision(eye, direction, near, far)
+        if distance is None:
             return None
+        nx, ny, nz = normal = self.front_plane.normal.tolist()
+        dx, dy, dz = direction
+        if dx*nx + dy*ny + dz*nz < 0:
+            return CollisionResult(point, Vec3(normal), self.front_plane.material, distance)
+        return CollisionResult(point, Vec3((-nx, -ny, -nz)), self.back_plane.material, distance)
+
+    def check_occlusion(self, eye, direction, near, far):
+        return self._get_collision(eye, direction, near, far)[0] is not None
+
+    def _get_collision(self, eye, direction, near, far):
+        """
+        Finds a collision of a ray with the circle using scalar calculations.
+        :return: a tuple of (distance, collision point), both are None if there is no collision
+        """
+        center = self.front_plane.position.tolist()
+        distance = _plane_distance(center, self.front_plane.normal.tolist(), eye, direction, near, far)
+        if distance is None:
+            return None, None
+        point = _ray_point(eye, direction, distance)
+        x, y, z = center[0] - point[0], center[1] - point[1], center[2] - point[2]
+        if math.sqrt(x*x + y*y + z*z) > self.radius:
+            return None, None
+        return distance, point
+
+    def check_collisions(self, eyes, directions, near, far):
+        distances = self._get_collision_distances(eyes, directions, near, far)
+        normal = self.front_plane.normal
+        front = Vectors.dot(directions, normal) < 0
+        normals = np.where(front[:, np.newaxis], normal, -normal)
+        return BatchCollisionResult(distances, normals, np.where(front, 0, 1))
+
+    def check_occlusions(self, eyes, directions, near, far):
+        return self._get_collision_distances(eyes, directions, near, far) < np.inf
+
+    def _get_collision_distances(self, eyes, directions, near, far):
+        center, normal = self.front_plane.position, self.front_plane.normal
+        distances = _plane_distances(center, normal, eyes, directions, near, far)
+        hits = distances < np.inf
+        if np.any(hits):
+            hit_eyes = Vectors.select(eyes, hits, 1)
+            points = hit_eyes + directions[hits]*distances[hits, np.newaxis]
+            distance = distances[hits]
+            distance[Vectors.norm(center - points) > self.radius] = np.inf
+            distances[hits] = distance
+        return distances
+
+    def get_bounding_box(self):
+        center, normal = self.front_plane.position, self.front_plane.normal
+        extent = self.radius * np.sqrt(np.maximum(1 - normal**2, 0))
+        return center - extent, center + extent
+
+
+def _ray_point(eye, direction, distance):
+    """
+    Calculates a point of a ray at given distance from its beginning.
+    :return: Vec3 object
+    """
+    (ex, ey, ez), (dx, dy, dz) = eye, direction
+    return Vec3((ex + dx*distance, ey + dy*distance, ez + dz*distance))
+
+
+def _plane_distance(position, normal, eye, direction, near, far):
+    """
+    Calculates the distance along a ray to a plane using scalar calculations (both sides of the plane are taken
+    into account).
+    :return: the distance or None, if the ray does not collide with the plane between near and far
+    """
+    (ex, ey, ez), (dx, dy, dz) = eye, direction
+    nx, ny, nz = normal
+    d = dx*nx + dy*ny + dz*nz
+    if d != 0:
+        distance = (nx*(position[0] - ex) + ny*(position[1] - ey) + nz*(position[2] - ez)) / d
+        if near <= distance <= far:
+            return distance
+    return None
+
+
+def _plane_distances(position, normal, eyes, directions, near, far):
+    """
+    Calculates distances along many rays to a plane (both sides of the plane are taken into account).
+    :return: numpy array of distances (numpy.inf if a ray does not collide with the plane between near and far)
+    """
+    d = Vectors.dot(directions, normal)
+    distances = np.full(len(directions), np.inf)
+    hits = d != 0
+    if np.any(hits):
+        hit_eyes = Vectors.select(eyes, hits, 1)
+        distance = Vectors.dot(normal, position - hit_eyes) / d[hits]
+        near = Vectors.select(near, hits)
+        far = Vectors.select(far, hits)
+        distances[hits] = np.where((near <= distance) & (distance <= far), distance, np.inf)
+    return distances
+
@@ -0,0 +1,151 @@
+"""
+Contains output sinks, which write rendered images to files tile by tile.
+
+Each sink has a method write_tile(tile, colors), where colors is a numpy array of shape
+(tile height, tile width, 3) with values in range 0 - 255. Tiles can be written in any order.
+Sinks write rows of pixels as soon as possible, so an image does not have to be kept in memory
+as a whole, and a file can be processed (e.g. uploaded) before the render is finished.
+Sinks must be closed after writing all tiles (they can be used as context managers).
+"""
+import struct
+import zlib
+import numpy as np
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class PngWriter:
+    """
+    Writes an RGB image to a PNG file incrementally.
+
+    Rows are compressed and written as soon as they are complete and all rows above them have
+    been written. Only incomplete rows are kept in memory.
+    """
+    def __init__(self, file, image_size, compression_level=6):
+        """
+        :param file: name of the output file or a binary file object (e.g. a pipe or a socket file)
+        :param image_size: image size as a tuple (width, height)
+        :param compression_level: zlib compression level (0 - 9)
+        """
+        self.image_size = image_size
+        self._own_file = isinstance(file, str)
+        self._file = open(file, 'wb') if self._own_file else file
+        self._compressor = zlib.compressobj(compression_level)
+        self._pending_rows = {}
+        self._filled_pixels = {}
+        self.next_row = 0
+
+        width, height = image_size
+        self._file.write(_PNG_SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_file()
+
+    def write_tile(self, tile, colors):
+        """
+        Writes a tile of the image (rows are written to the file when they are complete).
+        """
+        width = self.image_size[0]
+        colors = np.clip(colors, 0, 255).astype(np.uint8)
+        for y in range(tile.top, tile.bottom):
+            if y not in self._pending_rows:
+                self._pending_rows[y] = np.zeros((width, 3), dtype=np.uint8)
+                self._filled_pixels[y] = 0
+            self._pending_rows[y][tile.left:tile.right] = colors[y - tile.top]
+            self._filled_pixels[y] += tile.right - tile.left
+
+        rows = []
+        while self._filled_pixels.get(self.next_row) == width:
+            rows.append(self._pending_rows.pop(self.next_row))
+            del self._filled_pixels[self.next_row]
+            self.next_row += 1
+        if rows:
+            self.write_rows(np.stack(rows))
+
+    def write_rows(self, rows):
+        """
+        Writes complete rows of the image, directly after previously written rows.
+        :param rows: colors of the rows as a numpy array of shape (number of rows, width, 3)
+        """
+        rows = np.asarray(rows, dtype=np.uint8).reshape(len(rows), -1)
+        # 'Sub' filter: each byte is stored as a difference from the same color of the previous pixel
+        filtered = rows.copy()
+        filtered[:, 3:] -= rows[:, :-3]
+        data = np.hstack((np.ones((len(rows), 1), dtype=np.uint8), filtered))
+        compressed = self._compressor.compress(data.tobytes())
+        if compressed:
+            self._write_chunk(b'IDAT', compressed)
+
+    def close(self):
+        """
+        Finishes the PNG file.
+        :raises ValueError: if some rows of the image have not been written
+        """
+        if self._file is None:
+            return
+        try:
+            if self.next_row != self.image_size[1]:
+                raise ValueError('Image is incomplete ({} of {} rows written)'.format(self.next_row,
+                                                                                      self.image_size[1]))
+            self._write_chunk(b'IDAT', self._compressor.flush())
+            self._write_chunk(b'IEND', b'')
+        finally:
+            self._close_file()
+
+    def _close_file(self):
+        if self._own_file and self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+class RawWriter:
+    """
+    Writes an RGB image to a raw file.
+
+    The file contains only pixel colors (3 bytes per pixel), row by row, starting at top left corner.
+    Each tile is written directly to its place in the file, so nothing is kept in memory.
+    """
+    def __init__(self, file_name, image_size):
+        """
+        :param file_name: name of the output file
+        :param image_size: image size as a tuple (width, height)
+        """
+        width, height = image_size
+        self.image_size = image_size
+        self._file = open(file_name, 'wb')
+        self._file.truncate(width * height * 3)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_tile(self, tile, colors):
+        """
+        Writes a tile of the image.
+        """
+        width = self.image_size[0]
+        colors = np.clip(colors, 0, 255).astype(np.uint8)
+        for y in range(tile.top, tile.bottom):
+            self._file.seek((y * width + tile.left) * 3)
+            self._file.write(colors[y - tile.top].tobytes())
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self._file.close()
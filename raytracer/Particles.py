@@ -0,0 +1,289 @@
+"""
+Contains sphere clouds and functions for loading and saving them.
+
+A sphere cloud stores many spheres (e.g. particles or atoms of molecules) in a few contiguous numpy
+arrays: centers and radii as 32-bit floats and, optionally, indices of materials in the cloud's materials
+tuple. Arrays are used as they are given, so they can be memory-mapped (e.g. loaded from .npy files using
+numpy.load with mmap_mode='r'), and millions of spheres use only a few bytes each.
+
+Neighbouring spheres (in Morton order) are grouped into small clusters, and clusters are organized
+in a bounding volume hierarchy. Rays are tested against all spheres of a leaf at once. Clouds can also be
+saved in a binary format with their spheres sorted and their hierarchy, which is loaded instantly (the file
+is memory-mapped, so it is also shared between rendering processes instead of being copied).
+"""
+import numpy as np
+from raytracer import Vectors
+from raytracer.Acceleration import BoundingVolumeHierarchy
+from raytracer.Files import load_arrays, save_arrays
+from raytracer.Materials import GRAY_GLOSSY, Material
+from raytracer.Objects import BatchCollisionResult, CollisionResult
+
+CLOUD_FILE_TYPE = b'RTCLOUD1'
+
+_CLUSTER_SIZE = 32
+_MAX_LEAF_SIZE = 2
+# bits of each coordinate used to sort spheres in Morton order
+_MORTON_BITS = 10
+
+
+class SphereCloud:
+    """
+    Represents a cloud of spheres.
+
+    Like a sphere, each sphere of the cloud is illuminated only from the outside. The order of spheres
+    is not changed; an array of sphere indices sorted in Morton order is kept instead (it is not needed
+    by clouds loaded from files, which are already sorted).
+    """
+    def __init__(self, centers, radii, material_indices=None, materials=(GRAY_GLOSSY,), hierarchy=None):
+        """
+        :param centers: centers of spheres as an array of shape (N, 3)
+        :param radii: radii of spheres as an array of N values (or a single radius of all spheres)
+        :param material_indices: indices of materials of spheres as an array of N integers
+        (if None, all spheres will use the first material)
+        :param materials: sequence of materials of the cloud
+        :param hierarchy: bounding volume hierarchy of clusters of spheres (if None, it will be built,
+        otherwise spheres must already be sorted in Morton order, see save_sphere_cloud)
+        :raises ValueError: if there are no spheres, the arrays have different lengths or material indices
+        are invalid
+        """
+        self.centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        radii = np.asarray(radii, dtype=np.float32)
+        self.radii = np.full(len(self.centers), radii) if radii.ndim == 0 else radii.reshape(-1)
+        self.material_indices = None if material_indices is None else np.asarray(material_indices).reshape(-1)
+        self.materials = tuple(materials)
+        self.file_name = None
+        self.order = None
+        if not len(self.centers):
+            raise ValueError('A sphere cloud needs at least one sphere')
+        if len(self.radii) != len(self.centers) or (self.material_indices is not None and
+                                                    len(self.material_indices) != len(self.centers)):
+            raise ValueError('Arrays of spheres have different lengths')
+        if self.material_indices is not None and (
+                self.material_indices.min() < 0 or self.material_indices.max() >= len(self.materials)):
+            raise ValueError('Material indices refer to materials that do not exist')
+        if hierarchy is None:
+            self.order = _get_morton_order(self.centers)
+            hierarchy = BoundingVolumeHierarchy(*self._get_cluster_boxes(), _MAX_LEAF_SIZE)
+        self.hierarchy = hierarchy
+
+    def __len__(self):
+        return len(self.centers)
+
+    def __getstate__(self):
+        if self.file_name:
+            return {'file_name': self.file_name, 'materials': self.materials}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'file_name' in state and len(state) == 2:
+            state = load_sphere_cloud(state['file_name'], state['materials']).__dict__
+        self.__dict__.update(state)
+
+    def get_bounding_box(self):
+        return self.hierarchy.node_lower[0], self.hierarchy.node_upper[0]
+
+    def check_collision(self, eye, direction, near, far):
+        eye, direction = np.asarray(eye, dtype=float), np.asarray(direction, dtype=float)
+        closest = None
+
+        def intersect_clusters(clusters, far):
+            nonlocal closest
+            spheres = self._get_spheres(clusters)
+            distances = self._intersect_spheres(eye, direction, spheres, near, far)
+            index = np.argmin(distances)
+            if distances[index] < far:
+                closest, far = spheres[index], distances[index]
+            return far
+
+        distance = self.hierarchy.intersect(eye, direction, near, far, intersect_clusters)
+        if closest is None:
+            return None
+        point = eye + direction*distance
+        normal = Vectors.normalize(point - self.centers[closest].astype(float))
+        return CollisionResult(point, normal, self.materials[self._get_material_indices(closest)], distance)
+
+    def check_occlusion(self, eye, direction, near, far):
+        eye, direction = np.asarray(eye, dtype=float), np.asarray(direction, dtype=float)
+
+        def occlude_clusters(clusters, far):
+            distances = self._intersect_spheres(eye, direction, self._get_spheres(clusters), near, far)
+            return -np.inf if np.any(distances < np.inf) else far
+
+        return self.hierarchy.intersect(eye, direction, near, far, occlude_clusters) == -np.inf
+
+    def check_collisions(self, eyes, directions, near, far):
+        distances = np.full(len(directions), np.inf)
+        spheres = np.zeros(len(directions), dtype=int)
+        far = np.minimum(far, distances)
+
+        def intersect_clusters(rays, clusters):
+            leaf_spheres = self._get_spheres(clusters)
+            ray_eyes = np.reshape(Vectors.select(eyes, rays, 1), (-1, 1, 3))
+            ray_near = np.reshape(Vectors.select(near, rays), (-1, 1))
+            leaf_distances = self._intersect_spheres(ray_eyes, directions[rays, np.newaxis], leaf_spheres,
+                                                     ray_near, far[rays, np.newaxis])
+            closest = np.argmin(leaf_distances, axis=1)
+            closest_distances = leaf_distances[np.arange(len(rays)), closest]
+            closer = closest_distances < distances[rays]
+            closer_rays = rays[closer]
+            distances[closer_rays] = far[closer_rays] = closest_distances[closer]
+            spheres[closer_rays] = leaf_spheres[closest[closer]]
+
+        def intersect_ray(ray, node):
+            def intersect_ray_clusters(clusters, ray_far):
+                intersect_clusters(np.array([ray]), clusters)
+                return far[ray]
+            self.hierarchy.intersect(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                     far[ray], intersect_ray_clusters, node)
+
+        self.hierarchy.intersect_packet(eyes, directions, near, far, intersect_clusters, intersect_ray)
+        normals = np.zeros((len(directions), 3))
+        materials = np.zeros(len(directions), dtype=int)
+        hits = distances < np.inf
+        if np.any(hits):
+            points = Vectors.select(eyes, hits, 1) + directions[hits]*distances[hits, np.newaxis]
+            normals[hits] = Vectors.normalize(points - self.centers[spheres[hits]].astype(float))
+            materials[hits] = self._get_material_indices(spheres[hits])
+        return BatchCollisionResult(distances, normals, materials)
+
+    def check_occlusions(self, eyes, directions, near, far):
+        far = np.array(np.broadcast_to(far, len(directions)), dtype=float)
+
+        def occlude_clusters(rays, clusters):
+            ray_eyes = np.reshape(Vectors.select(eyes, rays, 1), (-1, 1, 3))
+            ray_near = np.reshape(Vectors.select(near, rays), (-1, 1))
+            distances = self._intersect_spheres(ray_eyes, directions[rays, np.newaxis], self._get_spheres(clusters),
+                                                ray_near, far[rays, np.newaxis])
+            far[rays[np.any(distances < np.inf, axis=1)]] = -np.inf
+
+        def occlude_ray(ray, node):
+            def occlude_ray_clusters(clusters, ray_far):
+                occlude_clusters(np.array([ray]), clusters)
+                return far[ray]
+            self.hierarchy.intersect(Vectors.select(eyes, ray, 1), directions[ray], Vectors.select(near, ray),
+                                     far[ray], occlude_ray_clusters, node)
+
+        self.hierarchy.intersect_packet(eyes, directions, near, far, occlude_clusters, occlude_ray)
+        return far == -np.inf
+
+    def get_sorted_arrays(self):
+        """
+        Returns arrays of spheres sorted in the order of the cluster hierarchy.
+        :return: a tuple of (centers, radii, material indices), material indices might be None
+        """
+        if self.order is None:
+            return self.centers, self.radii, self.material_indices
+        material_indices = None if self.material_indices is None else self.material_indices[self.order]
+        return self.centers[self.order], self.radii[self.order], material_indices
+
+    def _get_spheres(self, clusters):
+        """
+        Finds indices of spheres of given clusters.
+        """
+        spheres = (np.reshape(clusters, (-1, 1))*_CLUSTER_SIZE + np.arange(_CLUSTER_SIZE)).ravel()
+        spheres = spheres[spheres < len(self.centers)]
+        return spheres if self.order is None else self.order[spheres]
+
+    def _get_material_indices(self, spheres):
+        if self.material_indices is None:
+            return np.zeros_like(spheres)
+        return self.material_indices[spheres]
+
+    def _get_cluster_boxes(self):
+        """
+        Calculates bounding boxes of clusters of spheres.
+        :return: a tuple of (minimal corners, maximal corners)
+        """
+        centers, radii = self.get_sorted_arrays()[:2]
+        centers, radii = centers.astype(float), np.abs(radii.astype(float))[:, np.newaxis]
+        starts = np.arange(0, len(centers), _CLUSTER_SIZE)
+        return (np.minimum.reduceat(centers - radii, starts, axis=0),
+                np.maximum.reduceat(centers + radii, starts, axis=0))
+
+    def _intersect_spheres(self, eyes, directions, spheres, near, far):
+        """
+        Checks collisions of rays with spheres (the same way as Sphere.check_collisions).
+
+        Arguments are broadcast against each other, so one ray can be tested against many spheres,
+        or many rays (arrays of shape (N, 1, 3)) against many spheres at once.
+        :return: numpy array of distances (numpy.inf if a ray does not collide with a sphere)
+        """
+        centers, radii = self.centers[spheres].astype(float), self.radii[spheres].astype(float)
+        to_eye = eyes - centers
+        a = Vectors.dot(directions, directions)
+        b = 2*Vectors.dot(to_eye, directions)
+        c = Vectors.dot(to_eye, to_eye) - radii**2
+        with np.errstate(invalid='ignore'):
+            sqrt_delta = np.sqrt(b**2 - 4*a*c)
+            distance1 = (-b - sqrt_delta) / (2*a)
+            distance2 = (-b + sqrt_delta) / (2*a)
+            distances = np.where((near <= distance2) & (distance2 <= far), distance2, np.inf)
+            distances = np.where((near <= distance1) & (distance1 <= far), distance1, distances)
+        return np.where(distances == 0, np.inf, distances)
+
+
+def save_sphere_cloud(cloud, file_name):
+    """
+    Saves a sphere cloud to a binary file, which can be loaded using load_sphere_cloud.
+
+    The file contains sorted arrays of spheres, the cloud's hierarchy and materials.
+    :param cloud: SphereCloud object
+    :param file_name: name of the output file
+    """
+    centers, radii, material_indices = cloud.get_sorted_arrays()
+    arrays = {'centers': centers, 'radii': radii, 'hierarchy_primitives': cloud.hierarchy.primitives}
+    if material_indices is not None:
+        arrays['material_indices'] = material_indices
+    for name, array in cloud.hierarchy.get_arrays().items():
+        arrays['hierarchy_' + name] = array
+    header = {'materials': [[list(value) if isinstance(value, tuple) else value for value in material]
+                            for material in cloud.materials]}
+    save_arrays(file_name, CLOUD_FILE_TYPE, header, arrays)
+
+
+def load_sphere_cloud(file_name, materials=None, mmap=True):
+    """
+    Loads a sphere cloud from a binary file created by save_sphere_cloud.
+    :param file_name: name of the input file
+    :param materials: materials of the cloud (if None, the materials saved in the file will be used)
+    :param mmap: if True, the cloud's arrays will be memory-mapped instead of being read into memory
+    (a memory-mapped cloud passed to another process is loaded from the file again instead of being copied)
+    :return: SphereCloud object
+    :raises ValueError: if the file is not a valid sphere cloud file
+    """
+    header, arrays = load_arrays(file_name, CLOUD_FILE_TYPE, 'r' if mmap else None)
+    try:
+        centers, radii, material_indices = arrays['centers'], arrays['radii'], arrays.get('material_indices')
+        hierarchy_arrays = {name: np.asarray(arrays['hierarchy_' + name])
+                            for name in ('node_lower', 'node_upper', 'node_start', 'node_count', 'node_axis',
+                                         'node_right')}
+        primitives = np.asarray(arrays['hierarchy_primitives'])
+        if materials is None:
+            materials = [Material(*(tuple(value) if isinstance(value, list) else value for value in material))
+                         for material in header['materials']]
+    except (KeyError, TypeError):
+        raise ValueError('{} is not a complete sphere cloud file'.format(file_name))
+    if centers.shape[1:] != (3,) or radii.shape != centers.shape[:1] or (
+            material_indices is not None and material_indices.shape != radii.shape):
+        raise ValueError('{} contains arrays of invalid shapes'.format(file_name))
+
+    hierarchy = BoundingVolumeHierarchy.from_arrays(hierarchy_arrays, primitives)
+    cloud = SphereCloud(centers, radii, material_indices, materials, hierarchy)
+    if mmap:
+        cloud.file_name = file_name
+    return cloud
+
+
+def _get_morton_order(points):
+    """
+    Sorts points along a Z-order (Morton) curve, so that neighbouring points are close to each other.
+    :return: numpy array of indices of points
+    """
+    lower, upper = points.min(axis=0).astype(float), points.max(axis=0).astype(float)
+    scale = (2**_MORTON_BITS - 1) / np.where(upper > lower, upper - lower, 1)
+    cells = ((points - lower) * scale).astype(np.uint64)
+    codes = np.zeros(len(points), dtype=np.uint64)
+    for bit in range(_MORTON_BITS):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3*bit + axis)
+    return np.argsort(codes, kind='stable')
@@ -0,0 +1,66 @@
+"""
+Contains tools for fast relighting of rendered images.
+
+A G-buffer stores results of primary rays of an image (collision points, normals and material indices
+of all pixels). Collisions of primary rays depend only on the camera and on the scene objects,
+so when only the lights are changed, the image can be rendered again from the G-buffer: only
+the lighting model (shadow rays, shading and reflected rays) is calculated again.
+"""
+import numpy as np
+from PIL import Image
+from raytracer import Tracing
+from raytracer.Objects import CollisionResult
+
+
+class GBuffer:
+    """
+    Represents results of primary rays of an image.
+
+    A G-buffer is created by Camera.render_gbuffer. It stays valid as long as the camera and the scene
+    objects (their geometry and the list of their materials) are not changed. Lights, the background color
+    and properties of materials (e.g. colors) can be changed freely between relight calls.
+    """
+    def __init__(self, image_size, directions, hits, points, normals, materials):
+        """
+        :param image_size: image size as a tuple (width, height)
+        :param directions: directions of primary rays of all pixels as a numpy array of shape (N, 3)
+        :param hits: numpy array of N boolean values (True for pixels whose primary rays hit an object)
+        :param points: collision points of pixels that hit an object as a numpy array of shape (M, 3)
+        :param normals: normal vectors at the collision points as a numpy array of shape (M, 3)
+        :param materials: material indices at the collision points (they refer to the scene's material table)
+        """
+        self.image_size = image_size
+        self.directions = directions
+        self.hits = hits
+        self.points = points
+        self.normals = normals
+        self.materials = materials
+
+    def relight(self, scene, file_name=None):
+        """
+        Renders the image again using current lights of the scene.
+
+        The image is the same as an image rendered by Camera.render_image with batch=True.
+        :param scene: scene that was used to create the G-buffer (lights and materials are read again,
+        see Scene.refresh_lighting and CompiledScene.refresh_lighting)
+        :param file_name: name of the output file (if None, no file will be generated)
+        :return: generated image as PIL Image object
+        """
+        scene.refresh_lighting()
+
+        colors = np.zeros((len(self.directions), 3))
+        colors[:] = scene.background_color
+        if scene.max_recursion_level > 0 and np.any(self.hits):
+            directions = self.directions[self.hits]
+            collision_result = CollisionResult(self.points, self.normals, self.materials)
+            colors[self.hits] = scene.batch_lighting_model(scene, directions, collision_result,
+                                                           scene.max_recursion_level)
+            pixels = Tracing.Rays(np.arange(len(colors)), None, None, np.ones(len(colors)))
+            reflected_rays = Tracing.get_reflected_rays(scene, directions, collision_result, np.flatnonzero(self.hits))
+            Tracing.add_ray_colors(scene, colors, Tracing.continue_rays(scene, pixels, reflected_rays),
+                                   scene.max_recursion_level - 1)
+        width, height = self.image_size
+        image = Image.fromarray(np.clip(colors.astype(int), 0, 255).astype(np.uint8).reshape((height, width, 3)))
+        if file_name:
+            image.save(file_name)
+        return image
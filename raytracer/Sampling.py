@@ -0,0 +1,136 @@
+"""
+Contains samplers, which decide how many rays are traced through each pixel of an image.
+
+A sampler is used by a camera (see Camera's antialiasing argument). It must implement a method
+sample_tile(camera, tile, image_size, scene, batch), which returns a tuple of (colors, sample_counts),
+where colors is a numpy array of shape (tile height, tile width, 3) and sample_counts is a numpy array
+of shape (tile height, tile width) with the number of rays traced through each pixel. Colors should not depend
+on how the image is split into tiles (e.g. render caches do not distinguish renders with different tile sizes).
+"""
+import numpy as np
+
+
+class AdaptiveSampler:
+    """
+    Anti-aliases an image by tracing many jittered rays through each pixel.
+
+    Each pixel starts with a few samples at random positions inside of it. More samples are added
+    only to the pixels that are likely to be aliased: the ones whose samples differ from each other
+    (sample standard deviation above the threshold) or whose color differs from the color of a neighbour
+    pixel (by more than the threshold in any channel). Samples are added in rounds until the standard
+    deviation of a pixel drops below the threshold or the pixel reaches the maximal number of samples,
+    so extra rays are mostly traced at object edges and reflection seams.
+
+    Pixels on the edges of a tile are compared with their neighbours in other tiles as well: the initial
+    samples of a one-pixel border around the tile are traced too (only to compare colors). Random positions
+    of samples depend only on the seed and the pixel, so these pixels get the same colors as in their own
+    tiles, and rendered images do not depend on the tile size or on which worker renders which tile.
+    """
+    def __init__(self, initial_samples=4, max_samples=16, threshold=8, seed=0):
+        """
+        :param initial_samples: number of samples traced through every pixel (also added in each round)
+        :param max_samples: maximal number of samples of one pixel
+        :param threshold: maximal color difference (in range 0 - 255) that does not require more samples
+        :param seed: seed of the random generator used for jittering samples
+        """
+        if not 1 <= initial_samples <= max_samples:
+            raise ValueError('Number of initial samples must be between 1 and max_samples')
+        self.initial_samples = initial_samples
+        self.max_samples = max_samples
+        self.threshold = threshold
+        self.seed = seed
+
+    def sample_tile(self, camera, tile, image_size, scene, batch=False):
+        """
+        Calculates anti-aliased colors of all pixels in one tile of the image plane.
+        :param camera: camera that renders the image
+        :param tile: tile to render
+        :param image_size: image size as a tuple (width, height)
+        :param scene: scene to render
+        :param batch: if True, samples are traced at once using numpy arrays
+        :return: a tuple of (colors, sample_counts)
+        """
+        width, height = image_size
+        left, top = max(tile.left - 1, 0), max(tile.top - 1, 0)
+        right, bottom = min(tile.right + 1, width), min(tile.bottom + 1, height)
+        y, x = np.mgrid[top:bottom, left:right]
+        inside = ((x >= tile.left) & (x < tile.right) & (y >= tile.top) & (y < tile.bottom)).ravel()
+        x, y = x.ravel(), y.ravel()
+        color_sums = np.zeros((len(x), 3))
+        squared_color_sums = np.zeros((len(x), 3))
+        sample_counts = np.zeros(len(x), dtype=int)
+
+        def add_samples(pixels, count):
+            sample_indices = (sample_counts[pixels, np.newaxis] + np.arange(count)).ravel()
+            pixel_x, pixel_y = np.repeat(x[pixels], count), np.repeat(y[pixels], count)
+            sample_x = pixel_x + _get_random_offsets(self.seed, pixel_x, pixel_y, 2*sample_indices)
+            sample_y = pixel_y + _get_random_offsets(self.seed, pixel_x, pixel_y, 2*sample_indices + 1)
+            colors = camera.trace_image_plane_points(sample_x, sample_y, image_size, scene, batch)
+            # samples are averaged as they will be displayed, so that very bright samples do not dominate
+            colors = np.clip(colors, 0, 255).reshape(len(pixels), count, 3)
+            color_sums[pixels] += colors.sum(axis=1)
+            squared_color_sums[pixels] += (colors**2).sum(axis=1)
+            sample_counts[pixels] += count
+            return color_sums / np.maximum(sample_counts, 1)[:, np.newaxis]
+
+        samples = self.initial_samples
+        mean = add_samples(np.arange(len(x)), samples)
+        neighbour_differences = _get_neighbour_differences(mean.reshape((bottom - top, right - left, 3))).ravel()
+        active = inside & ((_get_deviations(mean, squared_color_sums, sample_counts) > self.threshold) |
+                           (neighbour_differences > self.threshold))
+        while samples < self.max_samples and np.any(active):
+            count = min(self.initial_samples, self.max_samples - samples)
+            pixels = np.flatnonzero(active)
+            mean = add_samples(pixels, count)
+            samples += count
+            active[pixels] = _get_deviations(mean[pixels], squared_color_sums[pixels], sample_counts[pixels]) > \
+                self.threshold
+
+        shape = (tile.bottom - tile.top, tile.right - tile.left)
+        colors = np.rint(mean[inside]).astype(int)
+        return colors.reshape(shape + (3,)), sample_counts[inside].reshape(shape)
+
+
+def _get_random_offsets(seed, x, y, indices):
+    """
+    Calculates pseudo-random numbers in range [0, 1), which depend only on the seed, the pixel and the index
+    of the number (a counter-based generator, SplitMix64 hash).
+    :param x: x indices of pixels as a numpy array
+    :param y: y indices of pixels as a numpy array
+    :param indices: indices of the numbers as a numpy array
+    :return: numpy array of floats
+    """
+    state = np.full(len(indices), seed % 2**64, dtype=np.uint64)
+    for value in (x, y, indices):
+        state ^= np.asarray(value).astype(np.uint64)
+        state += np.uint64(0x9e3779b97f4a7c15)
+        state ^= state >> np.uint64(30)
+        state *= np.uint64(0xbf58476d1ce4e5b9)
+        state ^= state >> np.uint64(27)
+        state *= np.uint64(0x94d049bb133111eb)
+        state ^= state >> np.uint64(31)
+    return (state >> np.uint64(11)).astype(float) / 2**53
+
+
+def _get_deviations(mean, squared_color_sums, sample_counts):
+    """
+    Calculates standard deviations of samples of pixels (the biggest of 3 color channels).
+    """
+    variance = squared_color_sums / sample_counts[:, np.newaxis] - mean**2
+    return np.sqrt(np.maximum(variance, 0)).max(axis=1)
+
+
+def _get_neighbour_differences(colors):
+    """
+    Calculates the biggest color difference between each pixel and its 4 neighbours.
+    :param colors: colors of pixels as a numpy array of shape (height, width, 3)
+    :return: numpy array of shape (height, width)
+    """
+    differences = np.zeros(colors.shape[:2])
+    horizontal = np.abs(colors[:, 1:] - colors[:, :-1]).max(axis=2)
+    vertical = np.abs(colors[1:] - colors[:-1]).max(axis=2)
+    differences[:, 1:] = np.maximum(differences[:, 1:], horizontal)
+    differences[:, :-1] = np.maximum(differences[:, :-1], horizontal)
+    differences[1:] = np.maximum(differences[1:], vertical)
+    differences[:-1] = np.maximum(differences[:-1], vertical)
+    return differences
@@ -1,5 +1,11 @@
 import numpy as np
-from raytracer.LightingModels import whitted_lighting_model
+from raytracer import Tracing, Vectors
+from raytracer.Acceleration import ObjectHierarchy
+from raytracer.Compilation import CompiledScene
+from raytracer.Lights import LightTable
+from raytracer.LightingModels import whitted_lighting_model, batch_whitted_lighting_model
+from raytracer.Materials import MaterialTable
+from raytracer.Objects import BatchCollisionResult, get_collision_distance
 
 
 class Scene:
@@ -15,10 +21,104 @@ class Scene:
         self.lights = []
         self.background_color = (64, 64, 64)
         self.lighting_model = whitted_lighting_model
+        self.batch_lighting_model = batch_whitted_lighting_model
         self.max_recursion_level = 4
+        self.reflection_threshold = 0
+        self.russian_roulette_weight = 0
         self.near = 1e-10
         self.far = 10000
-    
+        self.acceleration_structure = None
+        self.material_table = None
+        self.light_table = None
+        self.last_occluders = {}
+
+    def prepare(self):
+        """
+        Prepares the scene for rendering.
+
+        Builds an acceleration structure for finding collisions, a table of materials used by objects
+        and a table of lights (with a spatial index of point lights, so that shading a point visits only
+        lights that can reach it).
+        This method is called once per render by the camera. Prepared structures are used only as long as
+        the objects and lights lists are the same lists with the same lengths; if a list is replaced
+        or objects or lights are added or removed, the scene uses the lists directly (which is slower) until
+        it is prepared again. Objects and lights changed in place (e.g. a moved sphere or a light replaced
+        at the same index) are not detected, so the scene has to be prepared again after such changes.
+        """
+        self.acceleration_structure = ObjectHierarchy(self.objects)
+        self.refresh_lighting()
+
+    def refresh_lighting(self):
+        """
+        Rebuilds the tables of materials and lights, without rebuilding the acceleration structure.
+
+        This is enough after materials of objects or lights are changed (e.g. before relighting an image),
+        as long as the geometry of the objects stays the same.
+        """
+        self.material_table = None
+        self.material_table = self.get_material_table()
+        self.light_table = None
+        self.light_table = self.get_light_table()
+        self.last_occluders = {}
+
+    @property
+    def acceleration_structure(self):
+        """
+        Acceleration structure built by prepare (None if the objects changed since then).
+        """
+        return self._get_prepared(self._acceleration_structure, self.objects)
+
+    @acceleration_structure.setter
+    def acceleration_structure(self, structure):
+        self._acceleration_structure = structure, self.objects, len(self.objects)
+
+    @property
+    def material_table(self):
+        """
+        Table of materials built by prepare (None if the objects changed since then).
+        """
+        return self._get_prepared(self._material_table, self.objects)
+
+    @material_table.setter
+    def material_table(self, table):
+        self._material_table = table, self.objects, len(self.objects)
+
+    @property
+    def light_table(self):
+        """
+        Table of lights built by prepare (None if the lights changed since then).
+        """
+        return self._get_prepared(self._light_table, self.lights)
+
+    @light_table.setter
+    def light_table(self, table):
+        self._light_table = table, self.lights, len(self.lights)
+
+    @property
+    def last_occluders(self):
+        """
+        Dictionary of objects that blocked the last shadow rays (see check_occlusion), it is cleared
+        when the objects change.
+        """
+        if self._get_prepared(self._last_occluders, self.objects) is None:
+            self.last_occluders = {}
+        return self._last_occluders[0]
+
+    @last_occluders.setter
+    def last_occluders(self, occluders):
+        self._last_occluders = occluders, self.objects, len(self.objects)
+
+    @staticmethod
+    def _get_prepared(prepared, collection):
+        """
+        Returns a prepared value, if the collection it was prepared for has not changed (otherwise None).
+        :param prepared: a tuple of (value, prepared collection, length of the collection)
+        """
+        value, prepared_collection, length = prepared
+        if prepared_collection is collection and length == len(collection):
+            return value
+        return None
+
     def check_collision(self, eye, direction, near=None, far=None):
         """
         Checks if a ray collides with any object on the scene.
@@ -26,28 +126,66 @@ class Scene:
         :param direction: direction of a traced ray (must be normalized)
         :param near: minimal distance of detecting collisions
         :param far: maximal distance of detecting collisions
-        :return: a tuple of (collision point, normal, material) or None, if there is no collision
+        :return: a CollisionResult tuple of (collision point, normal, material, distance) or None, if there is
+        no collision
         """
         if near is None:
             near = self.near
         if far is None:
             far = self.far
+        structure = self.acceleration_structure
+        if structure:
+            return structure.check_collision(eye, direction, near, far)
         collision_result = None
         min_collision_distance = far
         for obj in self.objects:
             result = obj.check_collision(eye, direction, near, min_collision_distance)
             if result:
-                distance = np.linalg.norm(np.subtract(eye, result.point))
+                distance = get_collision_distance(eye, result)
                 if distance < min_collision_distance:
                     collision_result = result
                     min_collision_distance = distance
         return collision_result
     
+    def check_occlusion(self, eye, direction, near=None, far=None, cache_key=None):
+        """
+        Checks if a ray is blocked by any object on the scene.
+
+        This is faster than check_collision, because the search stops at the first object found
+        (not necessarily the closest one) and no collision details are calculated. It is meant
+        for shadow rays.
+        :param eye: beginning of a traced ray
+        :param direction: direction of a traced ray (must be normalized)
+        :param near: minimal distance of detecting collisions
+        :param far: maximal distance of detecting collisions
+        :param cache_key: if given (e.g. a light source), the object that blocked the previous ray
+        with the same key is tested first (neighbouring shadow rays are usually blocked by the same object)
+        :return: True if the ray is blocked, False otherwise
+        """
+        if near is None:
+            near = self.near
+        if far is None:
+            far = self.far
+        last_occluder = self.last_occluders.get(cache_key)
+        if last_occluder is not None and last_occluder.check_occlusion(eye, direction, near, far):
+            return True
+        structure = self.acceleration_structure
+        if structure:
+            occluder = structure.find_occluder(eye, direction, near, far)
+        else:
+            occluder = next((obj for obj in self.objects if obj.check_occlusion(eye, direction, near, far)), None)
+        if occluder is None:
+            return False
+        if cache_key is not None:
+            self.last_occluders[cache_key] = occluder
+        return True
+    
     def trace_ray(self, eye, direction, recursion_level=None):
         """
         Traces a ray of light through a scene and returns its color.
 
         Detects first object that a ray collides with and calculates its color at given point.
+        If the object is reflective, reflected rays are traced iteratively (see Tracing module).
         If there is no collision (or recursion level reached 0), returns background color of the scene.
         :param eye: beginning point of a traced ray
         :param direction: direction of a traced ray (must be normalized)
@@ -57,10 +195,135 @@ class Scene:
         """
         if recursion_level is None:
             recursion_level = self.max_recursion_level
-        if recursion_level == 0:
-            return self.background_color
-        collision_result = self.check_collision(eye, direction, self.near, self.far)
-        if collision_result:
-            return self.lighting_model(self, direction, collision_result, recursion_level)
-        else:
-            return self.background_color
+        return Tracing.trace_ray(self, eye, direction, recursion_level)
+
+    def shade_ray(self, eye, direction, recursion_level):
+        """
+        Calculates the color of the first collision of a ray, without mirror reflections.
+        :param eye: beginning point of a traced ray
+        :param direction: direction of a traced ray (must be normalized)
+        :param recursion_level: recursion level of the ray (greater than 0)
+        :return: a tuple of (color, reflected ray), where reflected ray is a tuple of (eye, direction, reflection
+        factor) or None, if the ray is not reflected
+        """
+        return Tracing.shade_ray(self, eye, direction, recursion_level)
+
+    def compile(self):
+        """
+        Creates a compiled (frozen) copy of the scene, in which objects, materials and lights are stored
+        in packed numpy arrays.
+
+        A compiled scene renders the same images, but it is faster to render with batch=True and much
+        cheaper to copy to worker processes. It does not change when the scene is modified.
+        :return: CompiledScene object
+        """
+        return CompiledScene(self)
+
+    def get_material_table(self):
+        """
+        Creates a table of all materials used by the scene objects.
+
+        Materials are listed in the order of objects, so material indices returned
+        by check_collisions refer to this table.
+        :return: MaterialTable object
+        """
+        if self.material_table:
+            return self.material_table
+        return MaterialTable(material for obj in self.objects for material in obj.materials)
+
+    def get_light_table(self):
+        """
+        Creates a table of all lights of the scene (used by batch lighting models).
+        :return: LightTable object
+        """
+        if self.light_table is not None:
+            return self.light_table
+        return LightTable(self.lights)
+
+    def check_collisions(self, eyes, directions, near=None, far=None):
+        """
+        Checks if many rays collide with any object on the scene.
+        :param eyes: beginnings of traced rays as a numpy array of shape (N, 3) (or a single point shared by all rays)
+        :param directions: directions of traced rays as a numpy array of shape (N, 3) (must be normalized)
+        :param near: minimal distance of detecting collisions (a single value or N values)
+        :param far: maximal distance of detecting collisions (a single value or N values)
+        :return: a tuple of (distances, normals, material indices) (distance is numpy.inf if there is no collision,
+        material index refers to the table returned by get_material_table)
+        """
+        if near is None:
+            near = self.near
+        if far is None:
+            far = self.far
+        structure = self.acceleration_structure
+        if structure:
+            return structure.check_collisions(eyes, directions, near, far)
+        distances = np.full(len(directions), np.inf)
+        normals = np.zeros((len(directions), 3))
+        materials = np.full(len(directions), -1)
+        min_collision_distances = np.minimum(far, distances)
+        material_offset = 0
+        for obj in self.objects:
+            result = obj.check_collisions(eyes, directions, near, min_collision_distances)
+            closer = result.distance < distances
+            distances[closer] = result.distance[closer]
+            normals[closer] = result.normal[closer]
+            materials[closer] = result.material[closer] + material_offset
+            min_collision_distances = np.minimum(far, distances)
+            material_offset += len(obj.materials)
+        return BatchCollisionResult(distances, normals, materials)
+
+    def check_occlusions(self, eyes, directions, near=None, far=None):
+        """
+        Checks if many rays are blocked by any object on the scene.
+
+        This is a counterpart of check_occlusion that operates on numpy arrays.
+        :param eyes: beginnings of traced rays as a numpy array of shape (N, 3) (or a single point shared by all rays)
+        :param directions: directions of traced rays as a numpy array of shape (N, 3) (must be normalized)
+        :param near: minimal distance of detecting collisions (a single value or N values)
+        :param far: maximal distance of detecting collisions (a single value or N values)
+        :return: numpy array of N boolean values (True for blocked rays)
+        """
+        if near is None:
+            near = self.near
+        if far is None:
+            far = self.far
+        structure = self.acceleration_structure
+        if structure:
+            return structure.check_occlusions(eyes, directions, near, far)
+        occluded = np.zeros(len(directions), dtype=bool)
+        for obj in self.objects:
+            rays = np.flatnonzero(~occluded)
+            if not len(rays):
+                break
+            occluded[rays] = obj.check_occlusions(Vectors.select(eyes, rays, 1), directions[rays],
+                                                  Vectors.select(near, rays), Vectors.select(far, rays))
+        return occluded
+
+    def trace_rays(self, eyes, directions, recursion_level=None):
+        """
+        Traces many rays of light through a scene and returns their colors.
+
+        This is a counterpart of trace_ray that operates on numpy arrays, which is much faster than tracing
+        rays one by one.
+        :param eyes: beginnings of traced rays as a numpy array of shape (N, 3) (or a single point shared by all rays)
+        :param directions: directions of traced rays as a numpy array of shape (N, 3) (must be normalized)
+        :param recursion_level: number of times the rays can reflect from any surface to create mirror reflection
+        (if None, the scene's max_recursion_level will be used)
+        :return: colors of given rays of light, as a numpy array of shape (N, 3) (values range from 0 to 255)
+        """
+        if recursion_level is None:
+            recursion_level = self.max_recursion_level
+        return Tracing.trace_rays(self, eyes, directions, recursion_level)
+
+    def shade_rays(self, eyes, directions, recursion_level):
+        """
+        Calculates colors of the first collisions of many rays, without mirror reflections.
+
+        This is a counterpart of shade_ray that operates on numpy arrays.
+        :param eyes: beginnings of traced rays as a numpy array of shape (N, 3) (or a single point shared by all rays)
+        :param directions: directions of traced rays as a numpy array of shape (N, 3) (must be normalized)
+        :param recursion_level: recursion level of the rays (greater than 0)
+        :return: a tuple of (colors, reflected rays), where reflected rays are Rays (see Tracing module)
+        whose indices refer to the given rays and weights are reflection factors
+        """
+        return Tracing.shade_rays(self, eyes, directions, recursion_level)
@@ -0,0 +1,299 @@
+"""
+Contains functions for saving scenes to binary files and loading them.
+
+Scene files use the format described in the Files module (a JSON header followed by packed numpy arrays),
+with the file type identifier RTSCEN01. The header contains the format version and the scene settings
+(background_color, max_recursion_level, reflection_threshold, russian_roulette_weight, near, far).
+It might also contain a camera (position, front, right and up vectors and image_plane_width).
+
+Objects are described by two arrays: object_kind (0 - sphere, 1 - plane, 2 - circle, 3 - triangle mesh)
+and object_slot (index of the object in arrays of its kind), so the order of objects is preserved.
+Parameters of objects of each kind are stored in separate arrays (e.g. sphere_center, sphere_radius),
+and their materials are stored as indices of the material arrays (material_color, material_specular_color,
+material_phong_exponent, material_reflection_factor). Arrays of a triangle mesh are stored under names
+prefixed with mesh<slot>_ (vertices, indices, normals and arrays of the mesh's hierarchy). Lights are
+stored in the arrays of a light table (light_kind, light_color, light_position, light_direction,
+light_max_lighting_distance, see Lights.LightTable).
+
+Only the standard objects, lights and materials can be saved. Lighting models and camera anti-aliasing
+are not saved (loaded scenes use the default ones). Vectors are stored exactly, so a loaded scene renders
+the same images as the saved one.
+"""
+import numpy as np
+from raytracer import Vectors
+from raytracer.Acceleration import BoundingVolumeHierarchy
+from raytracer.Camera import Camera
+from raytracer.Files import load_arrays, save_arrays
+from raytracer.Lights import AMBIENT, POINT, SUN, OTHER, Ambient, LightTable, Point, Sun
+from raytracer.Materials import Material, MaterialTable
+from raytracer.Meshes import TriangleMesh
+from raytracer.Objects import Circle, Plane, Sphere
+from raytracer.Scene import Scene
+
+SCENE_FILE_TYPE = b'RTSCEN01'
+SCENE_FILE_VERSION = 1
+
+SPHERE, PLANE, CIRCLE, MESH = range(4)
+
+_KINDS = {Sphere: SPHERE, Plane: PLANE, Circle: CIRCLE, TriangleMesh: MESH}
+_SETTINGS = ('max_recursion_level', 'reflection_threshold', 'russian_roulette_weight', 'near', 'far')
+_HIERARCHY_ARRAYS = ('node_lower', 'node_upper', 'node_start', 'node_count', 'node_axis', 'node_right')
+
+
+def save_scene(scene, file_name, camera=None):
+    """
+    Saves a scene (and optionally a camera) to a binary file, which can be loaded using load_scene.
+    :param scene: Scene object
+    :param file_name: name of the output file
+    :param camera: camera to save with the scene (might be None)
+    :raises ValueError: if the scene contains objects, lights or materials of unsupported types
+    """
+    header, arrays = pack_scene(scene, camera)
+    save_arrays(file_name, SCENE_FILE_TYPE, header, arrays)
+
+
+def pack_scene(scene, camera=None):
+    """
+    Packs a scene (and optionally a camera) into the header and the arrays of a scene file.
+
+    The same scene always gives the same header and arrays, so they can also be used to compare
+    scenes or to calculate their hashes.
+    :return: a tuple of (header, dictionary of arrays)
+    :raises ValueError: if the scene contains objects, lights or materials of unsupported types
+    """
+    for obj in scene.objects:
+        if type(obj) not in _KINDS:
+            raise ValueError('Objects of type {} cannot be saved'.format(type(obj).__name__))
+    light_table = LightTable(scene.lights)
+    if np.any(light_table.kind == OTHER):
+        raise ValueError('Only ambient, point and sun lights can be saved')
+
+    # equal materials are stored only once, whether they are shared by objects or not
+    material_indices = {}
+    materials = []
+    for obj in scene.objects:
+        for material in obj.materials:
+            if not isinstance(material, Material):
+                raise ValueError('Materials of type {} cannot be saved'.format(type(material).__name__))
+            key = _get_material_key(material)
+            if key not in material_indices:
+                material_indices[key] = len(materials)
+                materials.append(material)
+    material_table = MaterialTable(materials)
+
+    def get_material_index(material):
+        return material_indices[_get_material_key(material)]
+
+    def select(kind):
+        return [obj for obj in scene.objects if _KINDS[type(obj)] == kind]
+
+    kinds = np.array([_KINDS[type(obj)] for obj in scene.objects], dtype=np.int8)
+    slots = np.zeros(len(kinds), dtype=np.int32)
+    for kind in (SPHERE, PLANE, CIRCLE, MESH):
+        slots[kinds == kind] = np.arange(np.count_nonzero(kinds == kind))
+    spheres, planes, circles, meshes = select(SPHERE), select(PLANE), select(CIRCLE), select(MESH)
+    arrays = {
+        'object_kind': kinds,
+        'object_slot': slots,
+        'material_color': material_table.color,
+        'material_specular_color': material_table.specular_color,
+        'material_phong_exponent': material_table.phong_exponent.astype(float),
+        'material_reflection_factor': material_table.reflection_factor,
+        'sphere_center': np.array([sphere.center for sphere in spheres], dtype=float).reshape(-1, 3),
+        'sphere_radius': np.array([sphere.radius for sphere in spheres], dtype=float),
+        'sphere_material': np.array([get_material_index(sphere.material) for sphere in spheres], dtype=np.int32),
+        'plane_position': np.array([plane.position for plane in planes], dtype=float).reshape(-1, 3),
+        'plane_normal': np.array([plane.normal for plane in planes], dtype=float).reshape(-1, 3),
+        'plane_material': np.array([get_material_index(plane.material) for plane in planes], dtype=np.int32),
+        'circle_center': np.array([circle.front_plane.position for circle in circles], dtype=float).reshape(-1, 3),
+        'circle_normal': np.array([circle.front_plane.normal for circle in circles], dtype=float).reshape(-1, 3),
+        'circle_radius': np.array([circle.radius for circle in circles], dtype=float),
+        'circle_material': np.array([[get_material_index(material) for material in circle.materials]
+                                     for circle in circles], dtype=np.int32).reshape(-1, 2),
+        'mesh_material': np.array([get_material_index(mesh.material) for mesh in meshes], dtype=np.int32),
+        'light_kind': light_table.kind.astype(np.int8),
+        'light_color': light_table.color,
+        'light_position': light_table.position,
+        'light_direction': light_table.direction,
+        'light_max_lighting_distance': light_table.max_lighting_distance,
+    }
+    for slot, mesh in enumerate(meshes):
+        prefix = 'mesh{}_'.format(slot)
+        arrays[prefix + 'vertices'] = mesh.vertices
+        arrays[prefix + 'indices'] = mesh.indices
+        if mesh.normals is not None:
+            arrays[prefix + 'normals'] = mesh.normals
+        for name, array in mesh.hierarchy.get_arrays().items():
+            arrays[prefix + 'hierarchy_' + name] = array
+
+    header = {'version': SCENE_FILE_VERSION, 'background_color': [float(c) for c in scene.background_color]}
+    header.update((name, float(getattr(scene, name))) for name in _SETTINGS)
+    header['max_recursion_level'] = int(scene.max_recursion_level)
+    if camera is not None:
+        header['camera'] = {name: [float(c) for c in getattr(camera, name)]
+                            for name in ('position', 'front', 'right', 'up')}
+        header['camera']['image_plane_width'] = float(camera.image_plane_width)
+    return header, arrays
+
+
+def load_scene(file_name):
+    """
+    Loads a scene from a binary file created by save_scene.
+    :param file_name: name of the input file
+    :return: a tuple of (Scene object, Camera object), camera is None if it was not saved
+    :raises ValueError: if the file is not a valid scene file
+    """
+    header, arrays = load_arrays(file_name, SCENE_FILE_TYPE, None)
+    if header.get('version') != SCENE_FILE_VERSION:
+        raise ValueError('{} has an unsupported version: {}'.format(file_name, header.get('version')))
+    try:
+        _validate_arrays(arrays)
+    except ValueError as error:
+        raise ValueError('{} is not a valid scene file: {}'.format(file_name, error))
+    try:
+        scene = Scene()
+        scene.background_color = tuple(_to_number(c) for c in header['background_color'])
+        for name in _SETTINGS:
+            setattr(scene, name, header[name])
+        scene.objects = _load_objects(arrays)
+        scene.lights = _load_lights(arrays)
+        camera = _load_camera(header['camera']) if 'camera' in header else None
+    except (KeyError, TypeError, IndexError) as error:
+        raise ValueError('{} is not a complete scene file ({!r})'.format(file_name, error))
+    return scene, camera
+
+
+def _get_material_key(material):
+    """
+    Returns a key identifying a material by its values, so equal materials have equal keys even if they
+    are separate objects or their vectors have different types (the identity of the material is used
+    if its values are not numbers).
+    """
+    try:
+        return tuple(tuple(np.asarray(value, dtype=float).ravel().tolist()) for value in material)
+    except (TypeError, ValueError):
+        return id(material)
+
+
+def _validate_arrays(arrays):
+    """
+    Checks shapes of the arrays and the values that refer to other arrays.
+    :raises ValueError: if an array is invalid
+    """
+    shapes = {
+        'object_kind': (None,), 'object_slot': (None,),
+        'material_color': (None, 3), 'material_specular_color': (None, 3), 'material_phong_exponent': (None,),
+        'material_reflection_factor': (None,),
+        'sphere_center': (None, 3), 'sphere_radius': (None,), 'sphere_material': (None,),
+        'plane_position': (None, 3), 'plane_normal': (None, 3), 'plane_material': (None,),
+        'circle_center': (None, 3), 'circle_normal': (None, 3), 'circle_radius': (None,), 'circle_material': (None, 2),
+        'mesh_material': (None,),
+        'light_kind': (None,), 'light_color': (None, 3), 'light_position': (None, 3), 'light_direction': (None, 3),
+        'light_max_lighting_distance': (None,),
+    }
+    lengths = {}
+    for name, shape in shapes.items():
+        if name not in arrays:
+            raise ValueError('Array {} is missing'.format(name))
+        array = arrays[name]
+        if array.ndim != len(shape) or array.shape[1:] != shape[1:]:
+            raise ValueError('Array {} has an invalid shape {}'.format(name, array.shape))
+        if not np.all(np.isfinite(array)):
+            raise ValueError('Array {} contains values that are not finite'.format(name))
+        prefix = name.split('_')[0]
+        if lengths.setdefault(prefix, len(array)) != len(array):
+            raise ValueError('Arrays of {} have different lengths'.format(prefix))
+
+    kinds, slots = arrays['object_kind'], arrays['object_slot']
+    for kind, prefix in enumerate(('sphere', 'plane', 'circle', 'mesh')):
+        if not np.array_equal(np.sort(slots[kinds == kind]), np.arange(lengths[prefix])):
+            raise ValueError('Slots of objects do not match arrays of {}s'.format(prefix))
+    if np.any((kinds < SPHERE) | (kinds > MESH)):
+        raise ValueError('Array object_kind contains unknown kinds of objects')
+    for name in ('sphere_material', 'plane_material', 'circle_material', 'mesh_material'):
+        if np.any((arrays[name] < 0) | (arrays[name] >= lengths['material'])):
+            raise ValueError('Array {} refers to materials that do not exist'.format(name))
+    if np.any((arrays['light_kind'] < AMBIENT) | (arrays['light_kind'] > SUN)):
+        raise ValueError('Array light_kind contains unknown kinds of lights')
+    for name in ('plane_normal', 'circle_normal', 'light_direction'):
+        vectors = arrays[name] if name != 'light_direction' else arrays[name][arrays['light_kind'] == SUN]
+        if np.any(Vectors.norm(vectors) == 0):
+            raise ValueError('Array {} contains zero vectors'.format(name))
+    for slot in range(lengths['mesh']):
+        prefix = 'mesh{}_'.format(slot)
+        for name in ('vertices', 'indices') + tuple('hierarchy_' + name for name in _HIERARCHY_ARRAYS):
+            if prefix + name not in arrays:
+                raise ValueError('Array {} is missing'.format(prefix + name))
+        vertices, indices = arrays[prefix + 'vertices'], arrays[prefix + 'indices']
+        if vertices.shape[1:] != (3,) or indices.shape[1:] != (3,):
+            raise ValueError('Arrays of mesh {} have invalid shapes'.format(slot))
+        if np.any((indices < 0) | (indices >= len(vertices))):
+            raise ValueError('Array {}indices refers to vertices that do not exist'.format(prefix))
+
+
+def _load_objects(arrays):
+    materials = [Material(tuple(_to_number(c) for c in color), tuple(_to_number(c) for c in specular_color),
+                          _to_number(phong_exponent), _to_number(reflection_factor))
+                 for color, specular_color, phong_exponent, reflection_factor in zip(
+                     arrays['material_color'].tolist(), arrays['material_specular_color'].tolist(),
+                     arrays['material_phong_exponent'].tolist(), arrays['material_reflection_factor'].tolist())]
+
+    spheres = [Sphere(center, radius, materials[material]) for center, radius, material in zip(
+        arrays['sphere_center'], arrays['sphere_radius'].tolist(), arrays['sphere_material'].tolist())]
+    planes = []
+    for position, normal, material in zip(arrays['plane_position'], arrays['plane_normal'],
+                                          arrays['plane_material'].tolist()):
+        plane = Plane(position, normal, materials[material])
+        # normals are already normalized, normalizing them again might change their last bits
+        plane.normal = normal.copy()
+        planes.append(plane)
+    circles = []
+    for center, normal, radius, (front_material, back_material) in zip(
+            arrays['circle_center'], arrays['circle_normal'], arrays['circle_radius'].tolist(),
+            arrays['circle_material'].tolist()):
+        circle = Circle(center, normal, radius, materials[front_material], materials[back_material])
+        circle.front_plane.normal = normal.copy()
+        circle.back_plane.normal = -normal
+        circles.append(circle)
+    meshes = []
+    for slot, material in enumerate(arrays['mesh_material'].tolist()):
+        prefix = 'mesh{}_'.format(slot)
+        indices = arrays[prefix + 'indices']
+        hierarchy = BoundingVolumeHierarchy.from_arrays(
+            {name: arrays[prefix + 'hierarchy_' + name] for name in _HIERARCHY_ARRAYS}, np.arange(len(indices)))
+        meshes.append(TriangleMesh(arrays[prefix + 'vertices'], indices, arrays.get(prefix + 'normals'),
+                                   materials[material], hierarchy))
+
+    objects_of_kinds = (spheres, planes, circles, meshes)
+    return [objects_of_kinds[kind][slot] for kind, slot in zip(arrays['object_kind'].tolist(),
+                                                               arrays['object_slot'].tolist())]
+
+
+def _load_lights(arrays):
+    lights = []
+    for kind, color, position, direction, max_lighting_distance in zip(
+            arrays['light_kind'].tolist(), arrays['light_color'], arrays['light_position'],
+            arrays['light_direction'], arrays['light_max_lighting_distance'].tolist()):
+        if kind == AMBIENT:
+            lights.append(Ambient(color))
+        elif kind == POINT:
+            lights.append(Point(color, position, max_lighting_distance))
+        else:
+            light = Sun(color, direction)
+            light.direction = direction.copy()
+            lights.append(light)
+    return lights
+
+
+def _load_camera(parameters):
+    position = np.array(parameters['position'])
+    front, right, up = (np.array(parameters[name]) for name in ('front', 'right', 'up'))
+    camera = Camera(position, position + front, up)
+    camera.front, camera.right, camera.up = front, right, up
+    camera.image_plane_width = parameters['image_plane_width']
+    return camera
+
+
+def _to_number(value):
+    # integral values (e.g. colors of materials) are restored as integers, so loaded materials equal saved ones
+    return int(value) if float(value).is_integer() else value
@@ -0,0 +1,287 @@
+"""
+Contains render sessions, which render many images using one pool of worker processes.
+
+Camera.render_image starts worker processes and sends the scene to them on every call, which takes
+longer than rendering a small image. A session starts its workers once. Scenes are uploaded to the session
+once as well: an uploaded scene is prepared, pickled and stored in shared memory, and each worker
+loads it from there the first time it renders a tile of that scene. Workers keep loaded scenes
+in a cache, so render tasks contain only a scene id, a camera and a tile.
+"""
+import asyncio
+import contextlib
+import itertools
+import os
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import resource_tracker
+from multiprocessing.pool import Pool
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from PIL import Image
+from raytracer.Camera import _calculate_tile_pixels, _render_tile
+from raytracer.Framebuffer import SharedFramebuffer, get_tiles, order_tiles
+
+_MAX_CACHED_SCENES = 8
+
+_worker_scenes = OrderedDict()
+
+
+class _SceneRegistry:
+    """
+    Stores scenes uploaded to a session.
+    """
+    def __init__(self):
+        # workers have to share the resource tracker of this process, otherwise shared memory of scenes
+        # would be released by trackers of the workers
+        resource_tracker.ensure_running()
+        self.scenes = {}
+        self._scene_ids = itertools.count()
+
+    def upload_scene(self, scene, scene_id=None):
+        """
+        Uploads a scene to the session (replacing the scene with the same id, if there is one).
+        :param scene: scene to upload (Scene or CompiledScene object)
+        :param scene_id: id of the scene (if None, a new id is generated)
+        :return: id of the scene
+        """
+        if scene_id is None:
+            scene_id = next(self._scene_ids)
+            while scene_id in self.scenes:
+                scene_id = next(self._scene_ids)
+        uploaded_scene = _UploadedScene(scene)
+        self.remove_scene(scene_id)
+        self.scenes[scene_id] = uploaded_scene
+        return scene_id
+
+    def remove_scene(self, scene_id):
+        """
+        Removes an uploaded scene from the session (if there is no scene with given id, nothing happens).
+        The scene should not be removed while it is being rendered.
+        """
+        uploaded_scene = self.scenes.pop(scene_id, None)
+        if uploaded_scene is not None:
+            uploaded_scene.release()
+
+
+class RenderSession(_SceneRegistry):
+    """
+    Represents a long-lived pool of worker processes with uploaded scenes.
+
+    A session should be closed when it is no longer needed (it can be used as a context manager).
+    Uploaded scenes are snapshots: if a scene is modified, it has to be uploaded again.
+    """
+    def __init__(self, processes=None):
+        """
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        """
+        super().__init__()
+        self.pool = Pool(processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def render_image(self, scene_id, camera, image_size=(128, 72), file_name=None, batch=False, tile_size=(64, 64),
+                     stats=None, tile_costs=None):
+        """
+        Creates an image of an uploaded scene (see Camera.render_image).
+
+        This method can be called from many threads at once.
+        :param scene_id: id of an uploaded scene
+        :param camera: camera used to render the image
+        :param image_size: image size as a tuple (width, height)
+        :param file_name: name of the output file (if None, no file will be generated)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param stats: RenderStats object (see Statistics module), if given, statistics of the render
+        are added to it
+        :param tile_costs: dictionary {tile: expected cost} (e.g. tile_times of RenderStats of a previous render),
+        expensive tiles are rendered first (see Framebuffer.order_tiles)
+        :return: generated image as PIL Image object
+        """
+        scene_key = self.scenes[scene_id].key
+        framebuffer = SharedFramebuffer(image_size)
+        try:
+            render_tile = partial(_render_session_tile, scene_key=scene_key, camera=camera, image_size=image_size,
+                                  framebuffer=framebuffer, batch=batch, collect_stats=stats is not None)
+            tile_stats = self.pool.map(render_tile, order_tiles(get_tiles(image_size, tile_size), tile_costs),
+                                       chunksize=1)
+            rendered_image = framebuffer.to_image()
+        finally:
+            framebuffer.unlink()
+
+        if stats is not None:
+            for single_tile_stats in tile_stats:
+                stats.merge(single_tile_stats)
+        if file_name:
+            rendered_image.save(file_name)
+        return rendered_image
+
+    def render_tiles(self, scene_id, camera, image_size=(128, 72), tile_size=(64, 64), batch=False):
+        """
+        Renders an image of an uploaded scene tile by tile (see Camera.render_tiles).
+        :return: generator of tuples (tile, colors), where colors is a numpy array of shape
+        (tile height, tile width, 3) with 8-bit unsigned values
+        """
+        scene_key = self.scenes[scene_id].key
+        tile_pixels = partial(_calculate_session_tile_pixels, scene_key=scene_key, camera=camera,
+                              image_size=image_size, batch=batch)
+        yield from self.pool.imap_unordered(tile_pixels, get_tiles(image_size, tile_size))
+
+    def close(self):
+        """
+        Waits for all started renders, stops the worker processes and releases all uploaded scenes.
+        """
+        self.pool.close()
+        self.pool.join()
+        for scene_id in list(self.scenes):
+            self.remove_scene(scene_id)
+
+
+class AsyncRenderSession(_SceneRegistry):
+    """
+    Represents a render session for asyncio programs (e.g. web services).
+
+    Renders do not block the event loop: tiles are rendered by worker processes and awaited asynchronously.
+    Only a few tiles of a render are sent to the workers at once and the next ones are sent when the finished
+    tiles are consumed, so cancelling a render (cancelling the task that awaits it or closing the iterator
+    of its tiles) leaves little work for the workers: tiles that have not been started are cancelled,
+    but tiles that are already being rendered cannot be interrupted, so they are finished and their results
+    are discarded. The number of renders running at once is limited, other renders wait for their turn.
+    """
+    def __init__(self, processes=None, max_renders=1):
+        """
+        :param processes: number of worker processes (if None, the number of CPUs is used)
+        :param max_renders: maximal number of renders running at once
+        """
+        super().__init__()
+        self.processes = processes or os.cpu_count()
+        self.executor = ProcessPoolExecutor(self.processes)
+        self.render_slots = asyncio.Semaphore(max_renders)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def render_image(self, scene_id, camera, image_size=(128, 72), file_name=None, batch=False,
+                           tile_size=(64, 64), progress=None):
+        """
+        Creates an image of an uploaded scene (see Camera.render_image).
+
+        If the render is cancelled, tiles that are being rendered by workers at that moment (at most one
+        per worker) are still finished, so the next render may wait for them.
+        :param scene_id: id of an uploaded scene
+        :param camera: camera used to render the image
+        :param image_size: image size as a tuple (width, height)
+        :param file_name: name of the output file (if None, no file will be generated)
+        :param batch: if True, all pixels of a tile are traced at once using numpy arrays (much faster)
+        :param tile_size: maximal size of a tile rendered by one task, as a tuple (width, height)
+        :param progress: function called with a fraction of rendered tiles (from 0 to 1) after each tile
+        :return: generated image as PIL Image object
+        """
+        width, height = image_size
+        pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        tile_count = len(get_tiles(image_size, tile_size))
+        rendered_tile_count = 0
+        async with contextlib.aclosing(self.render_tiles(scene_id, camera, image_size, tile_size, batch)) as tiles:
+            async for tile, colors in tiles:
+                pixels[tile.top:tile.bottom, tile.left:tile.right] = colors
+                rendered_tile_count += 1
+                if progress:
+                    progress(rendered_tile_count / tile_count)
+        rendered_image = Image.fromarray(pixels)
+        if file_name:
+            rendered_image.save(file_name)
+        return rendered_image
+
+    async def render_tiles(self, scene_id, camera, image_size=(128, 72), tile_size=(64, 64), batch=False):
+        """
+        Renders an image of an uploaded scene tile by tile (see Camera.render_tiles).
+
+        This is an asynchronous generator, which should be closed when it is not consumed until the end
+        (e.g. using contextlib.aclosing), so that its remaining tiles are cancelled at once (tiles that
+        have already been started are finished by the workers, but they are not yielded).
+        :return: asynchronous generator of tuples (tile, colors), where colors is a numpy array of shape
+        (tile height, tile width, 3) with 8-bit unsigned values
+        """
+        scene_key = self.scenes[scene_id].key
+        loop = asyncio.get_running_loop()
+        async with self.render_slots:
+            tiles = iter(get_tiles(image_size, tile_size))
+            pending = set()
+            try:
+                while True:
+                    for tile in itertools.islice(tiles, 2*self.processes - len(pending)):
+                        pending.add(loop.run_in_executor(self.executor, _calculate_session_tile_pixels, tile,
+                                                         scene_key, camera, image_size, batch))
+                    if not pending:
+                        return
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    async def close(self):
+        """
+        Cancels tiles that have not been started, stops the worker processes and releases all uploaded scenes.
+        """
+        await asyncio.to_thread(self.executor.shutdown, cancel_futures=True)
+        for scene_id in list(self.scenes):
+            self.remove_scene(scene_id)
+
+
+class _UploadedScene:
+    """
+    Represents a prepared and pickled scene stored in shared memory.
+    """
+    def __init__(self, scene):
+        scene.prepare()
+        data = pickle.dumps(scene, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared_memory = SharedMemory(create=True, size=len(data))
+        self.shared_memory.buf[:len(data)] = data
+        self.size = len(data)
+
+    @property
+    def key(self):
+        # shared memory names are unique, so a scene uploaded again never hits a stale cache entry
+        return self.shared_memory.name, self.size
+
+    def release(self):
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
+def _get_scene(scene_key):
+    """
+    Returns a scene from the worker's cache (loading it from shared memory, if needed).
+    """
+    scene = _worker_scenes.get(scene_key)
+    if scene is not None:
+        _worker_scenes.move_to_end(scene_key)
+        return scene
+    name, size = scene_key
+    shared_memory = SharedMemory(name=name)
+    try:
+        scene = pickle.loads(shared_memory.buf[:size])
+    finally:
+        shared_memory.close()
+    _worker_scenes[scene_key] = scene
+    if len(_worker_scenes) > _MAX_CACHED_SCENES:
+        _worker_scenes.popitem(last=False)
+    return scene
+
+
+def _render_session_tile(tile, scene_key, camera, image_size, framebuffer, batch, collect_stats):
+    return _render_tile(tile, camera, image_size, _get_scene(scene_key), framebuffer, batch, collect_stats)
+
+
+def _calculate_session_tile_pixels(tile, scene_key, camera, image_size, batch):
+    return _calculate_tile_pixels(tile, camera, image_size, _get_scene(scene_key), batch)
@@ -0,0 +1,202 @@
+"""
+Contains tools for collecting statistics of renders.
+
+Statistics are collected by instrumented copies of scenes (see RenderStats.instrument), so rendering
+without statistics runs exactly the same code as before and has no overhead at all.
+"""
+import copy
+import time
+from collections import Counter
+import numpy as np
+from PIL import Image
+
+
+class RenderStats:
+    """
+    Represents statistics of a render.
+
+    Rays are counted by depth: depth 0 means primary rays (traced from the camera), depth 1 means
+    rays reflected once, etc. Shadow rays are counted separately. Intersection tests are counted by
+    the type of tested objects (a test of one ray against one object counts as one test, even if the
+    object has its own internal structure, e.g. a triangle mesh). Compiled scenes test many objects
+    at once, so their intersection tests are not counted.
+
+    Times are exclusive (time spent in nested sections is not included in the outer section):
+    'collisions' is time spent finding the closest collisions of rays, 'shadow rays' is time spent
+    checking if points are illuminated, 'lighting' is the remaining time spent in the lighting model
+    and 'camera' is the remaining time of rendering tiles (generating rays, writing pixels).
+    Times are summed across all worker processes, so they are CPU times rather than wall times.
+    """
+    def __init__(self):
+        self.rays = Counter()
+        self.shadow_rays = 0
+        self.intersection_tests = Counter()
+        self.times = Counter()
+        self.tile_times = {}
+        self._sections = []
+        self._section_start = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sections'] = []
+        return state
+
+    @property
+    def primary_rays(self):
+        return self.rays[0]
+
+    @property
+    def total_rays(self):
+        """
+        Number of all traced rays (primary, reflected and shadow rays).
+        """
+        return sum(self.rays.values()) + self.shadow_rays
+
+    def merge(self, other):
+        """
+        Adds statistics collected by another object (e.g. in another process) to this object.
+        """
+        self.rays.update(other.rays)
+        self.shadow_rays += other.shadow_rays
+        self.intersection_tests.update(other.intersection_tests)
+        self.times.update(other.times)
+        self.tile_times.update(other.tile_times)
+
+    def measure_tile(self, tile, render):
+        """
+        Renders a tile and measures the time of rendering it.
+        :param tile: rendered tile
+        :param render: function without arguments that renders the tile
+        :return: value returned by the render function
+        """
+        start = time.perf_counter()
+        try:
+            return self._measure('camera', render)
+        finally:
+            self.tile_times[tile] = time.perf_counter() - start
+
+    def instrument(self, scene):
+        """
+        Creates a copy of a prepared scene that collects statistics in this object.
+
+        The copy shares objects, lights and the acceleration structure with the original scene,
+        so creating it is cheap.
+        :param scene: prepared or compiled scene (see Scene.prepare and Scene.compile)
+        :return: instrumented scene
+        """
+        instrumented_scene = copy.copy(scene)
+        structure = getattr(scene, 'acceleration_structure', None)
+        if structure is not None:
+            structure = copy.copy(structure)
+            structure.unbounded_objects = [(index, _CountingObject(obj, self.intersection_tests))
+                                           for index, obj in structure.unbounded_objects]
+            structure.bounded_objects = [(index, _CountingObject(obj, self.intersection_tests))
+                                         for index, obj in structure.bounded_objects]
+            # prepared structures of a scene are valid only for its objects list, so the list is replaced first
+            instrumented_scene.objects = [_CountingObject(obj, self.intersection_tests) for obj in scene.objects]
+            instrumented_scene.acceleration_structure = structure
+            instrumented_scene.material_table = scene.material_table
+            instrumented_scene.last_occluders = {}
+
+        shade_ray, shade_rays = getattr(instrumented_scene, 'shade_ray', None), instrumented_scene.shade_rays
+        max_recursion_level = scene.max_recursion_level
+
+        def count_ray(eye, direction, recursion_level):
+            self.rays[max_recursion_level - recursion_level] += 1
+            return shade_ray(eye, direction, recursion_level)
+
+        def count_rays(eyes, directions, recursion_level):
+            self.rays[max_recursion_level - recursion_level] += len(directions)
+            return shade_rays(eyes, directions, recursion_level)
+
+        def count_shadow_rays(check_occlusion, count):
+            def wrapper(eyes, directions, *args, **kwargs):
+                self.shadow_rays += count(directions)
+                return self._measure('shadow rays', check_occlusion, eyes, directions, *args, **kwargs)
+            return wrapper
+
+        if shade_ray is not None:
+            instrumented_scene.shade_ray = count_ray
+        instrumented_scene.shade_rays = count_rays
+        instrumented_scene.check_collision = self._timed('collisions', instrumented_scene.check_collision)
+        instrumented_scene.check_collisions = self._timed('collisions', instrumented_scene.check_collisions)
+        instrumented_scene.check_occlusion = count_shadow_rays(instrumented_scene.check_occlusion, lambda d: 1)
+        instrumented_scene.check_occlusions = count_shadow_rays(instrumented_scene.check_occlusions, len)
+        if hasattr(scene, 'lighting_model'):
+            instrumented_scene.lighting_model = self._timed('lighting', scene.lighting_model)
+        instrumented_scene.batch_lighting_model = self._timed('lighting', scene.batch_lighting_model)
+        return instrumented_scene
+
+    def get_tile_cost_map(self):
+        """
+        Creates a map of rendering costs of tiles.
+        :return: numpy array of shape (height, width) with the average rendering time of a pixel
+        (in seconds) in each pixel of rendered tiles
+        """
+        width = max((tile.right for tile in self.tile_times), default=0)
+        height = max((tile.bottom for tile in self.tile_times), default=0)
+        cost_map = np.zeros((height, width))
+        for tile, tile_time in self.tile_times.items():
+            cost_map[tile.top:tile.bottom, tile.left:tile.right] = \
+                tile_time / ((tile.right - tile.left) * (tile.bottom - tile.top))
+        return cost_map
+
+    def get_heatmap(self):
+        """
+        Creates an image showing rendering costs of tiles.
+
+        The most expensive tile is white, cheaper tiles are yellow, red and black.
+        :return: PIL Image object
+        """
+        cost_map = self.get_tile_cost_map()
+        cost = cost_map / cost_map.max() if cost_map.size and cost_map.max() > 0 else cost_map
+        colors = np.clip(np.stack((3*cost, 3*cost - 1, 3*cost - 2), axis=-1), 0, 1)
+        return Image.fromarray(np.uint8(colors * 255))
+
+    def _timed(self, section, function):
+        return lambda *args, **kwargs: self._measure(section, function, *args, **kwargs)
+
+    def _measure(self, section, function, *args, **kwargs):
+        """
+        Calls a function and adds the time of the call to a section (pausing the time of the outer section).
+        """
+        now = time.perf_counter()
+        if self._sections:
+            self.times[self._sections[-1]] += now - self._section_start
+        self._sections.append(section)
+        self._section_start = now
+        try:
+            return function(*args, **kwargs)
+        finally:
+            now = time.perf_counter()
+            self.times[self._sections.pop()] += now - self._section_start
+            self._section_start = now
+
+
+class _CountingObject:
+    """
+    Wraps a scene object and counts intersection tests of the object.
+    """
+    def __init__(self, obj, counter):
+        self.obj = obj
+        self.counter = counter
+        self.type_name = type(obj).__name__
+
+    def __getattr__(self, name):
+        return getattr(self.obj, name)
+
+    def check_collision(self, eye, direction, near, far):
+        self.counter[self.type_name] += 1
+        return self.obj.check_collision(eye, direction, near, far)
+
+    def check_occlusion(self, eye, direction, near, far):
+        self.counter[self.type_name] += 1
+        return self.obj.check_occlusion(eye, direction, near, far)
+
+    def check_collisions(self, eyes, directions, near, far):
+        self.counter[self.type_name] += len(directions)
+        return self.obj.check_collisions(eyes, directions, near, far)
+
+    def check_occlusions(self, eyes, directions, near, far):
+        self.counter[self.type_name] += len(directions)
+        return self.obj.check_occlusions(eyes, directions, near, far)
@@ -0,0 +1,206 @@
+"""
+Contains functions for tracing rays of light through scenes.
+
+Rays are traced iteratively, generation by generation. A scene shades collision points of a generation
+of rays (see Scene.shade_rays), which gives their colors without mirror reflections and the rays
+reflected from reflective surfaces. Reflected rays form the next generation, until there are no more rays
+or the recursion level is reached (the last generation gets the background color of the scene).
+
+Each ray carries a weight: the product of reflection factors of all surfaces it was reflected from.
+The color of a ray is multiplied by its weight before it is added to the color of its primary ray.
+Two attributes of a scene limit tracing of rays that contribute little to the image:
+
+- reflection_threshold: reflected rays with a lower weight are not traced at all,
+- russian_roulette_weight: reflected rays with a lower weight are traced only with probability
+  weight / russian_roulette_weight, and the weight of traced rays is raised to russian_roulette_weight
+  (so the expected color of a pixel does not change). Random numbers are derived from origins of rays,
+  so rendering the same image twice gives the same result.
+"""
+from collections import namedtuple
+import numpy as np
+from raytracer import Vectors
+from raytracer.LightingModels import _reflection
+from raytracer.Objects import CollisionResult
+
+# a generation of rays (indices refer to the colors that the rays contribute to)
+Rays = namedtuple('Rays', 'indices eyes directions weights')
+
+
+def trace_ray(scene, eye, direction, recursion_level):
+    """
+    Traces a ray of light and all its reflections (see Scene.trace_ray).
+    :return: color of the ray as a tuple (R, G, B)
+    """
+    eye, direction = Vectors.vec3(eye), Vectors.vec3(direction)
+    red = green = blue = 0.0
+    weight = 1.0
+    while recursion_level > 0:
+        (r, g, b), reflected_ray = scene.shade_ray(eye, direction, recursion_level)
+        red, green, blue = red + weight*r, green + weight*g, blue + weight*b
+        if reflected_ray is None:
+            return int(red), int(green), int(blue)
+        eye, direction, reflection_factor = reflected_ray
+        weight *= reflection_factor
+        if weight < scene.reflection_threshold:
+            return int(red), int(green), int(blue)
+        if weight < scene.russian_roulette_weight:
+            if _get_random_numbers(eye)[0] * scene.russian_roulette_weight >= weight:
+                return int(red), int(green), int(blue)
+            weight = scene.russian_roulette_weight
+        recursion_level -= 1
+    r, g, b = scene.background_color
+    return int(red + weight*r), int(green + weight*g), int(blue + weight*b)
+
+
+def shade_ray(scene, eye, direction, recursion_level):
+    """
+    Finds the collision of a ray and calculates its color without mirror reflections (see Scene.shade_ray).
+    :return: a tuple of (color, reflected ray), where reflected ray is a tuple of (eye, direction, reflection factor)
+    or None, if the ray is not reflected
+    """
+    collision_result = scene.check_collision(eye, direction, scene.near, scene.far)
+    if not collision_result:
+        return scene.background_color, None
+    color = scene.lighting_model(scene, direction, collision_result, recursion_level)
+    point, normal, material = collision_result[:3]
+    if material.reflection_factor > 0:
+        return color, (point, _reflection(direction, normal), material.reflection_factor)
+    return color, None
+
+
+def trace_rays(scene, eyes, directions, recursion_level):
+    """
+    Traces many rays of light and all their reflections (see Scene.trace_rays).
+    :return: colors of the rays as a numpy array of shape (N, 3) with integer values
+    """
+    colors = np.zeros((len(directions), 3))
+    add_ray_colors(scene, colors, Rays(np.arange(len(directions)), eyes, directions, np.ones(len(directions))),
+                   recursion_level)
+    return colors.astype(int)
+
+
+def shade_rays(scene, eyes, directions, recursion_level):
+    """
+    Finds collisions of many rays and calculates their colors without mirror reflections (see Scene.shade_rays).
+    :return: a tuple of (colors, reflected rays), where colors is a numpy array of shape (N, 3) with integer values
+    and reflected rays are Rays whose indices refer to the given rays and weights are reflection factors
+    """
+    colors = np.empty((len(directions), 3), dtype=int)
+    colors[:] = scene.background_color
+    distances, normals, materials = scene.check_collisions(eyes, directions, scene.near, scene.far)
+    hits = distances < np.inf
+    hit_eyes = Vectors.select(eyes, hits, 1)
+    points = hit_eyes + directions[hits]*distances[hits, np.newaxis]
+    collision_result = CollisionResult(points, normals[hits], materials[hits], distances[hits])
+    if np.any(hits):
+        colors[hits] = scene.batch_lighting_model(scene, directions[hits], collision_result, recursion_level)
+    return colors, get_reflected_rays(scene, directions[hits], collision_result, np.flatnonzero(hits))
+
+
+def get_reflected_rays(scene, directions, collision_result, indices):
+    """
+    Creates rays reflected from reflective surfaces at collision points.
+    :param scene: scene that is being rendered
+    :param directions: directions of rays as a numpy array of shape (N, 3)
+    :param collision_result: a tuple of (collision_points, normal_vectors, material_indices) of the rays
+    :param indices: indices of the rays (copied to the reflected rays)
+    :return: Rays object, with reflection factors as weights
+    """
+    points, normals, materials = collision_result[:3]
+    reflection_factors = scene.get_material_table().reflection_factor[materials]
+    reflective = reflection_factors > 0
+    return Rays(indices[reflective], points[reflective],
+                Vectors.reflection(directions[reflective], normals[reflective]), reflection_factors[reflective])
+
+
+def add_ray_colors(scene, colors, rays, recursion_level):
+    """
+    Traces a generation of rays and all their reflections, and adds their weighted colors to colors.
+    :param scene: scene that is being rendered
+    :param colors: numpy array of float values of shape (M, 3) (indices of rays refer to it)
+    :param rays: Rays object
+    :param recursion_level: recursion level of the rays
+    """
+    while len(rays.indices):
+        if recursion_level == 0:
+            colors[rays.indices] += rays.weights[:, np.newaxis] * np.asarray(scene.background_color)
+            return
+        ray_colors, reflected_rays = scene.shade_rays(rays.eyes, rays.directions, recursion_level)
+        colors[rays.indices] += rays.weights[:, np.newaxis] * ray_colors
+        rays = continue_rays(scene, rays, reflected_rays)
+        recursion_level -= 1
+
+
+def continue_rays(scene, rays, reflected_rays):
+    """
+    Creates the next generation of rays from rays reflected from a generation of rays.
+
+    Weights of the reflected rays are multiplied by weights of the rays they were reflected from,
+    and rays contributing too little are dropped (see module description).
+    :param scene: scene that is being rendered
+    :param rays: Rays object
+    :param reflected_rays: Rays object, whose indices refer to the rays
+    :return: Rays object, whose indices are the same as indices of the rays
+    """
+    weights = rays.weights[reflected_rays.indices] * reflected_rays.weights
+    continued, weights = _select_continued_rays(scene, weights, reflected_rays.eyes)
+    return Rays(rays.indices[reflected_rays.indices][continued], reflected_rays.eyes[continued],
+                reflected_rays.directions[continued], weights[continued])
+
+
+def count_collisions(scene, eyes, directions, recursion_level):
+    """
+    Counts collisions of many rays and all their reflections, without calculating their colors.
+
+    It is much faster than tracing the rays, and it is used to estimate costs of rendering parts of an image.
+    :param scene: prepared scene
+    :param eyes: beginnings of the rays as a numpy array of shape (N, 3) (or a single point shared by all rays)
+    :param directions: directions of the rays as a numpy array of shape (N, 3)
+    :param recursion_level: recursion level of the rays
+    :return: numpy array of N integer values
+    """
+    counts = np.zeros(len(directions), dtype=int)
+    rays = Rays(np.arange(len(directions)), eyes, directions, np.ones(len(directions)))
+    while len(rays.indices) and recursion_level > 0:
+        distances, normals, materials = scene.check_collisions(rays.eyes, rays.directions, scene.near, scene.far)
+        hits = distances < np.inf
+        counts[rays.indices[hits]] += 1
+        points = Vectors.select(rays.eyes, hits, 1) + rays.directions[hits]*distances[hits, np.newaxis]
+        reflected_rays = get_reflected_rays(scene, rays.directions[hits],
+                                            CollisionResult(points, normals[hits], materials[hits]),
+                                            np.flatnonzero(hits))
+        rays = continue_rays(scene, rays, reflected_rays)
+        recursion_level -= 1
+    return counts
+
+
+def _select_continued_rays(scene, weights, eyes):
+    """
+    Decides which reflected rays should be traced (using the threshold and Russian roulette of the scene).
+    :return: a tuple of (numpy array of boolean values, new weights)
+    """
+    continued = weights >= scene.reflection_threshold
+    if scene.russian_roulette_weight > 0:
+        gambled = np.flatnonzero(continued & (weights < scene.russian_roulette_weight))
+        continued[gambled] = _get_random_numbers(eyes[gambled]) * scene.russian_roulette_weight < weights[gambled]
+        weights = weights.copy()
+        weights[gambled] = scene.russian_roulette_weight
+    return continued, weights
+
+
+def _get_random_numbers(points):
+    """
+    Calculates pseudo-random numbers from range [0, 1) by hashing bits of coordinates of points.
+
+    Coordinates are rounded to single precision first, because collision points found by scalar
+    and batch methods might differ in the last bits.
+    """
+    bits = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3).view(np.uint32).astype(np.uint64)
+    hashes = bits[:, 0] | (bits[:, 1] << np.uint64(32))
+    hashes ^= bits[:, 2] * np.uint64(0x9e3779b97f4a7c15)
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return (hashes >> np.uint64(11)) * 2.0**-53
@@ -0,0 +1,119 @@
+"""
+Contains helper functions for operating on many vectors at once.
+
+Vectors passed to these functions are numpy arrays with 3 values in the last
+dimension, so a single vector has a shape (3,) and N vectors have a shape (N, 3).
+
+Single rays are traced one by one, and creating tiny numpy arrays for them costs more than
+the calculations themselves. The scalar tracing path uses Vec3 instead: a tuple of 3 Python floats
+that also supports basic vector arithmetic (so code written for numpy vectors still works with it).
+Hot scalar methods unpack Vec3 into floats and perform the same operations, in the same order,
+as their numpy counterparts, so both paths give identical results.
+"""
+import numpy as np
+
+
+class Vec3(tuple):
+    """
+    Represents a single vector as a tuple of 3 floats.
+
+    Adding and subtracting tuples, multiplying and dividing by numbers and negating work as for vectors
+    (not as for tuples). Operations with numpy arrays are handled by numpy (and give numpy arrays).
+    """
+    __slots__ = ()
+
+    def __add__(self, other):
+        if isinstance(other, tuple):
+            return Vec3((self[0] + other[0], self[1] + other[1], self[2] + other[2]))
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, tuple):
+            return Vec3((self[0] - other[0], self[1] - other[1], self[2] - other[2]))
+        return NotImplemented
+
+    def __rsub__(self, other):
+        if isinstance(other, tuple):
+            return Vec3((other[0] - self[0], other[1] - self[1], other[2] - self[2]))
+        return NotImplemented
+
+    def __mul__(self, other):
+        if isinstance(other, (tuple, np.ndarray)):
+            return NotImplemented
+        return Vec3((self[0]*other, self[1]*other, self[2]*other))
+
+    def __rmul__(self, other):
+        if isinstance(other, (tuple, np.ndarray)):
+            return NotImplemented
+        return Vec3((other*self[0], other*self[1], other*self[2]))
+
+    def __truediv__(self, other):
+        if isinstance(other, (tuple, np.ndarray)):
+            return NotImplemented
+        return Vec3((self[0]/other, self[1]/other, self[2]/other))
+
+    def __neg__(self):
+        return Vec3((-self[0], -self[1], -self[2]))
+
+
+def vec3(vector):
+    """
+    Converts a vector (e.g. a numpy array) to a Vec3 (a Vec3 is returned unchanged).
+    """
+    if type(vector) is Vec3:
+        return vector
+    return Vec3(np.asarray(vector, dtype=float).tolist())
+
+
+def dot(a, b):
+    """
+    Calculates dot products of corresponding vectors.
+    :return: numpy array of dot products (a single value for single vectors)
+    """
+    return a[..., 0]*b[..., 0] + a[..., 1]*b[..., 1] + a[..., 2]*b[..., 2]
+
+
+def cross(a, b):
+    """
+    Calculates cross products of corresponding vectors.
+    """
+    return np.stack((a[..., 1]*b[..., 2] - a[..., 2]*b[..., 1],
+                     a[..., 2]*b[..., 0] - a[..., 0]*b[..., 2],
+                     a[..., 0]*b[..., 1] - a[..., 1]*b[..., 0]), axis=-1)
+
+
+def norm(vectors):
+    """
+    Calculates lengths of given vectors.
+    """
+    return np.sqrt(dot(vectors, vectors))
+
+
+def normalize(vectors):
+    """
+    Creates normalized copies of given vectors.
+    """
+    return vectors / norm(vectors)[..., np.newaxis]
+
+
+def reflection(vectors, normals):
+    """
+    Creates reflections of given vectors in relation to given normals.
+    """
+    return vectors - 2*dot(vectors, normals)[..., np.newaxis]*normals
+
+
+def select(values, mask, item_ndim=0):
+    """
+    Selects values that belong to the rays from a mask.
+
+    Values shared by all rays (e.g. a single eye point or a single far distance) are returned unchanged.
+    :param values: values of all rays or a value shared by all rays
+    :param mask: boolean mask or indices of selected rays
+    :param item_ndim: number of dimensions of a value that belongs to one ray (0 for numbers, 1 for vectors)
+    """
+    if np.ndim(values) > item_ndim:
+        return values[mask]
+    return values
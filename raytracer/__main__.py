@@ -0,0 +1,74 @@
+"""
+Renders a scene file (see SceneFiles module) from the command line:
+
+    python -m raytracer scene.rtscene --size 1280x720 --output image.png
+
+The camera saved in the scene file is used. Camera options that are given replace only the corresponding
+parameters of the saved camera (or of the default camera, if the scene file does not contain one).
+"""
+import argparse
+import math
+import sys
+import time
+from raytracer.Camera import Camera
+from raytracer.SceneFiles import load_scene
+
+
+def _parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def _parse_vector(text):
+    x, y, z = (float(value) for value in text.split(','))
+    return x, y, z
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m raytracer', description='Renders a scene file.')
+    parser.add_argument('scene', help='name of the scene file')
+    parser.add_argument('--output', '-o', default='image.png', help='name of the output image (default: image.png)')
+    parser.add_argument('--size', type=_parse_size, default=(128, 72), help='image size (default: 128x72)')
+    parser.add_argument('--position', type=_parse_vector, help='position of the camera, e.g. 4,4,4')
+    parser.add_argument('--look-at', type=_parse_vector, help='point the camera is looking at (default: 0,0,0)')
+    parser.add_argument('--up', type=_parse_vector, help="camera's 'up' direction (default: 0,1,0)")
+    parser.add_argument('--angle', type=float, help='horizontal angle of view in degrees (default: 45)')
+    parser.add_argument('--processes', type=int, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--tile-size', type=_parse_size, default=(64, 64), help='tile size (default: 64x64)')
+    parser.add_argument('--scalar', action='store_true', help='trace each ray separately instead of using batches')
+    arguments = parser.parse_args(arguments)
+
+    try:
+        scene, camera = load_scene(arguments.scene)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    camera = _merge_camera(camera, arguments)
+
+    start_time = time.time()
+    camera.render_image(scene, arguments.size, arguments.output, batch=not arguments.scalar,
+                        tile_size=arguments.tile_size, processes=arguments.processes)
+    print('Rendered {} in {:.2f} s'.format(arguments.output, time.time() - start_time))
+    return 0
+
+
+def _merge_camera(camera, arguments):
+    """
+    Replaces parameters of the camera (or of the default camera, if camera is None) with the camera options
+    that are given.
+    """
+    options = (arguments.position, arguments.look_at, arguments.up, arguments.angle)
+    if camera is not None and all(option is None for option in options):
+        return camera
+    if camera is None:
+        position, look_at, up, angle = (4, 4, 4), (0, 0, 0), (0, 1, 0), 45
+    else:
+        position, look_at, up = camera.position, camera.position + camera.front, camera.up
+        angle = math.degrees(2*math.atan(camera.image_plane_width/2))
+    return Camera(position if arguments.position is None else arguments.position,
+                  look_at if arguments.look_at is None else arguments.look_at,
+                  up if arguments.up is None else arguments.up,
+                  angle if arguments.angle is None else arguments.angle)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,38 @@
+import asyncio
 import os
+import pickle
+import socket
+import tempfile
+import time
+from multiprocessing import Process
+from multiprocessing.pool import Pool
+from unittest import mock
 from unittest.case import TestCase
 
+import numpy as np
 from PIL import Image
 
+from raytracer import Vectors
+from raytracer.__main__ import main
+from raytracer.Animation import Animation, CameraPath
+from raytracer.Benchmarks import run_benchmarks, compare_results
+from raytracer.Caching import RenderCache, get_render_key
 from raytracer.Camera import Camera
+from raytracer.Distributed import RenderCoordinator, RenderWorker, _authenticate
+from raytracer.Framebuffer import MemmapFramebuffer, Tile, get_tiles, order_tiles
+from raytracer.Instancing import Instance, InstanceGroup, create_transform
 from raytracer.Lights import Sun, Ambient, Point
 from raytracer.Materials import BLUE_GLOSSY, ORANGE_GLOSSY, GRAY_MATTE, GRAY_GLOSSY, ORANGE_MATTE, MIRROR_GLOSSY, \
-    BLUE_MATTE
+    BLUE_MATTE, Material
+from raytracer.Meshes import TriangleMesh, load_obj, save_mesh, load_mesh
 from raytracer.Objects import Sphere, Plane, Circle
+from raytracer.Output import PngWriter, RawWriter
+from raytracer.Particles import SphereCloud, load_sphere_cloud, save_sphere_cloud
+from raytracer.Sampling import AdaptiveSampler
 from raytracer.Scene import Scene
+from raytracer.SceneFiles import load_scene, save_scene
+from raytracer.Session import AsyncRenderSession, RenderSession
+from raytracer.Statistics import RenderStats
 
 
 class RayTracingTests(TestCase):
@@ -168,3 +192,779 @@ class RayTracingTests(TestCase):
         camera = Camera((0, 0.4, 4), (0, 0, 0))
         rendered_image = camera.render_image(scene, file_name=None)
         self.compare_images(rendered_image, 'blue_light.png')
+
+    def test_batch_multiple_reflections(self):
+        light1 = Point(position=(-5, 5, 5))
+        light2 = Ambient()
+        sphere1 = Sphere((-0.7, 0, 0.2), 1, MIRROR_GLOSSY)
+        plane1 = Plane(position=(0, -2, 0), material=BLUE_GLOSSY)
+        circle1 = Circle(center=(0.8, 0, -0.5), normal=(-1, 0, 1), radius=1.5, front_material=MIRROR_GLOSSY)
+
+        scene = Scene()
+        scene.background_color = (0, 0, 0)
+        scene.objects.append(circle1)
+        scene.objects.append(sphere1)
+        scene.objects.append(plane1)
+        scene.lights.append(light1)
+        scene.lights.append(light2)
+
+        camera = Camera((0, 3, 3), (0, 0, 0))
+        rendered_image = camera.render_image(scene, (100, 100), file_name=None, batch=True)
+        self.compare_images(rendered_image, 'multiple_reflections.png')
+
+    def test_batch_circle_front_back(self):
+        light1 = Point(position=(5, 5, 5))
+        light2 = Sun()
+        circle1 = Circle(center=(0, 0, 0.5), front_material=GRAY_GLOSSY, back_material=BLUE_GLOSSY)
+        circle2 = Circle(center=(0, 1, -0.5), normal=(0, -1, 0), front_material=GRAY_GLOSSY, back_material=BLUE_GLOSSY)
+        plane1 = Plane(position=(0, -0.2, 0), material=ORANGE_MATTE)
+
+        scene = Scene()
+        scene.objects.append(circle1)
+        scene.objects.append(circle2)
+        scene.objects.append(plane1)
+        scene.lights.append(light1)
+        scene.lights.append(light2)
+
+        camera = Camera((0, 3, 3), (0, 0, 0))
+        rendered_image = camera.render_image(scene, (64, 64), file_name=None)
+        batch_rendered_image = camera.render_image(scene, (64, 64), file_name=None, batch=True)
+        self.assertEqual(list(rendered_image.getdata()), list(batch_rendered_image.getdata()))
+
+    def test_uneven_tiles(self):
+        scene = Scene()
+        scene.objects.append(Sphere((0, 0, 0), 0.5, ORANGE_GLOSSY))
+        scene.objects.append(Sphere((0.124, 0.484, 0), 0.3, BLUE_GLOSSY))
+        scene.objects.append(Sphere((-0.5, 0, 0), 0.3, BLUE_GLOSSY))
+        scene.objects.append(Plane(position=(0, -0.7, 0), material=GRAY_MATTE))
+        scene.lights.append(Sun())
+        scene.lights.append(Ambient())
+
+        camera = Camera((0, 0.4, 4), (0, 0, 0), horizontal_angle=60)
+        rendered_image = camera.render_image(scene, file_name=None, batch=True, tile_size=(7, 13))
+        self.compare_images(rendered_image, 'camera_angle_60.png')
+
+    def test_bounding_volume_hierarchy(self):
+        scene = Scene()
+        for x, y, z in np.ndindex(4, 4, 4):
+            material = MIRROR_GLOSSY if (x + y + z) % 3 == 0 else ORANGE_GLOSSY
+            scene.objects.append(Sphere((x - 1.5, y - 1.5, z - 1.5), 0.3, material))
+        scene.objects.append(Circle(center=(0, 0, -3), normal=(0, 0.2, 1), radius=2, front_material=BLUE_GLOSSY))
+        scene.objects.append(Plane(position=(0, -2.5, 0), material=GRAY_MATTE))
+        scene.lights.append(Point(position=(-5, 5, 5)))
+        scene.lights.append(Sun(direction=(1, -1, -1)))
+        scene.lights.append(Ambient())
+
+        camera = Camera((2, 3, 6), (0, 0, 0))
+        tile = Tile(0, 0, 40, 30)
+        colors = camera.calculate_tile_colors(tile, (40, 30), scene)
+        batch_colors = camera.calculate_tile_colors(tile, (40, 30), scene, batch=True)
+        scene.prepare()
+        self.assertIsNotNone(scene.acceleration_structure.hierarchy)
+        np.testing.assert_array_equal(colors, camera.calculate_tile_colors(tile, (40, 30), scene))
+        np.testing.assert_array_equal(batch_colors, camera.calculate_tile_colors(tile, (40, 30), scene, batch=True))
+
+        # objects and lights changed after preparing the scene are not ignored
+        scene.objects.append(Sphere((0, 0, 4), 0.5, BLUE_GLOSSY))
+        scene.lights.pop(0)
+        self.assertIsNone(scene.acceleration_structure)
+        self.assertIsNone(scene.light_table)
+        eye, direction = np.array((0, 0, 6.0)), np.array((0, 0, -1.0))
+        self.assertEqual(scene.check_collision(eye, direction).material, BLUE_GLOSSY)
+        self.assertEqual(scene.check_collisions(eye, direction[np.newaxis]).distance[0], 1.5)
+        self.assertTrue(scene.check_occlusion(eye, direction, far=2, cache_key=0))
+        self.assertTrue(scene.check_occlusions(eye, direction[np.newaxis], far=2)[0])
+        colors = camera.calculate_tile_colors(tile, (40, 30), scene)
+        np.testing.assert_array_equal(colors, camera.calculate_tile_colors(tile, (40, 30), scene, batch=True))
+        scene.prepare()
+        np.testing.assert_array_equal(colors, camera.calculate_tile_colors(tile, (40, 30), scene))
+
+    def test_triangle_mesh(self):
+        with tempfile.TemporaryDirectory() as directory:
+            obj_file_name = os.path.join(directory, 'octahedron.obj')
+            with open(obj_file_name, 'w') as obj_file:
+                obj_file.write('v 1 0 0\nv -1 0 0\nv 0 1 0\nv 0 -1 0\nv 0 0 1\nv 0 0 -1\n'
+                               'f 1 3 5\nf 3 2 5\nf 2 4 5\nf 4 1 5\nf 3 1 6\nf 2 3 6\nf 4 2 6\nf 1 4 6\n')
+            mesh = load_obj(obj_file_name, ORANGE_GLOSSY)
+            mesh_file_name = os.path.join(directory, 'octahedron.mesh')
+            save_mesh(mesh, mesh_file_name)
+            loaded_mesh = pickle.loads(pickle.dumps(load_mesh(mesh_file_name)))
+            self.assertEqual(loaded_mesh.material, ORANGE_GLOSSY)
+            np.testing.assert_array_equal(mesh.indices, loaded_mesh.indices)
+
+            scene = Scene()
+            scene.objects.append(mesh)
+            scene.objects.append(Plane(position=(0, -1.5, 0), material=GRAY_MATTE))
+            scene.lights.append(Point(position=(-5, 5, 5)))
+            scene.lights.append(Ambient())
+
+            camera = Camera((1, 2, 3), (0, 0, 0))
+            tile = Tile(0, 0, 40, 30)
+            colors = camera.calculate_tile_colors(tile, (40, 30), scene)
+            np.testing.assert_array_equal(colors, camera.calculate_tile_colors(tile, (40, 30), scene, batch=True))
+            scene.objects[0] = loaded_mesh
+            np.testing.assert_array_equal(colors, camera.calculate_tile_colors(tile, (40, 30), scene, batch=True))
+            self.assertNotEqual(tuple(colors[15, 20]), scene.background_color)
+            del scene, loaded_mesh
+
+    def test_empty_mesh(self):
+        with tempfile.TemporaryDirectory() as directory:
+            obj_file_name = os.path.join(directory, 'points.obj')
+            with open(obj_file_name, 'w') as obj_file:
+                obj_file.write('v 1 0 0\nv -1 0 0\nv 0 1 0\n')
+            meshes = [TriangleMesh([], []), load_obj(obj_file_name)]
+        self.assertEqual(len(meshes[1].indices), 0)
+        self.assertIsNone(meshes[0].check_collision((0, 0, 0), (0, 0, -1), 0, np.inf))
+
+        scene = Scene()
+        scene.objects.append(Plane(position=(0, -1, 0), material=GRAY_MATTE))
+        scene.lights.append(Point(position=(-5, 5, 5)))
+        camera = Camera((0, 0, 3), (0, 0, 0))
+        image = camera.render_image(scene, (32, 24), None, processes=1).tobytes()
+        scene.objects.extend(meshes)
+        self.assertEqual(image, camera.render_image(scene, (32, 24), None, processes=1).tobytes())
+        self.assertEqual(image, camera.render_image(scene, (32, 24), None, batch=True, processes=1).tobytes())
+        self.assertEqual(image, camera.render_image(scene.compile(), (32, 24), None, batch=True,
+                                                    processes=1).tobytes())
+
+    def test_instancing(self):
+        vertices = np.array([(0, 1, 0), (-1, -1, 1), (1, -1, 1), (0, -1, -1)])
+        indices = [(0, 1, 2), (0, 2, 3), (0, 3, 1), (1, 3, 2)]
+        mesh = TriangleMesh(vertices, indices, material=ORANGE_GLOSSY)
+        sphere = Sphere((0, 0, 0), 1, BLUE_GLOSSY)
+        transform = create_transform((-1, 0, 0), (1, 0.5, 1), (1, 1, 0), 30)
+        positions = [(x, 0.5, z) for x, z in np.ndindex(3, 2)]
+        materials = [MIRROR_GLOSSY if x == 1 else None for x, y, z in positions]
+        camera = Camera((0, 3, 5), (0, 0, 0))
+
+        def render(objects):
+            scene = Scene()
+            scene.objects.extend(objects)
+            scene.objects.append(Plane(position=(0, -1, 0), material=GRAY_MATTE))
+            scene.lights.append(Point(position=(3, 5, 4)))
+            scene.lights.append(Ambient())
+            image = camera.render_image(scene, (48, 36), None, processes=1)
+            self.assertEqual(image.tobytes(), camera.render_image(scene, (48, 36), None, batch=True,
+                                                                  processes=1).tobytes())
+            self.assertEqual(image.tobytes(), camera.render_image(scene.compile(), (48, 36), None, batch=True,
+                                                                  processes=1).tobytes())
+            return image.tobytes()
+
+        transformed_mesh = TriangleMesh(vertices @ transform[:3, :3].T + transform[:3, 3], indices,
+                                        material=ORANGE_GLOSSY)
+        image = render([transformed_mesh] + [Sphere(position, 0.4, material or BLUE_GLOSSY)
+                                             for position, material in zip(positions, materials)])
+        self.assertEqual(image, render([Instance(mesh, transform)] + [
+            Instance(sphere, create_transform(position, 0.4), material)
+            for position, material in zip(positions, materials)]))
+        self.assertEqual(image, render([InstanceGroup(mesh, [transform]), InstanceGroup(
+            sphere, [create_transform(position, 0.4) for position in positions], materials)]))
+
+        transforms = [create_transform((x, 0, z)) for x, z in np.ndindex(100, 100)]
+        group = InstanceGroup(mesh, transforms)
+        self.assertLess(len(pickle.dumps(group)), 200 * len(group))
+        self.assertLess(len(pickle.dumps(group)), len(pickle.dumps([Instance(mesh, t) for t in transforms])) / 2)
+        with self.assertRaises(ValueError):
+            Instance(mesh, np.zeros((4, 4)))
+
+    def test_sphere_cloud(self):
+        random = np.random.default_rng(0)
+        centers = random.uniform(-1.5, 1.5, (100, 3)).astype(np.float32)
+        radii = random.uniform(0.05, 0.3, 100).astype(np.float32)
+        material_indices = random.integers(0, 3, 100)
+        materials = (BLUE_GLOSSY, MIRROR_GLOSSY, ORANGE_MATTE)
+        camera = Camera((0, 3, 5), (0, 0, 0))
+
+        def create_scene(objects):
+            scene = Scene()
+            scene.objects.extend(objects)
+            scene.objects.append(Plane(position=(0, -2, 0), material=GRAY_MATTE))
+            scene.lights.append(Point(position=(3, 5, 4)))
+            scene.lights.append(Ambient())
+            return scene
+
+        scene = create_scene([Sphere(center.astype(float), float(radius), materials[material])
+                              for center, radius, material in zip(centers, radii, material_indices)])
+        image = camera.render_image(scene, (48, 36), None, batch=True, processes=1).tobytes()
+        with tempfile.TemporaryDirectory() as directory:
+            np.save(os.path.join(directory, 'centers.npy'), centers)
+            cloud = SphereCloud(np.load(os.path.join(directory, 'centers.npy'), mmap_mode='r'), radii,
+                                material_indices, materials)
+            cloud_file_name = os.path.join(directory, 'cloud.rtcloud')
+            save_sphere_cloud(cloud, cloud_file_name)
+            loaded_cloud = pickle.loads(pickle.dumps(load_sphere_cloud(cloud_file_name)))
+            self.assertEqual(loaded_cloud.materials, materials)
+            self.assertLess(len(pickle.dumps(load_sphere_cloud(cloud_file_name))), 1000)
+
+            for cloud in (cloud, loaded_cloud):
+                scene = create_scene([cloud])
+                for batch in (False, True):
+                    self.assertEqual(image, camera.render_image(scene, (48, 36), None, batch=batch,
+                                                                processes=1).tobytes())
+                self.assertEqual(image, camera.render_image(scene.compile(), (48, 36), None, batch=True,
+                                                            processes=1).tobytes())
+            del cloud, loaded_cloud, scene
+
+    def test_scene_file(self):
+        scene = Scene()
+        scene.objects.append(Sphere((0, 0.5, 0), 0.5, ORANGE_GLOSSY))
+        scene.objects.append(TriangleMesh([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)],
+                                          [(0, 2, 4), (2, 1, 4), (1, 3, 4), (3, 0, 4)], material=BLUE_GLOSSY))
+        scene.objects.append(Circle((1, 0, -1), (1, 1, 1), 0.7, MIRROR_GLOSSY, BLUE_MATTE))
+        scene.objects.append(Plane(position=(0, -1, 0), normal=(0, 1, 0.1), material=GRAY_MATTE))
+        scene.lights.append(Sun(direction=(1, -3, -2)))
+        scene.lights.append(Point(position=(-2, 3, 2)))
+        scene.lights.append(Ambient((40, 40, 40)))
+        scene.background_color = (10, 20, 30)
+        scene.max_recursion_level = 3
+        camera = Camera((1, 2, 5), (0, 0, 0), horizontal_angle=50)
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'scene.rtscene')
+            save_scene(scene, file_name, camera)
+            loaded_scene, loaded_camera = load_scene(file_name)
+            self.assertEqual(scene.background_color, loaded_scene.background_color)
+            self.assertEqual(scene.objects[0].material, loaded_scene.objects[0].material)
+            self.assertEqual([type(obj) for obj in scene.objects], [type(obj) for obj in loaded_scene.objects])
+            for batch in (False, True):
+                image = camera.render_image(scene, (40, 30), None, batch=batch)
+                self.assertEqual(image.tobytes(), loaded_camera.render_image(loaded_scene, (40, 30), None,
+                                                                             batch=batch).tobytes())
+
+            image_file_name = os.path.join(directory, 'image.png')
+            self.assertEqual(0, main([file_name, '--size', '40x30', '--output', image_file_name, '--processes', '1']))
+            self.assertEqual(image.tobytes(), Image.open(image_file_name).tobytes())
+
+            # camera options replace only the given parameters of the saved camera
+            wide_camera = Camera((1, 2, 5), (0, 0, 0), horizontal_angle=70)
+            self.assertEqual(0, main([file_name, '--size', '40x30', '--output', image_file_name, '--processes', '1',
+                                      '--angle', '70']))
+            self.assertEqual(wide_camera.render_image(scene, (40, 30), None, batch=True).tobytes(),
+                             Image.open(image_file_name).tobytes())
+
+            with open(file_name, 'r+b') as file:
+                file.truncate(os.path.getsize(file_name) - 8)
+            with self.assertRaises(ValueError):
+                load_scene(file_name)
+
+    def test_occlusion(self):
+        scene = Scene()
+        for x, y in np.ndindex(5, 5):
+            scene.objects.append(Sphere((x - 2, y - 2, 0), 0.3))
+            scene.objects.append(Circle((x - 2, y - 2, 1), (0, 0.5, 1), 0.3))
+        scene.objects.append(Plane(position=(0, 0, -2), normal=(0, 0, 1)))
+        scene.prepare()
+
+        rng = np.random.default_rng(0)
+        eyes = rng.uniform(-3, 3, (200, 3))
+        directions = rng.normal(size=(200, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        far = rng.uniform(0, 5, 200)
+        expected = [scene.check_collision(eye, direction, far=f) is not None
+                    for eye, direction, f in zip(eyes, directions, far)]
+        self.assertEqual(expected, [scene.check_occlusion(eye, direction, far=f, cache_key='light')
+                                    for eye, direction, f in zip(eyes, directions, far)])
+        self.assertEqual(expected, list(scene.check_occlusions(eyes, directions, far=far)))
+        scene.acceleration_structure = None
+        self.assertEqual(expected, list(scene.check_occlusions(eyes, directions, far=far)))
+
+    def test_scalar_collisions(self):
+        scene = Scene()
+        for x, y in np.ndindex(4, 4):
+            scene.objects.append(Sphere((x - 1.5, y - 1.5, 0), 0.4))
+            scene.objects.append(Circle((x - 1.5, y - 1.5, 1), (0, 0.5, 1), 0.4, BLUE_GLOSSY, ORANGE_GLOSSY))
+        scene.objects.append(Plane(position=(0, 0, -2), normal=(0, 0, 1)))
+        scene.prepare()
+
+        rng = np.random.default_rng(1)
+        eyes = rng.uniform(-3, 3, (300, 3))
+        directions = rng.normal(size=(300, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        distances, normals, materials = scene.check_collisions(eyes, directions)
+        material_table = scene.get_material_table()
+        for eye, direction, distance, normal, material in zip(eyes, directions, distances, normals, materials):
+            for ray in ((eye, direction), (Vectors.vec3(eye), Vectors.vec3(direction))):
+                result = scene.check_collision(*ray)
+                if distance == np.inf:
+                    self.assertIsNone(result)
+                    continue
+                self.assertEqual(distance, result.distance)
+                self.assertEqual(tuple(normal), tuple(result.normal))
+                self.assertEqual(tuple(eye + direction*distance), tuple(result.point))
+                self.assertIs(material_table.materials[material], result.material)
+
+    def test_streaming_output(self):
+        light1 = Point(position=(5, 5, 5))
+        light2 = Ambient()
+        sphere1 = Sphere((0, 0, 0), 1, BLUE_GLOSSY)
+        plane1 = Plane(position=(0, -2, 0), material=GRAY_MATTE)
+
+        scene = Scene()
+        scene.objects.append(sphere1)
+        scene.objects.append(plane1)
+        scene.lights.append(light1)
+        scene.lights.append(light2)
+
+        camera = Camera((0, 3, 3), (0, 0, 0))
+        with tempfile.TemporaryDirectory() as directory:
+            png_file_name = os.path.join(directory, 'image.png')
+            raw_file_name = os.path.join(directory, 'image.raw')
+            with PngWriter(png_file_name, (100, 100)) as png_writer, RawWriter(raw_file_name, (100, 100)) as raw_writer:
+                for tile, colors in camera.render_tiles(scene, (100, 100), tile_size=(30, 40), batch=True):
+                    png_writer.write_tile(tile, colors)
+                    raw_writer.write_tile(tile, colors)
+            self.compare_images(Image.open(png_file_name), 'lamp_specular.png')
+            with open(raw_file_name, 'rb') as raw_file:
+                self.compare_images(Image.frombytes('RGB', (100, 100), raw_file.read()), 'lamp_specular.png')
+
+        tiles = camera.render_tiles(scene, (100, 100), tile_size=(10, 10))
+        next(tiles)
+        tiles.close()
+
+    def test_tile_scheduling(self):
+        tiles = get_tiles((256, 256), (64, 64))
+        ordered_tiles = order_tiles(tiles)
+        self.assertEqual(sorted(ordered_tiles), sorted(tiles))
+        for tile, next_tile in zip(ordered_tiles, ordered_tiles[1:]):
+            self.assertEqual(abs(tile.left - next_tile.left) + abs(tile.top - next_tile.top), 64)
+        costs = {tile: 10 if tile.left == 192 else 1 for tile in tiles}
+        self.assertEqual({tile.left for tile in order_tiles(tiles, costs)[:4]}, {192})
+
+        scene = Scene()
+        scene.objects.append(Sphere((0, 0, 0), 0.25, BLUE_GLOSSY))
+        scene.objects.append(Circle((-2, 0, 0), (1, 0, 0), 1, MIRROR_GLOSSY))
+        scene.objects.append(Circle((2, 0, 0), (-1, 0, 0), 1, MIRROR_GLOSSY))
+        scene.lights.append(Point(position=(0, 3, 1)))
+        camera = Camera((1.5, 0.3, 0.5), (-2, 0, 0))
+        scene.prepare()
+        tiles = get_tiles((80, 40), (20, 20))
+        costs = dict(zip(tiles, camera.estimate_tile_costs(scene, (80, 40), tiles)))
+        self.assertGreater(costs[tiles[1]], 2 * costs[tiles[0]])
+        # costs are estimated by the workers in chunks, and only if there are more tiles than workers
+        with Pool(2) as pool:
+            self.assertEqual(camera._schedule_tiles(pool, 2, scene, (80, 40), (20, 20), None),
+                             order_tiles(tiles, costs))
+        pool = mock.Mock()
+        self.assertEqual(camera._schedule_tiles(pool, 8, scene, (80, 40), (20, 20), None), order_tiles(tiles))
+        pool.map.assert_not_called()
+
+        stats = RenderStats()
+        image = camera.render_image(scene, (80, 40), None, batch=True, tile_size=(20, 20), stats=stats)
+        self.assertEqual(image.tobytes(), camera.render_image(scene, (80, 40), None, batch=True, tile_size=(20, 20),
+                                                              tile_costs=stats.tile_times).tobytes())
+
+    def test_region_and_progressive_rendering(self):
+        scene = Scene()
+        scene.objects.append(Sphere((0, 0, 0), 1, MIRROR_GLOSSY))
+        scene.objects.append(Plane(position=(0, -2, 0), material=GRAY_MATTE))
+        scene.lights.append(Point(position=(5, 5, 5)))
+        scene.lights.append(Ambient())
+        camera = Camera((0, 3, 3), (0, 0, 0))
+
+        for batch in (False, True):
+            image = camera.render_image(scene, (60, 40), None, batch=batch, tile_size=(16, 16))
+            region_image = camera.render_image(scene, (60, 40), None, batch=batch, tile_size=(16, 16),
+                                               region=(10, 5, 45, 33))
+            self.assertEqual(region_image.size, (35, 28))
+            self.assertEqual(region_image.tobytes(), image.crop((10, 5, 45, 33)).tobytes())
+
+            previews = list(camera.render_progressive(scene, (60, 40), batch=batch, tile_size=(16, 16)))
+            self.assertEqual(len(previews), 3)
+            self.assertEqual(previews[-1].tobytes(), image.tobytes())
+            pixels, first_preview = np.asarray(image), np.asarray(previews[0])
+            self.assertTrue(np.array_equal(first_preview[::4, ::4], pixels[::4, ::4]))
+            self.assertTrue(np.array_equal(first_preview[1::4, 2::4], pixels[::4, ::4]))
+            self.assertTrue(np.array_equal(np.asarray(previews[1])[::2, ::2], pixels[::2, ::2]))
+
+        with self.assertRaises(ValueError):
+            camera.render_image(scene, (60, 40), None, region=(50, 0, 70, 10))
+        with self.assertRaises(ValueError):
+            next(camera.render_progressive(scene, (60, 40), steps=(3, 2, 1)))
+
+    def test_memmap_framebuffer(self):
+        scene = Scene()
+        scene.objects.append(Sphere((0, 0, 0), 1, BLUE_GLOSSY))
+        scene.objects.append(Plane(position=(0, -2, 0), material=GRAY_MATTE))
+        scene.lights.append(Point((1000, 1000, 1000), (5, 5, 5)))
+        scene.lights.append(Ambient())
+
+        camera = Camera((0, 3, 3), (0, 0, 0))
+        image = camera.render_image(scene, (100, 100), None, batch=True)
+        with tempfile.TemporaryDirectory() as directory:
+            png_file_name = os.path.join(directory, 'image.png')
+            for dtype in (np.uint8, np.float32):
+                framebuffer = MemmapFramebuffer(os.path.join(directory, 'image.bin'), (100, 100), dtype)
+                camera.render_framebuffer(scene, framebuffer, batch=True, tile_size=(30, 40))
+                self.assertEqual(image.tobytes(), framebuffer.to_image().tobytes())
+                with PngWriter(png_file_name, (100, 100)) as png_writer:
+                    framebuffer.write_to(png_writer, strip_height=16)
+                self.assertEqual(image.tobytes(), Image.open(png_file_name).tobytes())
+                if dtype == np.float32:
+                    self.assertGreater(framebuffer.pixels.max(), 255)
+                framebuffer.unlink()
+
+    def test_render_cache(self):
+        scene = Scene()
+        scene.objects.append(Sphere((0, 0, 0), 1, BLUE_GLOSSY))
+        scene.objects.append(Plane(position=(0, -2, 0), material=GRAY_MATTE))
+        scene.lights.append(Point(position=(5, 5, 5)))
+        scene.lights.append(Ambient())
+        camera = Camera((0, 3, 3), (0, 0, 0))
+
+        # equal scenes have equal keys, whether their objects share materials or not
+        def create_scene(shared):
+            material = Material((10, 20, 30))
+            equal_scene = Scene()
+            equal_scene.objects.extend((Sphere((0, 0, 0), 1, material),
+                                        Sphere((2, 0, 0), 1, material if shared else Material((10.0, 20, 30)))))
+            return equal_scene
+        self.assertEqual(get_render_key(create_scene(True), camera, (40, 30)),
+                         get_render_key(create_scene(False), camera, (40, 30)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = RenderCache(directory=directory)
+            key = get_render_key(scene, camera, (40, 30))
+            image = cache.render_image(scene, camera, (40, 30), batch=True)
+            with mock.patch.object(Camera, 'render_image', side_effect=AssertionError('Image rendered again')):
+                self.assertEqual(image.tobytes(), cache.render_image(scene, Camera((0, 3, 3), (0, 0, 0)), (40, 30),
+                                                                     tile_size=(10, 10)).tobytes())
+            self.assertEqual((1, 1), (cache.memory_hits, cache.misses))
+
+            scene.lights[0] = Point(position=(5, 5, 4))
+            other_image = cache.render_image(scene, camera, (40, 30), batch=True)
+            self.assertNotEqual(image.tobytes(), other_image.tobytes())
+            self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+            disk_cache = RenderCache(memory_size=0, directory=directory)
+            disk_cache.disk_size = disk_cache.counters['disk_bytes']
+            self.assertEqual(other_image.tobytes(), disk_cache.render_image(scene, camera, (40, 30)).tobytes())
+            scene.lights[0] = Point(position=(5, 4, 4))
+            disk_cache.render_image(scene, camera, (40, 30), batch=True)
+            self.assertEqual({'hits': 1, 'disk_hits': 1, 'misses': 1, 'memory_images': 0},
+                             {name: disk_cache.counters[name] for name in ('hits', 'disk_hits', 'misses',
+                                                                           'memory_images')})
+            # the least recently used image is removed first
+            file_names = os.listdir(directory)
+            self.assertNotIn(key + '.png', file_names)
+            self.assertIn(get_render_key(scene, camera, (40, 30)) + '.png', file_names)
+
+            # files are read and written without blocking other threads
+            def get_size(file_name):
+                self.assertFalse(disk_cache._lock.locked())
+                return os.stat(file_name).st_size
+            with mock.patch('os.path.getsize', side_effect=get_size) as getsize:
+                disk_cache.put(key, image)
+                self.assertEqual(image.tobytes(), disk_cache.get(key).tobytes())
+            self.assertEqual(getsize.call_count, 2)
+
+        # compiled scenes are rendered without caching
+        cache = RenderCache()
+        compiled_image = cache.render_image(scene.compile(), camera, (32, 18), batch=True, processes=1)
+        self.assertEqual(camera.render_image(scene, (32, 18), None, batch=True, processes=1).tobytes(),
+                         compiled_image.tobytes())
+        self.assertEqual((1, 0), (cache.uncacheable, cache.misses))
+
+    def test_adaptive_antialiasing(self):
+        sphere1 = Sphere((0, 0, 0), 1, BLUE_GLOSSY)
+        plane1 = Plane(position=(0, -2, 0), material=GRAY_MATTE)
+
+        scene = Scene()
+        scene.objects.append(sphere1)
+        scene.objects.append(plane1)
+        scene.lights.append(Sun())
+        scene.lights.append(Ambient())
+        scene.prepare()
+
+        sampler = AdaptiveSampler(initial_samples=2, max_samples=8, threshold=8)
+        camera = Camera((0, 3, 3), (0, 0, 0), antialiasing=sampler)
+        tile = Tile(0, 0, 60, 40)
+        colors, sample_counts = sampler.sample_tile(camera, tile, (60, 40), scene, batch=True)
+        scalar_colors, scalar_sample_counts = sampler.sample_tile(camera, tile, (60, 40), scene)
+        self.assertTrue(np.array_equal(colors, scalar_colors))
+        self.assertTrue(np.array_equal(sample_counts, scalar_sample_counts))
+
+        self.assertEqual(set(np.unique(sample_counts)), {2, 4, 6, 8})
+        self.assertLess(np.mean(sample_counts), 4)
+        reference = Camera((0, 3, 3), (0, 0, 0)).calculate_tile_colors(tile, (60, 40), scene, batch=True)
+        edges = sample_counts > 2
+        self.assertLess(np.abs(colors - np.clip(reference, 0, 255))[~edges].max(), 16)
+        self.assertTrue(np.array_equal(camera.calculate_tile_colors(tile, (60, 40), scene), colors))
+        # pixels on tile edges are compared with pixels of neighbouring tiles, so tiles do not change the image
+        for tile_size in ((16, 16), (7, 5)):
+            image = camera.render_image(scene, (60, 40), None, batch=True, tile_size=tile_size, processes=1)
+            self.assertTrue(np.array_equal(np.asarray(image), np.clip(colors, 0, 255)))
+
+    def test_benchmarks(self):
+        results = run_benchmarks(['water_molecule', 'spheres_10'], [(32, 18)], [1, 2])
+        self.assertEqual(len(results['results']), 4)
+        for result in results['results']:
+            self.assertEqual(result['primary_rays'], 32 * 18)
+            self.assertGreater(result['rays'], result['primary_rays'])
+            self.assertGreater(result['rays_per_second'], result['pixels_per_second'])
+            self.assertGreater(result['peak_rss'], 0)
+        self.assertEqual(results['results'][0]['scaling_efficiency'], 1)
+
+        slower = {'results': [dict(result, rays_per_second=result['rays_per_second'] / 2)
+                              for result in results['results']]}
+        self.assertEqual(compare_results(results, results), [])
+        self.assertEqual(len(compare_results(results, slower)), 4)
+
+    def test_render_stats(self):
+        light1 = Point(position=(5, 5, 5))
+        light2 = Ambient()
+        sphere1 = Sphere((0, 0, 0), 1, MIRROR_GLOSSY)
+        sphere2 = Sphere((2, 0, 0), 0.5, BLUE_GLOSSY)
+        plane1 = Plane(position=(0, -2, 0), material=GRAY_MATTE)
+
+        scene = Scene()
+        scene.objects.extend((sphere1, sphere2, plane1))
+        scene.lights.extend((light1, light2))
+
+        camera = Camera((0, 3, 3), (0, 0, 0))
+        for batch in (False, True):
+            stats = RenderStats()
+            image = camera.render_image(scene, (60, 40), None, batch=batch, tile_size=(32, 32), stats=stats)
+            self.assertEqual(image.tobytes(), camera.render_image(scene, (60, 40), None, batch=batch).tobytes())
+            self.assertEqual(stats.primary_rays, 60 * 40)
+            self.assertGreater(stats.rays[1], 0)
+            self.assertEqual(stats.rays[scene.max_recursion_level], 0)
+            self.assertGreater(stats.shadow_rays, 0)
+            self.assertEqual(set(stats.intersection_tests), {'Sphere', 'Plane'})
+            self.assertEqual(set(stats.times), {'camera', 'collisions', 'lighting', 'shadow rays'})
+            self.assertEqual(len(stats.tile_times), 4)
+            self.assertEqual(stats.get_heatmap().size, (60, 40))
+
+    def test_light_culling(self):
+        scene = Scene()
+        scene.objects.append(Sphere((0, 1, -10), 1, BLUE_GLOSSY))
+        scene.objects.append(Plane(position=(0, 0, 0), material=GRAY_MATTE))
+        for z in range(0, 80, 2):
+            scene.lights.append(Point(position=(2, 3, -z), max_lighting_distance=4))
+        scene.lights.append(Point(position=(0, 50, 0), max_lighting_distance=1000))
+        scene.lights.append(Ambient())
+        camera = Camera((0, 3, 4), (0, 1, -20))
+        scene.prepare()
+
+        lights = scene.get_light_table()
+        points = np.random.default_rng(0).uniform((-5, 0, -85), (5, 5, 5), (1000, 3))
+        for point in points:
+            found = lights.find_lights(Vectors.vec3(point))
+            reaching = [index for index, light in enumerate(scene.lights)
+                        if any(light.get_light_intensity_at(Vectors.vec3(point)))]
+            self.assertEqual(list(found), sorted(found))
+            self.assertLessEqual(set(reaching), set(found))
+            self.assertLess(len(found), 16)
+        self.assertLessEqual({index for point in points[:10] for index, light in enumerate(scene.lights)
+                              if any(light.get_light_intensity_at(Vectors.vec3(point)))},
+                             set(lights.find_lights_at_points(points[:10]).tolist()))
+
+        stats = RenderStats()
+        image = camera.render_image(scene, (60, 40), None, batch=True, stats=stats)
+        self.assertLess(stats.shadow_rays, 60 * 40 * 4)
+        self.assertEqual(image.tobytes(), camera.render_image(scene, (60, 40), None).tobytes())
+
+    def test_compiled_scene(self):
+        scene = Scene()
+        for x, y, z in np.ndindex(6, 3, 3):
+            material = (BLUE_GLOSSY, MIRROR_GLOSSY, ORANGE_MATTE)[(x + y + z) % 3]
+            scene.objects.append(Sphere((x - 2.5, y - 1, z - 1), 0.3, material))
+        scene.objects.append(Circle((0, 0, -3), (0, 0, 1), 2, MIRROR_GLOSSY, ORANGE_GLOSSY))
+        scene.objects.append(Circle((3, 1, 0), (-1, 1, 0), 1, BLUE_MATTE))
+        scene.objects.append(Plane(position=(0, -2, 0), material=GRAY_GLOSSY))
+        scene.lights.append(Point(position=(2, 5, 3)))
+        scene.lights.append(Sun(direction=(1, -2, -1)))
+        scene.lights.append(Ambient())
+        scene.prepare()
+
+        compiled_scene = pickle.loads(pickle.dumps(scene.compile()))
+        scene.objects.pop()
+        camera = Camera((4, 3, 6), (0, 0, 0))
+        tile = Tile(0, 0, 64, 36)
+        scene.prepare()
+        colors = camera.calculate_tile_colors(tile, (64, 36), scene, batch=True)
+        old_colors = camera.calculate_tile_colors(tile, (64, 36), compiled_scene, batch=True)
+        self.assertFalse(np.array_equal(colors, old_colors))
+        compiled_scene = scene.compile()
+        np.testing.assert_array_equal(colors, camera.calculate_tile_colors(tile, (64, 36), compiled_scene, batch=True))
+        small_tile = Tile(20, 10, 30, 20)
+        np.testing.assert_array_equal(colors[10:20, 20:30],
+                                      camera.calculate_tile_colors(small_tile, (64, 36), compiled_scene))
+
+    def test_animation(self):
+        sphere = Sphere((0, 0, 0), 1, BLUE_GLOSSY)
+        light = Point(position=(5, 5, 5))
+        scene = Scene()
+        scene.objects.extend((sphere, Plane(position=(0, -2, 0), material=GRAY_MATTE)))
+        scene.lights.extend((light, Ambient()))
+
+        def changes(frame):
+            if frame == 1:
+                return {('objects', 0, 'center'): np.array((0, 0.5, 0))}
+            return {('lights', 0, 'position'): np.array((5 - frame, 5, 5))}
+
+        camera_path = CameraPath([(0, (0, 3, 5), (0, 0, 0)), (2, (4, 3, 3), (0, 1, 0))])
+        animation = Animation(scene, camera_path, 4, changes)
+        frames = list(animation.render_frames((40, 30), batch=True, tile_size=(16, 16), processes=2))
+        self.assertEqual([frame for frame, image in frames], [0, 1, 2, 3])
+        np.testing.assert_array_equal(sphere.center, (0, 0, 0))
+        # frames rendered one at a time are the same
+        for (_, image), (_, other_image) in zip(frames, animation.render_frames(
+                (40, 30), batch=True, tile_size=(16, 16), processes=2, frames_ahead=0)):
+            self.assertEqual(image.tobytes(), other_image.tobytes())
+
+        for frame, image in frames:
+            sphere.center = np.array((0, 0, 0) if frame == 0 else (0, 0.5, 0))
+            light.position = np.array(((5, 5, 5), (5, 5, 5), (3, 5, 5), (2, 5, 5))[frame])
+            camera = Camera(*np.array([(0, 3, 5), (0, 0, 0)]) + min(frame, 2) / 2 * np.array([(4, 0, -2), (0, 1, 0)]))
+            self.assertEqual(image.tobytes(), camera.render_image(scene, (40, 30), None, batch=True).tobytes())
+
+        with self.assertRaises(ValueError):
+            Animation(scene.compile(), camera_path, 4, changes)
+
+    def test_relighting(self):
+        sun = Sun(direction=(-1, -2, -1))
+        scene = Scene()
+        scene.objects.extend((Sphere((0, 0, 0), 1, MIRROR_GLOSSY), Sphere((2, 0, 0), 0.5, BLUE_GLOSSY),
+                              Plane(position=(0, -2, 0), material=GRAY_MATTE)))
+        scene.lights.extend((Point(position=(5, 5, 5)), sun, Ambient()))
+
+        camera = Camera((0, 3, 5), (0, 0, 0))
+        gbuffer = camera.render_gbuffer(scene, (60, 40))
+        compiled_scene = scene.compile()
+        compiled_gbuffer = camera.render_gbuffer(compiled_scene, (60, 40))
+        for direction, color in (((1, -1, 0), (255, 255, 255)), ((0, -1, 1), (255, 128, 0))):
+            sun.direction = direction / np.linalg.norm(direction)
+            sun.color = np.array(color)
+            image = gbuffer.relight(scene)
+            self.assertEqual(image.tobytes(), camera.render_image(scene, (60, 40), None, batch=True).tobytes())
+            # lights changed in place are read again by compiled scenes as well
+            self.assertEqual(image.tobytes(), compiled_gbuffer.relight(compiled_scene).tobytes())
+            self.assertEqual(image.tobytes(), camera.render_image(compiled_scene, (60, 40), None, batch=True,
+                                                                  processes=1).tobytes())
+
+    def test_render_session(self):
+        scene = Scene()
+        scene.objects.extend((Sphere((0, 0, 0), 1, MIRROR_GLOSSY), Plane(position=(0, -2, 0), material=GRAY_MATTE)))
+        scene.lights.extend((Point(position=(5, 5, 5)), Ambient()))
+        cameras = Camera((0, 3, 5), (0, 0, 0)), Camera((4, 1, 0), (0, 0, 0), horizontal_angle=60)
+
+        with RenderSession(processes=2) as session:
+            scene_id = session.upload_scene(scene)
+            compiled_scene_id = session.upload_scene(scene.compile())
+            for camera in cameras * 2:
+                image = camera.render_image(scene, (40, 30), None, batch=True, tile_size=(16, 16))
+                for batch in (False, True):
+                    self.assertEqual(image.tobytes(), session.render_image(scene_id, camera, (40, 30), batch=batch,
+                                                                           tile_size=(16, 16)).tobytes())
+                self.assertEqual(image.tobytes(), session.render_image(compiled_scene_id, camera, (40, 30),
+                                                                       batch=True).tobytes())
+
+            scene.objects.pop()
+            self.assertEqual(session.upload_scene(scene, scene_id), scene_id)
+            image = cameras[0].render_image(scene, (40, 30), None)
+            self.assertEqual(image.tobytes(), session.render_image(scene_id, cameras[0], (40, 30)).tobytes())
+            tiles = list(session.render_tiles(scene_id, cameras[0], (40, 30), (16, 16)))
+            self.assertEqual(len(tiles), 6)
+        self.assertEqual(session.scenes, {})
+
+    def test_distributed_rendering(self):
+        scene = Scene()
+        scene.objects.extend((Sphere((0, 0, 0), 1, MIRROR_GLOSSY), Plane(position=(0, -2, 0), material=GRAY_MATTE)))
+        scene.lights.extend((Point(position=(5, 5, 5)), Ambient()))
+        camera = Camera((0, 3, 5), (0, 0, 0))
+
+        authkey = b'test'
+        workers = [RenderWorker(('localhost', 0), authkey) for _ in range(3)]
+        workers[0].handle = lambda connection: time.sleep(60)
+        processes = [Process(target=worker.serve_forever, daemon=True) for worker in workers]
+        for process, worker in zip(processes, workers):
+            process.start()
+            worker.close()
+        dead_worker = socket.create_server(('localhost', 0))
+        dead_worker_address = dead_worker.getsockname()
+        dead_worker.close()
+        try:
+            addresses = [dead_worker_address] + [worker.address for worker in workers]
+            coordinator = RenderCoordinator(addresses, authkey, timeout=1)
+            for batch in (False, True):
+                image = coordinator.render_image(scene, camera, (40, 30), batch=batch, tile_size=(16, 16))
+                self.assertEqual(image.tobytes(), camera.render_image(scene, (40, 30), None, batch=batch).tobytes())
+                self.assertEqual(len(coordinator.errors), 2)
+        finally:
+            for process in processes:
+                process.terminate()
+        with self.assertRaises(RuntimeError):
+            coordinator.render_image(scene, camera, (40, 30))
+
+        # a coordinator that stops sending requests does not block the worker
+        worker = RenderWorker(('localhost', 0), authkey, timeout=0.5)
+        process = Process(target=worker.serve_forever, daemon=True)
+        process.start()
+        worker.close()
+        try:
+            with socket.create_connection(worker.address, 5) as silent_connection:
+                _authenticate(silent_connection, authkey, b'coordinator', b'worker')
+                coordinator = RenderCoordinator([worker.address], authkey, timeout=5)
+                image = coordinator.render_image(scene, camera, (40, 30), tile_size=(16, 16))
+                self.assertEqual(image.tobytes(), camera.render_image(scene, (40, 30), None).tobytes())
+        finally:
+            process.terminate()
+
+        for create in (lambda: RenderWorker(('localhost', 0)), lambda: RenderCoordinator(addresses, b'')):
+            with self.assertRaises(ValueError):
+                create()
+
+    def test_async_render_session(self):
+        scene = Scene()
+        scene.objects.extend((Sphere((0, 0, 0), 1, MIRROR_GLOSSY), Plane(position=(0, -2, 0), material=GRAY_MATTE)))
+        scene.lights.extend((Point(position=(5, 5, 5)), Ambient()))
+        camera = Camera((0, 3, 5), (0, 0, 0))
+        image = camera.render_image(scene, (40, 30), None, batch=True)
+
+        async def render():
+            async with AsyncRenderSession(processes=2, max_renders=1) as session:
+                scene_id = session.upload_scene(scene)
+                big_render_progress, progress = [], []
+                big_render = asyncio.ensure_future(session.render_image(
+                    scene_id, camera, (4000, 3000), tile_size=(8, 8), progress=big_render_progress.append))
+                while not big_render_progress:
+                    await asyncio.sleep(0.01)
+                render = asyncio.ensure_future(session.render_image(scene_id, camera, (40, 30), batch=True,
+                                                                    tile_size=(16, 16), progress=progress.append))
+                await asyncio.sleep(0.1)
+                self.assertEqual(progress, [])
+                big_render.cancel()
+                rendered_images = [await render, await session.render_image(scene_id, camera, (40, 30), batch=True)]
+                self.assertTrue(big_render.cancelled())
+                self.assertEqual(progress, [1/6, 2/6, 3/6, 4/6, 5/6, 1])
+                return rendered_images
+
+        for rendered_image in asyncio.run(asyncio.wait_for(render(), 30)):
+            self.assertEqual(image.tobytes(), rendered_image.tobytes())
+
+    def test_weighted_reflections(self):
+        half_mirror = Material(color=(0, 0, 0), specular_color=(0, 0, 0), reflection_factor=0.5)
+        scene = Scene()
+        scene.objects.append(Plane(position=(0, -2, 0), material=half_mirror))
+        direction = np.array((0, -1, 1)) / np.sqrt(2)
+        self.assertEqual(scene.trace_ray(np.zeros(3), direction), (32, 32, 32))
+        scene.prepare()
+        np.testing.assert_array_equal(scene.trace_rays(np.zeros(3), direction[np.newaxis]), [(32, 32, 32)])
+
+        scene.objects.extend((Sphere((0, 0, 0), 1, half_mirror), Sphere((2.5, 0, 0), 1, half_mirror),
+                              Sphere((1.25, 2, 0), 1, half_mirror)))
+        scene.lights.append(Point(position=(5, 5, 5)))
+        scene.max_recursion_level = 8
+        camera = Camera((1.25, 0.8, 5), (1.25, 0.8, 0))
+        ray_counts = []
+        for threshold, roulette_weight in ((0, 0), (0.1, 0), (0, 0.1)):
+            scene.reflection_threshold, scene.russian_roulette_weight = threshold, roulette_weight
+            stats = RenderStats()
+            image = camera.render_image(scene, (60, 40), None, batch=True, stats=stats)
+            for batch in (False, True):
+                self.assertEqual(image.tobytes(), camera.render_image(scene, (60, 40), None, batch=batch).tobytes())
+            ray_counts.append(stats.rays)
+        self.assertGreater(ray_counts[0][4], 0)
+        self.assertEqual(ray_counts[1][4], 0)
+        self.assertGreater(ray_counts[1][3], 0)
+        self.assertTrue(0 < ray_counts[2][4] < ray_counts[0][4])